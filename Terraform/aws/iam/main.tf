@@ -68,7 +68,8 @@ resource "aws_iam_role_policy" "fastapi_permissions" {
           "s3:PutObject",
           "s3:GetObject",
           "s3:DeleteObject",
-          "s3:ListBucket"
+          "s3:ListBucket",
+          "s3:AbortMultipartUpload"
         ]
         Resource = [
           "arn:aws:s3:::${var.s3_bucket_name}",
@@ -80,6 +81,10 @@ resource "aws_iam_role_policy" "fastapi_permissions" {
         Action = [
           "dynamodb:PutItem",
           "dynamodb:GetItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem",
+          "dynamodb:BatchWriteItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:Scan",
           "dynamodb:Query"
         ]
@@ -93,6 +98,14 @@ resource "aws_iam_role_policy" "fastapi_permissions" {
           "states:GetExecutionHistory"
         ]
         Resource = "*"
+      },
+      {
+        # 一括解析ジョブは自分自身を非同期起動（InvocationType=Event）して実行する
+        Effect = "Allow"
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        Resource = "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.fastapi_function_name}"
       }
     ]
   })
@@ -141,6 +154,13 @@ resource "aws_iam_role_policy" "pipeline_worker_access" {
           "arn:aws:s3:::${var.s3_bucket_name}/*"
         ]
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "arn:aws:s3:::${var.s3_bucket_name}/derived/*"
+      },
       {
         Effect = "Allow"
         Action = [
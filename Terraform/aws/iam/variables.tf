@@ -18,6 +18,11 @@ variable "fastapi_role_name" {
   type        = string
 }
 
+variable "fastapi_function_name" {
+  description = "FastAPI Lambda function name (bulk jobs invoke it asynchronously)"
+  type        = string
+}
+
 variable "s3_bucket_name" {
   description = "S3 bucket name for image uploads"
   type        = string
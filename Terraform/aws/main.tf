@@ -30,6 +30,7 @@ module "iam" {
   project_name              = var.project_name
   lambda_role_name          = var.lambda_role_name
   fastapi_role_name         = var.fastapi_lambda_role_name
+  fastapi_function_name     = var.fastapi_lambda_function_name
   pipeline_worker_role_name = var.pipeline_worker_role_name
   s3_bucket_name            = var.s3_bucket_name
   lambda_zip_bucket         = var.lambda_zip_bucket
@@ -123,6 +124,8 @@ module "step_functions" {
   sns_topic_arn       = module.sns.topic_arn
   log_retention_days  = 7
   lambda_worker_arn   = module.lambda_pipeline_worker.function_arn
+
+  enable_combined_variant = var.enable_combined_state_machine
 }
 
 module "lambda_fastapi" {
@@ -87,6 +87,11 @@ output "step_functions_arn" {
   value       = module.step_functions.state_machine_arn
 }
 
+output "step_functions_combined_arn" {
+  description = "Combined (task=all) state machine ARN, if enabled"
+  value       = module.step_functions.combined_state_machine_arn
+}
+
 output "fastapi_lambda_function_url" {
   description = "FastAPI Function URL"
   value       = module.lambda_fastapi.function_url
@@ -53,6 +53,11 @@ resource "aws_s3_bucket_lifecycle_configuration" "this" {
     noncurrent_version_expiration {
       noncurrent_days = 3
     }
+
+    # 完了・中断されなかったマルチパートアップロード（/api/s3/multipart/*）のパートを掃除
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
   }
 }
 
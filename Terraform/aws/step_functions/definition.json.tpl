@@ -1,7 +1,46 @@
 {
   "Comment": "PoC MC Vision multi-model pipeline orchestrated by Step Functions",
-  "StartAt": "InvokeSageMaker",
+  "StartAt": "PrepareImage",
   "States": {
+    "PrepareImage": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::lambda:invoke",
+      "Parameters": {
+        "FunctionName": "${lambda_worker_arn}",
+        "Payload": {
+          "task": "prepare",
+          "s3_key.$": "$.s3_key",
+          "request_id.$": "$.requestId"
+        }
+      },
+      "ResultSelector": {
+        "artifacts.$": "$.Payload.artifacts"
+      },
+      "ResultPath": "$.prepared",
+      "Next": "InvokeSageMaker",
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "Lambda.ServiceException",
+            "Lambda.AWSLambdaException",
+            "Lambda.SdkClientException",
+            "Lambda.TooManyRequestsException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 3,
+          "BackoffRate": 2.0
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [
+            "States.ALL"
+          ],
+          "ResultPath": "$.error",
+          "Next": "NotifyFailure"
+        }
+      ]
+    },
     "InvokeSageMaker": {
       "Type": "Task",
       "Resource": "arn:aws:states:::lambda:invoke",
@@ -10,7 +49,8 @@
         "Payload": {
           "task": "sagemaker",
           "s3_key.$": "$.s3_key",
-          "request_id.$": "$.requestId"
+          "request_id.$": "$.requestId",
+          "artifacts.$": "$.prepared.artifacts"
         }
       },
       "ResultSelector": {
@@ -55,7 +95,8 @@
                 "Payload": {
                   "task": "bedrock",
                   "s3_key.$": "$.s3_key",
-                  "request_id.$": "$.requestId"
+                  "request_id.$": "$.requestId",
+                  "artifacts.$": "$.prepared.artifacts"
                 }
               },
               "ResultSelector": {
@@ -90,7 +131,8 @@
                 "Payload": {
                   "task": "azure",
                   "s3_key.$": "$.s3_key",
-                  "request_id.$": "$.requestId"
+                  "request_id.$": "$.requestId",
+                  "artifacts.$": "$.prepared.artifacts"
                 }
               },
               "ResultSelector": {
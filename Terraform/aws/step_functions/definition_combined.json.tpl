@@ -0,0 +1,146 @@
+{
+  "Comment": "PoC MC Vision pipeline variant: all models in a single worker invocation (task=all)",
+  "StartAt": "InvokeAllModels",
+  "States": {
+    "InvokeAllModels": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::lambda:invoke",
+      "Parameters": {
+        "FunctionName": "${lambda_worker_arn}",
+        "Payload": {
+          "task": "all",
+          "s3_key.$": "$.s3_key",
+          "request_id.$": "$.requestId"
+        }
+      },
+      "ResultSelector": {
+        "sagemaker.$": "$.Payload.sagemaker",
+        "bedrock": {
+          "bedrock.$": "$.Payload.bedrock"
+        },
+        "azure": {
+          "azure.$": "$.Payload.azure"
+        }
+      },
+      "ResultPath": "$.combined",
+      "Next": "PersistResults",
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "Lambda.ServiceException",
+            "Lambda.AWSLambdaException",
+            "Lambda.SdkClientException",
+            "Lambda.TooManyRequestsException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 3,
+          "BackoffRate": 2.0
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [
+            "States.ALL"
+          ],
+          "ResultPath": "$.error",
+          "Next": "NotifyFailure"
+        }
+      ]
+    },
+    "PersistResults": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::aws-sdk:dynamodb:putItem",
+      "Parameters": {
+        "TableName": "${ddb_table_name}",
+        "Item": {
+          "request_id": {
+            "S.$": "$.requestId"
+          },
+          "s3_key": {
+            "S.$": "$.s3_key"
+          },
+          "sagemaker": {
+            "S.$": "States.JsonToString($.combined.sagemaker)"
+          },
+          "bedrock": {
+            "S.$": "States.JsonToString($.combined.bedrock)"
+          },
+          "azure": {
+            "S.$": "States.JsonToString($.combined.azure)"
+          },
+          "created_at": {
+            "N.$": "States.Format('{}', $.timestamps.created)"
+          },
+          "expire_at": {
+            "N.$": "States.Format('{}', $.timestamps.expires)"
+          }
+        }
+      },
+      "ResultPath": "$.ddb",
+      "Next": "NotifyComplete",
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "DynamoDB.ProvisionedThroughputExceededException",
+            "DynamoDB.RequestLimitExceeded",
+            "DynamoDB.ThrottlingException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 3,
+          "BackoffRate": 2.0
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [
+            "States.ALL"
+          ],
+          "ResultPath": "$.error",
+          "Next": "NotifyFailure"
+        }
+      ]
+    },
+    "NotifyComplete": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::aws-sdk:sns:publish",
+      "Parameters": {
+        "TopicArn": "${sns_topic_arn}",
+        "Subject": "PoC MC Vision pipeline completed",
+        "Message.$": "States.Format('\\{\"requestId\": \"{}\", \"status\": \"SUCCEEDED\", \"s3_key\": \"{}\"\\}', $.requestId, $.s3_key)"
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "SNS.SdkClientException",
+            "SNS.ThrottledException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 3,
+          "BackoffRate": 2.0
+        }
+      ],
+      "End": true
+    },
+    "NotifyFailure": {
+      "Type": "Task",
+      "Resource": "arn:aws:states:::aws-sdk:sns:publish",
+      "Parameters": {
+        "TopicArn": "${sns_topic_arn}",
+        "Subject": "PoC MC Vision pipeline failed",
+        "Message.$": "States.Format('\\{\"requestId\": \"{}\", \"status\": \"FAILED\"\\}', $.requestId)"
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [
+            "SNS.SdkClientException",
+            "SNS.ThrottledException"
+          ],
+          "IntervalSeconds": 2,
+          "MaxAttempts": 3,
+          "BackoffRate": 2.0
+        }
+      ],
+      "End": true
+    }
+  }
+}
@@ -87,3 +87,23 @@ resource "aws_sfn_state_machine" "this" {
     log_destination        = "${aws_cloudwatch_log_group.this.arn}:*"
   }
 }
+
+# 全モデルを1回のワーカー起動で実行する比較用バリアント（task=all）
+resource "aws_sfn_state_machine" "combined" {
+  count = var.enable_combined_variant ? 1 : 0
+
+  name     = "${var.state_machine_name}-combined"
+  role_arn = aws_iam_role.this.arn
+
+  definition = templatefile("${path.module}/definition_combined.json.tpl", {
+    ddb_table_name    = var.dynamodb_table_name
+    sns_topic_arn     = var.sns_topic_arn
+    lambda_worker_arn = var.lambda_worker_arn
+  })
+
+  logging_configuration {
+    include_execution_data = true
+    level                  = "ALL"
+    log_destination        = "${aws_cloudwatch_log_group.this.arn}:*"
+  }
+}
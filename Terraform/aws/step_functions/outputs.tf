@@ -7,3 +7,8 @@ output "state_machine_name" {
   description = "Name of the state machine"
   value       = aws_sfn_state_machine.this.name
 }
+
+output "combined_state_machine_arn" {
+  description = "ARN of the single-invocation (task=all) variant, if enabled"
+  value       = var.enable_combined_variant ? aws_sfn_state_machine.combined[0].arn : null
+}
@@ -29,3 +29,9 @@ variable "lambda_worker_arn" {
   description = "Pipeline worker Lambda ARN used for model invocations"
   type        = string
 }
+
+variable "enable_combined_variant" {
+  description = "Also create the single-invocation (task=all) state machine variant for cost/latency comparison"
+  type        = bool
+  default     = false
+}
@@ -273,6 +273,12 @@ variable "state_machine_name" {
   default     = "poc-mc-vision-pipeline"
 }
 
+variable "enable_combined_state_machine" {
+  description = "Create the <state_machine_name>-combined variant that runs all models in one worker invocation"
+  type        = bool
+  default     = false
+}
+
 # ====================
 # Guardrails
 # ====================
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark local image lookup by request_id: glob scan vs. the request_id index.
+
+Creates --files empty "<request_id>__<name>.jpg" files in a temporary images
+directory, then measures the per-lookup time of the previous implementation
+(IMAGES_DIR.glob per request) and of _find_image_path_by_request_id backed by
+the index, at several directory sizes up to --files, for both hits and misses
+(unknown request_ids, which must not fall back to a directory scan). Index build
+time (directory scan + SQLite sidecar) and sidecar reload time are printed too.
+
+Usage:
+    python scripts/bench_image_index.py --files 100000 --lookups 200
+"""
+
+import argparse
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+def glob_lookup(images_dir: pathlib.Path, req_id: str) -> pathlib.Path:
+    # 変更前の実装（リクエストごとにディレクトリ全体を走査）
+    candidates = list(images_dir.glob(f"{req_id}__*"))
+    if not candidates:
+        raise FileNotFoundError(req_id)
+    return candidates[0]
+
+
+def per_lookup_us(fn, ids: list) -> float:
+    t0 = time.perf_counter()
+    for req_id in ids:
+        try:
+            fn(req_id)
+        except FileNotFoundError:
+            pass
+    return (time.perf_counter() - t0) * 1e6 / len(ids)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark request_id -> image path lookup.")
+    parser.add_argument("--files", type=int, default=100_000, help="Stored images at the largest size")
+    parser.add_argument("--lookups", type=int, default=200, help="Index lookups per size")
+    parser.add_argument("--glob-lookups", type=int, default=5, help="Glob lookups per size (slow)")
+    args = parser.parse_args()
+
+    main.log_json = lambda **kwargs: None
+    images_dir = pathlib.Path(tempfile.mkdtemp(prefix="mc-vision-index-")) / "images"
+    images_dir.mkdir()
+    main.IMAGES_DIR = images_dir
+
+    sizes = sorted({s for s in (1_000, 10_000, args.files) if s <= args.files})
+    ids: list = []
+    print(f"{'images':>8} {'glob (us)':>12} {'index (us)':>11} {'glob miss':>12} {'index miss':>11}"
+          f" {'build (ms)':>11} {'reload (ms)':>12}")
+    for size in sizes:
+        for _ in range(size - len(ids)):
+            req_id = str(uuid.uuid4())
+            (images_dir / f"{req_id}__sample.jpg").touch()
+            ids.append(req_id)
+
+        main.IMAGE_INDEX_REBUILD = True
+        t0 = time.perf_counter()
+        main._image_index_instance = None
+        main._image_index()
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        main.IMAGE_INDEX_REBUILD = False
+        t0 = time.perf_counter()
+        main._image_index_instance = None
+        main._image_index()
+        reload_ms = (time.perf_counter() - t0) * 1000
+
+        glob_us = per_lookup_us(lambda r: glob_lookup(images_dir, r), random.sample(ids, args.glob_lookups))
+        index_us = per_lookup_us(main._find_image_path_by_request_id, random.sample(ids, min(args.lookups, size)))
+        unknown = [str(uuid.uuid4()) for _ in range(args.lookups)]
+        glob_miss_us = per_lookup_us(lambda r: glob_lookup(images_dir, r), unknown[:args.glob_lookups])
+        index_miss_us = per_lookup_us(main._find_image_path_by_request_id, unknown)
+        print(f"{size:>8,} {glob_us:>12,.0f} {index_us:>11,.1f} {glob_miss_us:>12,.0f} {index_miss_us:>11,.1f}"
+              f" {build_ms:>11,.0f} {reload_ms:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for SageMaker classifier output post-processing.
+
+Compares the previous implementation (json.loads + Python max + full argsort)
+with the vectorized post-processing module (NumPy parse + argpartition top-k
++ label lookup) on a synthetic N x C score response.
+
+Usage:
+    python scripts/bench_postprocess.py --iterations 200 --batch 16 --classes 1000
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import postprocess  # noqa: E402
+
+
+def legacy_summarize(body: bytes) -> list:
+    # 変更前の実装（リストのまま argmax / max / argsort）
+    data = json.loads(body.decode("utf-8", errors="ignore"))
+    results = []
+    for scores in data:
+        results.append({
+            "predicted_class_index": int(np.argmax(scores)),
+            "confidence_score": float(max(scores)),
+            "top_5_indices": [int(i) for i in np.argsort(scores)[-5:][::-1]],
+            "all_scores": [scores],
+        })
+    return results
+
+
+def bench(fn, iterations: int):
+    out = fn()
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        out = fn()
+    return (time.perf_counter() - t0) * 1000 / iterations, out
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark classifier output post-processing.")
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations per implementation")
+    parser.add_argument("--batch", type=int, default=16, help="Images per response (N)")
+    parser.add_argument("--classes", type=int, default=1000, help="Classes per image (C)")
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    body = json.dumps(rng.random((args.batch, args.classes)).tolist()).encode("utf-8")
+    labels = [f"class_{i}" for i in range(args.classes)]
+
+    rows = [("legacy", bench(lambda: legacy_summarize(body), args.iterations)[0])]
+    for include_all in (True, False):
+        ms, out = bench(lambda: postprocess.summarize_scores(
+            postprocess.parse_scores(body), k=args.top_k, labels=labels, include_all_scores=include_all,
+        ), args.iterations)
+        rows.append(("vectorized (all_scores)" if include_all else "vectorized (top-k only)", ms))
+
+    legacy = legacy_summarize(body)
+    same = all(a["top_5_indices"] == b["top_5_indices"] for a, b in zip(legacy, out))
+    print(f"response: {args.batch} x {args.classes} ({len(body):,} bytes), iterations={args.iterations}")
+    print(f"{'implementation':<26} {'ms/response':>12}")
+    for name, ms in rows:
+        print(f"{name:<26} {ms:>12.3f}")
+    print(f"top-5 indices match legacy: {same}")
+
+
+if __name__ == "__main__":
+    main_cli()
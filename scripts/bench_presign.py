@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark presigned upload URL issuance: per-request client vs. reused client.
+
+Measures the per-URL latency of
+1. the previous implementation (a new virtual-hosted SigV4 boto3 S3 client
+   built for every request, then generate_presigned_url),
+2. _presign_put with the shared presign client, and
+3. POST /api/s3/presign/batch (in-process ASGI) divided by the batch size,
+compared with POST /api/s3/presign per URL.
+
+Presigning is local (no network); dummy credentials are used if none are set.
+
+Usage:
+    python scripts/bench_presign.py --iterations 50 --batch 20
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+import sys
+import time
+import uuid
+
+import boto3
+import httpx
+from botocore.client import Config
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIDEXAMPLE")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench-secret")
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+def legacy_presign(content_type: str = "image/jpeg") -> dict:
+    # 変更前の実装（リクエストごとにクライアントを生成）
+    key = f"uploads/{uuid.uuid4()}.jpg"
+    s3_client = boto3.client(
+        "s3",
+        region_name=main.AWS_REGION,
+        config=Config(signature_version="s3v4", s3={"addressing_style": "virtual"}),
+        endpoint_url=f"https://s3.{main.AWS_REGION}.amazonaws.com",
+    )
+    url = s3_client.generate_presigned_url(
+        ClientMethod="put_object",
+        Params={"Bucket": main.S3_UPLOAD_BUCKET, "Key": key, "ContentType": content_type},
+        ExpiresIn=main.S3_PRESIGN_EXPIRE_SEC,
+        HttpMethod="PUT",
+    )
+    return {"url": url, "key": key}
+
+
+def per_call_ms(fn, iterations: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - t0) * 1000 / iterations
+
+
+async def http_ms(iterations: int, batch: int):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://presign-bench") as client:
+        async def single():
+            r = await client.post("/api/s3/presign")
+            r.raise_for_status()
+
+        async def batched():
+            r = await client.post("/api/s3/presign/batch", params={"count": batch})
+            r.raise_for_status()
+            assert len(r.json()["items"]) == batch
+
+        results = []
+        for fn, per in ((single, 1), (batched, batch)):
+            await fn()
+            t0 = time.perf_counter()
+            for _ in range(iterations):
+                await fn()
+            results.append((time.perf_counter() - t0) * 1000 / iterations / per)
+        return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark presigned URL issuance.")
+    parser.add_argument("--iterations", type=int, default=50, help="Calls per mode")
+    parser.add_argument("--batch", type=int, default=20, help="URLs per /api/s3/presign/batch call")
+    args = parser.parse_args()
+
+    main.API_KEY_OPTIONAL = False
+    legacy = per_call_ms(legacy_presign, args.iterations)
+    reused = per_call_ms(lambda: main._presign_put("image/jpeg"), args.iterations)
+    http_single, http_batch = asyncio.run(http_ms(args.iterations, min(args.batch, main.S3_PRESIGN_BATCH_MAX)))
+
+    print(f"iterations={args.iterations}, batch={args.batch}")
+    print(f"{'mode':<36} {'ms/URL':>8}")
+    print(f"{'new client per call (before)':<36} {legacy:>8.2f}")
+    print(f"{'reused presign client (after)':<36} {reused:>8.2f}")
+    print(f"{'POST /api/s3/presign':<36} {http_single:>8.2f}")
+    print(f"{'POST /api/s3/presign/batch':<36} {http_batch:>8.2f}")
+
+
+if __name__ == "__main__":
+    main_cli()
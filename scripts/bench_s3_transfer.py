@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Throughput test for the S3 read path: single GetObject vs. ranged parallel GETs.
+
+Uses a local S3 stand-in that serves objects from memory and models S3's
+per-request time-to-first-byte (--ttfb-ms) and per-connection bandwidth
+(--conn-mbps). For each object size it measures the previous implementation
+(get_object + Body.read()) and _s3_get_bytes with the configured part size and
+thread count, verifies the bytes match, and prints MB/s.
+
+Usage:
+    python scripts/bench_s3_transfer.py --sizes 1,4,16,64 --part-mb 8 --threads 8
+"""
+
+import argparse
+import io
+import os
+import pathlib
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+class ThrottledBody(io.RawIOBase):
+    """1接続あたりの帯域を模した本文（読み込んだ量に応じて sleep する）"""
+
+    def __init__(self, data: memoryview, bytes_per_sec: float):
+        self._data, self._pos, self._rate = data, 0, bytes_per_sec
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._data) - self._pos, 256 * 1024)
+        b[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        time.sleep(n / self._rate)
+        return n
+
+    def read(self, amt=-1):
+        out = bytearray()
+        chunk = bytearray(256 * 1024)
+        while True:
+            n = self.readinto(chunk)
+            if not n:
+                return bytes(out)
+            out += chunk[:n]
+
+
+class LocalS3:
+    def __init__(self, ttfb: float, bytes_per_sec: float):
+        self.objects, self.ttfb, self.rate = {}, ttfb, bytes_per_sec
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        with self._lock:
+            self.requests += 1
+        data = self.objects[Key]
+        etag = f'"{len(data)}"'
+        if IfMatch is not None and IfMatch != etag:
+            raise RuntimeError("PreconditionFailed")
+        time.sleep(self.ttfb)
+        start, end = 0, len(data) - 1
+        if Range:
+            start, end = (int(v) for v in Range.split("=", 1)[1].split("-"))
+            end = min(end, len(data) - 1)
+        body = ThrottledBody(memoryview(data)[start:end + 1], self.rate)
+        resp = {"Body": body, "ContentLength": end - start + 1, "ETag": etag}
+        if Range:
+            resp["ContentRange"] = f"bytes {start}-{end}/{len(data)}"
+        return resp
+
+
+def measure(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Measure S3 read throughput against object size.")
+    parser.add_argument("--sizes", default="1,4,16,64", help="Object sizes in MiB (comma separated)")
+    parser.add_argument("--part-mb", type=float, default=8, help="Ranged GET part size in MiB")
+    parser.add_argument("--threads", type=int, default=8, help="Parallel ranged GETs")
+    parser.add_argument("--ttfb-ms", type=float, default=30, help="Simulated time to first byte per request")
+    parser.add_argument("--conn-mbps", type=float, default=80, help="Simulated bandwidth per connection (MiB/s)")
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    main.S3_TRANSFER_PART_BYTES = int(args.part_mb * 1024 * 1024)
+    main._s3_transfer_pool = main.ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix="s3-transfer")
+    fake = LocalS3(args.ttfb_ms / 1000, args.conn_mbps * 1024 * 1024)
+    main.s3 = fake
+
+    print(f"part={args.part_mb:g}MiB threads={args.threads} ttfb={args.ttfb_ms:g}ms conn={args.conn_mbps:g}MiB/s")
+    print(f"{'size (MiB)':>10} {'single (MB/s)':>14} {'ranged (MB/s)':>14} {'GETs':>5} {'speedup':>8}")
+    for size_mb in (float(v) for v in args.sizes.split(",")):
+        size = int(size_mb * 1024 * 1024)
+        key = f"uploads/bench-{size}.jpg"
+        fake.objects[key] = os.urandom(size)
+
+        single = measure(lambda: fake.get_object(Bucket="b", Key=key)["Body"].read(), args.repeat)
+        fake.requests = 0
+        ranged = measure(lambda: main._s3_get_bytes(key, bucket="b"), args.repeat)
+        gets = fake.requests // args.repeat
+        assert main._s3_get_bytes(key, bucket="b") == fake.objects[key]
+        mb = size / 1e6
+        print(f"{size_mb:>10g} {mb / single:>14.1f} {mb / ranged:>14.1f} {gets:>5} {single / ranged:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for SageMaker payload serialization (preprocess + encode).
+
+Compares the legacy JSON float-list body with the compact binary modes and
+prints per-image serialization time and body size.
+
+Usage:
+    python scripts/bench_sagemaker_payload.py --iterations 20 --size 1920x1080
+"""
+
+import argparse
+import io
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+def build_sample_jpeg(width: int, height: int) -> bytes:
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def legacy_payload(img_bytes: bytes) -> bytes:
+    # 変更前の実装（float64 で2パス正規化 + tolist + json.dumps）
+    img = Image.open(io.BytesIO(img_bytes)).convert("RGB").resize((224, 224))
+    arr = np.array(img, dtype=np.float32).transpose(2, 0, 1)
+    mean = np.array([0.485, 0.456, 0.406]).reshape(3, 1, 1)
+    std = np.array([0.229, 0.224, 0.225]).reshape(3, 1, 1)
+    arr = np.expand_dims((arr / 255.0 - mean) / std, axis=0)
+    return json.dumps(arr.tolist()).encode("utf-8")
+
+
+def bench(fn, iterations: int):
+    body = fn()
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        body = fn()
+    elapsed_ms = (time.perf_counter() - t0) * 1000 / iterations
+    return elapsed_ms, len(body if isinstance(body, bytes) else body[0])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark SageMaker payload modes.")
+    parser.add_argument("--iterations", type=int, default=20, help="Iterations per mode")
+    parser.add_argument("--size", default="1920x1080", help="Sample image size WxH")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    img_bytes = build_sample_jpeg(width, height)
+
+    rows = [("legacy-json",) + bench(lambda: legacy_payload(img_bytes), args.iterations)]
+    for mode in main.SAGEMAKER_PAYLOAD_MODES:
+        rows.append((mode,) + bench(lambda m=mode: main._prepare_sagemaker_payload(img_bytes, mode=m), args.iterations))
+
+    print(f"input: {width}x{height} JPEG ({len(img_bytes)} bytes), iterations={args.iterations}")
+    print(f"{'mode':<12} {'ms/image':>10} {'body bytes':>12}")
+    for mode, ms, size in rows:
+        print(f"{mode:<12} {ms:>10.2f} {size:>12,}")
+
+
+if __name__ == "__main__":
+    main_cli()
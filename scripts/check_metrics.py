@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Check that the EMF metrics actually reach stdout from every emitting context.
+
+Runs with AWS_EMF_ENVIRONMENT=Local (the same stdout sink as on Lambda),
+captures stdout and triggers each metric from the context it is emitted from in
+production:
+
+1. write-behind flush on the "write-behind" daemon thread
+   -> PersistQueueDepth / PersistFlushMs
+2. POST /api/analyze/aws/stream (mock Bedrock stream) inside the ASGI event loop
+   -> TimeToFirstTokenMs / TokensPerSecond
+3. circuit breaker opened by a provider call in a to_thread worker, then
+   rejecting an async provider call on the event loop
+   -> CircuitState / CircuitRejected
+
+Exits non-zero if any expected metric is missing from the EMF output.
+
+Usage:
+    python scripts/check_metrics.py
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import types
+
+import httpx
+
+os.environ["AWS_EMF_ENVIRONMENT"] = "Local"
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+class FakeTable:
+    def __init__(self):
+        self.meta = types.SimpleNamespace(client=self)
+
+    def batch_write_item(self, RequestItems):
+        return {"UnprocessedItems": {}}
+
+
+def emitted_metrics(output: str) -> dict:
+    """EMF の JSON 行から {メトリクス名: [値, ...]} を作る"""
+    found = {}
+    for line in output.splitlines():
+        try:
+            doc = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(doc, dict) or "_aws" not in doc:
+            continue
+        for directive in doc["_aws"]["CloudWatchMetrics"]:
+            for metric in directive["Metrics"]:
+                found.setdefault(metric["Name"], []).append(doc[metric["Name"]])
+    return found
+
+
+def run_write_behind():
+    main.ddb = FakeTable()
+    main._persistence = main._WriteBehind(True)
+    emitted = threading.Event()
+    record = main._record_persist_flush
+
+    def record_and_signal(*args, **kwargs):
+        record(*args, **kwargs)
+        assert threading.current_thread().name == "write-behind"
+        emitted.set()
+
+    main._record_persist_flush = record_and_signal
+    try:
+        main._persistence.put_item({"request_id": "metrics-check", "created_at": 0, "expire_at": 0})
+        emitted.wait(main.PERSIST_FLUSH_INTERVAL_SEC + 5)
+    finally:
+        main._record_persist_flush = record
+
+
+def run_stream():
+    async def post():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://metrics-check") as client:
+            resp = await client.post("/api/analyze/aws/stream", json={"request_id": "metrics-check"})
+            assert resp.status_code == 200 and "event: result" in resp.text
+
+    main.USE_REAL = False
+    asyncio.run(post())
+
+
+class UpstreamError(Exception):
+    response = {"Error": {"Code": "InternalFailure"}, "ResponseMetadata": {"HTTPStatusCode": 500}}
+
+
+def run_circuit():
+    main._circuit_breakers["sagemaker"] = main.CircuitBreaker("sagemaker", 1, 30, 1, 1)
+
+    @main._circuit("sagemaker")
+    def failing_call():
+        raise UpstreamError()
+
+    @main._circuit("sagemaker")
+    async def async_call():
+        return None
+
+    async def calls():
+        try:
+            await asyncio.to_thread(failing_call)
+        except UpstreamError:
+            pass
+        try:
+            await async_call()
+        except main.CircuitOpenError:
+            pass
+
+    asyncio.run(calls())
+    assert main._circuit_breakers["sagemaker"].state == "open"
+
+
+SCENARIOS = [
+    ("write-behind flush (daemon thread)", run_write_behind, ["PersistQueueDepth", "PersistFlushMs"]),
+    ("SSE stream (running event loop)", run_stream, ["TimeToFirstTokenMs", "TokensPerSecond"]),
+    ("circuit breaker (worker thread + event loop)", run_circuit, ["CircuitState", "CircuitRejected"]),
+]
+
+
+def main_cli():
+    main.log_json = lambda **kwargs: None
+    main.LOGS_DIR = pathlib.Path(tempfile.mkdtemp(prefix="mc-vision-metrics-"))
+    ok = True
+    for label, scenario, expected in SCENARIOS:
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            scenario()
+            main.drain_metrics()
+        found = emitted_metrics(buf.getvalue())
+        missing = [name for name in expected if name not in found]
+        ok = ok and not missing
+        print(f"{'NG ' if missing else 'OK '} {label}: {', '.join(f'{n}={found[n]}' for n in expected if n in found)}"
+              + (f" missing={missing}" if missing else ""))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Check that concurrent identical analyses reach each upstream exactly once.
+
+Runs three scenarios against fake S3 / SageMaker / Bedrock clients that count
+their calls and block for --latency seconds:
+
+1. N concurrent POST /api/s3/analyze for the same s3_key
+   -> one S3 GetObject, one SageMaker invocation
+2. N concurrent POST /api/analyze/aws for the same request_id
+   -> one Bedrock invocation
+3. Two "instances" (separate _SingleFlight objects) sharing a DynamoDB lease
+   -> one upstream call
+
+Exits non-zero if any count differs.
+
+Usage:
+    python scripts/check_single_flight.py --concurrency 8 --latency 0.3
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import httpx
+from PIL import Image
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.n += 1
+
+
+def sample_jpeg() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (640, 480), (120, 80, 40)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+class FakeS3:
+    def __init__(self, data: bytes, latency: float):
+        self.data, self.latency, self.calls = data, latency, Counter()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.calls.hit()
+        time.sleep(self.latency)
+        return {"Body": io.BytesIO(self.data), "ContentLength": len(self.data)}
+
+
+class FakeSageMaker:
+    def __init__(self, latency: float):
+        self.latency, self.calls = latency, Counter()
+
+    def invoke_endpoint(self, **kwargs):
+        self.calls.hit()
+        time.sleep(self.latency)
+        return {"Body": io.BytesIO(json.dumps([[0.1, 0.7, 0.2]]).encode("utf-8"))}
+
+
+class FakeBedrockRuntime:
+    def __init__(self, latency: float):
+        self.latency, self.calls = latency, Counter()
+
+    def invoke_model(self, **kwargs):
+        self.calls.hit()
+        time.sleep(self.latency)
+        text = json.dumps({"caption": "テスト画像", "tags": ["テスト"]}, ensure_ascii=False)
+        body = json.dumps({"content": [{"type": "text", "text": text}], "stop_reason": "end_turn"}).encode("utf-8")
+        return {"body": io.BytesIO(body)}
+
+
+class ConditionalCheckFailed(Exception):
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+class FakeTable:
+    """
+    put_item の条件（attribute_not_exists OR expire_at < :now）だけを再現するテーブル。
+    write-behind の書き込み用に meta.client.batch_write_item も受け付ける。
+    """
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+        self.meta = types.SimpleNamespace(client=self)
+
+    def batch_write_item(self, RequestItems):
+        with self._lock:
+            for requests in RequestItems.values():
+                for req in requests:
+                    item = {k: main._deserializer.deserialize(v) for k, v in req["PutRequest"]["Item"].items()}
+                    self.items[item["request_id"]] = item
+        return {"UnprocessedItems": {}}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        with self._lock:
+            current = self.items.get(Item["request_id"])
+            if ConditionExpression and current and current["expire_at"] >= ExpressionAttributeValues[":now"]:
+                raise ConditionalCheckFailed()
+            self.items[Item["request_id"]] = dict(Item)
+
+    def get_item(self, Key, ConsistentRead=False):
+        with self._lock:
+            item = self.items.get(Key["request_id"])
+            return {"Item": dict(item)} if item else {}
+
+    def delete_item(self, Key):
+        with self._lock:
+            self.items.pop(Key["request_id"], None)
+
+
+def check(label: str, actual: int, expected: int) -> bool:
+    ok = actual == expected
+    print(f"{'OK ' if ok else 'NG '} {label}: {actual} call(s) (expected {expected})")
+    return ok
+
+
+async def run_http(concurrency: int, latency: float) -> bool:
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix="mc-vision-flight-"))
+    main.IMAGES_DIR = tmp / "images"
+    main.LOGS_DIR = tmp / "logs"
+    main.IMAGES_DIR.mkdir(parents=True)
+    data = sample_jpeg()
+    (main.IMAGES_DIR / "flight-test__sample.jpg").write_bytes(data)
+
+    fake_s3, fake_smr, fake_brt = FakeS3(data, latency), FakeSageMaker(latency), FakeBedrockRuntime(latency)
+    main.s3, main._smr_client, main._bedrock_rt = fake_s3, fake_smr, fake_brt
+    main.ddb = FakeTable()
+    main._result_cache = None
+    main.STEP_FUNCTION_ARN = ""
+    main.API_KEY_OPTIONAL = False
+    main.USE_REAL = True
+    os.environ.update({"USE_AZURE": "0", "USE_SAGEMAKER": "1", "USE_BEDROCK": "0", "SAGEMAKER_ENDPOINT_NAME": "flight-test"})
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://flight-test") as client:
+        s3_responses = await asyncio.gather(*[
+            client.post("/api/s3/analyze", json={"s3_key": "uploads/flight-test.jpg"}) for _ in range(concurrency)
+        ])
+        aws_responses = await asyncio.gather(*[
+            client.post("/api/analyze/aws", json={"request_id": "flight-test"}) for _ in range(concurrency)
+        ])
+
+    main._persistence.drain()
+    statuses = [r.status_code for r in s3_responses + aws_responses]
+    if any(code != 200 for code in statuses):
+        print(f"NG  unexpected status codes: {statuses}")
+        return False
+    return all([
+        check(f"S3 GetObject for {concurrency} x /api/s3/analyze", fake_s3.calls.n, 1),
+        check(f"SageMaker invoke for {concurrency} x /api/s3/analyze", fake_smr.calls.n, 1),
+        check(f"Bedrock invoke for {concurrency} x /api/analyze/aws", fake_brt.calls.n, 1),
+        check("failed write-behind writes", main._persistence.stats["failed"], 0),
+    ])
+
+
+def run_lease(concurrency: int, latency: float) -> bool:
+    table = FakeTable()
+    instances = [main._SingleFlight(f"instance-{i}", main._DynamoLease(table, 30, 0.05)) for i in range(2)]
+    upstream = Counter()
+
+    def infer():
+        upstream.hit()
+        time.sleep(latency)
+        return {"provider": "sagemaker", "raw": {"predicted_class_index": 1}}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda i=i: results.append(instances[i % 2].do("same-key", infer)))
+        for i in range(concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return all([
+        check(f"upstream for {concurrency} callers on 2 instances (DynamoDB lease)", upstream.n, 1),
+        check("callers that received the result", len(results), concurrency),
+    ])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Verify single-flight request coalescing.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent identical requests")
+    parser.add_argument("--latency", type=float, default=0.3, help="Simulated upstream latency in seconds")
+    args = parser.parse_args()
+
+    main._put_latency_metric = lambda **kwargs: None
+    ok = asyncio.run(run_http(args.concurrency, args.latency))
+    ok = run_lease(args.concurrency, args.latency) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
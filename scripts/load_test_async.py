@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Load test showing that concurrent /api/analyze/aws requests are no longer
+serialized on the event loop.
+
+Bedrock is replaced by a fake client that blocks for --latency seconds, and the
+new non-blocking endpoint is compared with the previous behaviour (blocking
+call_bedrock_real inside an async handler) using in-process ASGI requests.
+Every request uses its own request_id and image, so the numbers are not
+helped by single-flight coalescing or the result cache.
+
+Usage:
+    python scripts/load_test_async.py --concurrency 10 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+class FakeBedrockRuntime:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def invoke_model(self, **kwargs):
+        time.sleep(self.latency)
+        text = json.dumps({"caption": "テスト画像", "tags": ["テスト"]}, ensure_ascii=False)
+        body = json.dumps({"content": [{"type": "text", "text": text}], "stop_reason": "end_turn"}).encode("utf-8")
+        return {"body": io.BytesIO(body)}
+
+
+async def blocking_analyze_aws(req: main.AnalyzeRequest):
+    # 変更前の実装（async ハンドラ内でブロッキング呼び出し）
+    return main.call_bedrock_real(req.request_id)
+
+
+async def fire(client: httpx.AsyncClient, path: str, request_ids: list) -> float:
+    t0 = time.perf_counter()
+    responses = await asyncio.gather(*[
+        client.post(path, json={"request_id": request_id}) for request_id in request_ids
+    ])
+    elapsed = time.perf_counter() - t0
+    failed = [r.status_code for r in responses if r.status_code != 200]
+    if failed:
+        raise RuntimeError(f"{path} returned {failed}")
+    return elapsed
+
+
+async def run(concurrency: int, latency: float):
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix="mc-vision-load-"))
+    main.IMAGES_DIR = tmp / "images"
+    main.LOGS_DIR = tmp / "logs"
+    main.IMAGES_DIR.mkdir(parents=True)
+    # 実行ごと・リクエストごとに別の request_id と別内容の画像（同じ内容だと推論が集約・キャッシュされる）
+    request_ids = {}
+    for run_name in ("blocking", "non-blocking"):
+        request_ids[run_name] = [f"load-test-{run_name}-{i}" for i in range(concurrency)]
+        for i, request_id in enumerate(request_ids[run_name]):
+            color = (i * 7 % 256, 80 if run_name == "blocking" else 160, 40)
+            Image.new("RGB", (1280, 960), color).save(main.IMAGES_DIR / f"{request_id}__sample.jpg", format="JPEG")
+
+    main.USE_REAL = True
+    main._bedrock_rt = FakeBedrockRuntime(latency)
+    main._put_latency_metric = lambda **kwargs: None
+    main.app.add_api_route("/api/analyze/aws-blocking", blocking_analyze_aws, methods=["POST"])
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test") as client:
+        blocking = await fire(client, "/api/analyze/aws-blocking", request_ids["blocking"])
+        non_blocking = await fire(client, "/api/analyze/aws", request_ids["non-blocking"])
+
+    print(f"concurrency={concurrency}, provider latency={latency:.2f}s")
+    print(f"{'handler':<24} {'wall (s)':>9} {'x latency':>10}")
+    print(f"{'blocking (before)':<24} {blocking:>9.2f} {blocking / latency:>10.1f}")
+    print(f"{'non-blocking (after)':<24} {non_blocking:>9.2f} {non_blocking / latency:>10.1f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Concurrent request load test for async provider adapters.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent requests per run")
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated Bedrock latency in seconds")
+    args = parser.parse_args()
+    asyncio.run(run(args.concurrency, args.latency))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Cold-start profile for the FastAPI Lambda entry point (src/backend/main.py).
+
+Each run starts a fresh interpreter so nothing is cached in-process:
+
+1. import-time breakdown: `python -X importtime -c "import main"`, printing the
+   modules imported directly by main sorted by cumulative time
+2. time-to-first-response: import main, then invoke main.handler with an
+   API Gateway (HTTP API v2) event for GET /healthz, as the Lambda runtime does
+
+Prints the median over --runs and exits non-zero if the median import time
+exceeds --budget-ms. --preinit sets LAMBDA_PREINIT=1 to show the cost moved
+into the init phase by the pre-initialization hook.
+
+Usage:
+    python scripts/profile_cold_start.py --runs 5 --budget-ms 800
+    python scripts/profile_cold_start.py --preinit
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+
+BACKEND = pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"
+
+FIRST_RESPONSE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+event = {
+    "version": "2.0", "routeKey": "GET /healthz", "rawPath": "/healthz", "rawQueryString": "",
+    "headers": {"host": "localhost"}, "isBase64Encoded": False,
+    "requestContext": {"stage": "$default", "http": {"method": "GET", "path": "/healthz",
+                       "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1", "userAgent": "profile"}},
+}
+resp = main.handler(event, None)
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_response_ms": (t2 - t1) * 1000,
+    "status": resp["statusCode"],
+    "heavy_modules": [m for m in ("boto3", "botocore", "requests", "aws_embedded_metrics", "aiohttp", "numpy", "PIL.Image", "httpx") if m in sys.modules],
+}))
+"""
+
+
+def child_env(preinit: bool) -> dict:
+    env = dict(os.environ, USE_REAL="0", LAMBDA_PREINIT="1" if preinit else "0", AWS_LAMBDA_FUNCTION_NAME="profile-cold-start")
+    env.setdefault("AWS_REGION", "ap-northeast-1")
+    return env
+
+
+def import_breakdown(env: dict, top: int):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=BACKEND, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        prefix, cum_us, name = line.split("|", 2)
+        try:
+            self_us, cum_us = int(prefix.split(":")[-1]), int(cum_us)
+        except ValueError:
+            continue  # ヘッダー行
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((depth, name.strip(), self_us, cum_us))
+    main_row = next(r for r in rows if r[1] == "main")
+    # importtime は子を親より先に出力するため、main の直前までの depth+1 の行が main の直接の import
+    main_idx = rows.index(main_row)
+    children = [r for r in rows[:main_idx] if r[0] == main_row[0] + 1]
+    return main_row, sorted(children, key=lambda r: -r[3])[:top]
+
+
+def first_response(env: dict) -> dict:
+    proc = subprocess.run([sys.executable, "-c", FIRST_RESPONSE], cwd=BACKEND, env=env,
+                          capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Profile cold-start import time and time-to-first-response.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=15, help="Modules to show in the import breakdown")
+    parser.add_argument("--budget-ms", type=float, default=0, help="Fail if median import time exceeds this (0: no check)")
+    parser.add_argument("--preinit", action="store_true", help="Run with LAMBDA_PREINIT=1")
+    args = parser.parse_args()
+
+    env = child_env(args.preinit)
+    main_row, children = import_breakdown(env, args.top)
+    print(f"import main: {main_row[3] / 1000:.1f} ms cumulative, {main_row[2] / 1000:.1f} ms in main itself")
+    print(f"{'module':<36} {'cumulative (ms)':>16}")
+    for _, name, _, cum_us in children:
+        print(f"{name:<36} {cum_us / 1000:>16.1f}")
+
+    samples = [first_response(env) for _ in range(args.runs)]
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    first_ms = statistics.median(s["first_response_ms"] for s in samples)
+    print()
+    print(f"runs={args.runs} preinit={args.preinit}")
+    print(f"{'median import (ms)':<28} {import_ms:>8.1f}")
+    print(f"{'median first /healthz (ms)':<28} {first_ms:>8.1f}")
+    print(f"{'time to first response (ms)':<28} {import_ms + first_ms:>8.1f}")
+    print(f"status={samples[-1]['status']} heavy modules loaded: {', '.join(samples[-1]['heavy_modules']) or 'none'}")
+
+    if args.budget_ms and import_ms > args.budget_ms:
+        print(f"import time {import_ms:.1f} ms exceeds budget {args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
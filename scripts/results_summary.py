@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Summarize the rotated result logs (results/logs/poc_results-*.csv.gz).
+
+Streams every file row by row and prints per-provider request count, cost and
+latency percentiles.
+
+Usage:
+    python scripts/results_summary.py --since 2026-10-01T00:00:00
+    python scripts/results_summary.py --logs-dir /path/to/logs --json
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "backend"))
+import main  # noqa: E402
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Latency percentiles and cost per provider from result logs.")
+    parser.add_argument("--since", default=None, help="Only rows at or after this ISO8601 time (UTC if no offset)")
+    parser.add_argument("--logs-dir", default=None, help="Directory with poc_results-*.csv.gz (default: results/logs)")
+    parser.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+    args = parser.parse_args()
+
+    if args.logs_dir:
+        main.LOGS_DIR = pathlib.Path(args.logs_dir)
+    summary = main._summarize_results(args.since)
+
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return
+    print(f"{'provider':<12} {'count':>8} {'cost usd':>12} {'usd/req':>10} {'p50':>7} {'p90':>7} {'p95':>7} {'p99':>7}")
+    for provider, s in sorted(summary.items()):
+        lat = s["latency_ms"]
+        print(f"{provider:<12} {s['count']:>8} {s['cost_usd']:>12.4f} {s['cost_per_request_usd']:>10.6f} "
+              + " ".join(f"{lat[k] if lat[k] is not None else '-':>7}" for k in ("p50", "p90", "p95", "p99")))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,18 +1,20 @@
-import os, uuid, time, json, csv, pathlib, base64, io, logging
-from datetime import datetime
+import time
+_IMPORT_T0 = time.perf_counter()  # コールドスタート計測（/api/debug/startup）
+import os, sys, uuid, json, csv, gzip, pathlib, base64, io, logging, hashlib, threading, asyncio, functools, atexit, sqlite3, importlib
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as futures_wait
+from datetime import datetime, timezone
+from decimal import Decimal
 from typing import Dict, List, Optional
-from PIL import Image
-import requests
-import boto3
 from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, status, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from botocore.client import Config
-from requests import Session, RequestException
-import numpy as np
-from aws_embedded_metrics import metric_scope
 from mangum import Mangum
+# boto3 / botocore・requests・aws_embedded_metrics、numpy・PIL・httpx（と numpy を使う postprocess）は
+# コールドスタートを軽くするため初回利用時に import する（後者は _LazyInit のモジュールプロキシ np / Image / httpx）
 
 # ==== パス設定 ====
 BASE = pathlib.Path(__file__).resolve().parents[2]
@@ -22,8 +24,10 @@ LOGS_DIR = RESULTS_DIR / "logs"
 CONFIGS_DIR = BASE / "configs"
 
 # ==== 環境変数 ====
-load_dotenv(CONFIGS_DIR / ".env")  # configs/.env を読む
-load_dotenv()
+# configs/.env を読む（無ければカレントから上位へ .env を探す）。Lambda では関数の環境変数を使うので読まない
+if not os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    _dotenv_path = CONFIGS_DIR / ".env"
+    load_dotenv(_dotenv_path if _dotenv_path.is_file() else None)
 USE_REAL = os.getenv("USE_REAL", "0") == "1"
 
 # ==== Runtime settings (env with sane defaults) ====
@@ -32,10 +36,95 @@ REQUEST_TIMEOUT_TOTAL   = int(os.getenv("REQUEST_TIMEOUT_TOTAL", "30"))
 AZURE_MAX_RETRIES       = int(os.getenv("AZURE_MAX_RETRIES", "3"))
 AZURE_RETRY_BASE_SEC    = float(os.getenv("AZURE_RETRY_BASE_SEC", "1.0"))
 S3_PRESIGN_EXPIRE_SEC   = int(os.getenv("S3_PRESIGN_EXPIRE_SEC", "300"))
+S3_PRESIGN_BATCH_MAX    = int(os.getenv("S3_PRESIGN_BATCH_MAX", "50"))  # /api/s3/presign/batch の1回あたり上限
+# S3 転送: レンジ指定 GET のパートサイズ / 並列数（パートサイズ以下のオブジェクトは1回の GET）
+S3_TRANSFER_PART_BYTES  = int(os.getenv("S3_TRANSFER_PART_BYTES", str(8 * 1024 * 1024)))
+S3_TRANSFER_THREADS     = int(os.getenv("S3_TRANSFER_THREADS", "8"))
+S3_FETCH_WORKERS        = int(os.getenv("S3_FETCH_WORKERS", "8"))  # バッチ解析でオブジェクトを並列取得する数
+S3_READ_MAX_BYTES       = int(os.getenv("S3_READ_MAX_BYTES", str(64 * 1024 * 1024)))  # 読み込むオブジェクトの上限（超えたら 413）
+# 署名付きマルチパートアップロードのパートサイズ（S3 の下限は 5MiB、パート数の上限は 10000）
+S3_MULTIPART_PART_BYTES = max(int(os.getenv("S3_MULTIPART_PART_BYTES", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+S3_MULTIPART_MAX_PARTS  = 10000
+AZURE_HTTP_POOL_SIZE    = int(os.getenv("AZURE_HTTP_POOL_SIZE", "10"))
+AZURE_HTTP_KEEPALIVE_SEC = float(os.getenv("AZURE_HTTP_KEEPALIVE_SEC", "60"))
 
 API_KEY_OPTIONAL        = os.getenv("API_KEY_OPTIONAL", "1") == "1"
 API_KEY_VALUE           = os.getenv("API_KEY_VALUE", "")
 MAX_IMAGE_BYTES         = int(os.getenv("MAX_IMAGE_BYTES", str(2*1024*1024)))
+# /api/upload のストリーミング保存（読み込み単位 / 画像ヘッダー判定に使う先頭バイト数の上限）
+UPLOAD_CHUNK_BYTES      = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+UPLOAD_SNIFF_BYTES      = int(os.getenv("UPLOAD_SNIFF_BYTES", str(256 * 1024)))
+# ローカル画像（results/images）の request_id → ファイル名インデックス
+# sqlite: results/images.index.sqlite3 に永続化（プロセス間で共有）/ memory: 起動時にディレクトリを1回走査
+IMAGE_INDEX_BACKEND     = os.getenv("IMAGE_INDEX_BACKEND", "sqlite").lower()
+IMAGE_INDEX_REBUILD     = os.getenv("IMAGE_INDEX_REBUILD", "0") == "1"  # 起動時にディレクトリから作り直す
+IMAGES_MAX_FILES        = int(os.getenv("IMAGES_MAX_FILES", "0"))  # 超えたら古い順に削除（0 は無制限）
+SAGEMAKER_PAYLOAD_MODE  = os.getenv("SAGEMAKER_PAYLOAD_MODE", "json").lower()  # json | npy | float32 | float16 | uint8
+
+# プロバイダー並列実行（parallel | sequential）
+ANALYZE_FANOUT_MODE     = os.getenv("ANALYZE_FANOUT_MODE", "parallel").lower()
+PROVIDER_MAX_WORKERS    = int(os.getenv("PROVIDER_MAX_WORKERS", "8"))
+CPU_POOL_WORKERS        = int(os.getenv("CPU_POOL_WORKERS", str(os.cpu_count() or 2)))
+PROVIDER_DEADLINE_SEC   = {
+    "azure": float(os.getenv("AZURE_DEADLINE_SEC", "60")),
+    "sagemaker": float(os.getenv("SAGEMAKER_DEADLINE_SEC", "60")),
+    "bedrock": float(os.getenv("BEDROCK_DEADLINE_SEC", "60")),
+}
+
+# 結果キャッシュ（none | memory | dynamodb | tiered）
+RESULT_CACHE_BACKEND    = os.getenv("RESULT_CACHE_BACKEND", "memory").lower()
+RESULT_CACHE_TTL_SEC    = int(os.getenv("RESULT_CACHE_TTL_SEC", "3600"))
+RESULT_CACHE_MAX_ITEMS  = int(os.getenv("RESULT_CACHE_MAX_ITEMS", "512"))
+RESULT_CACHE_MAX_BYTES  = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64*1024*1024)))
+
+# 結果の書き込み（DynamoDB / CSV）をリクエスト外でまとめて行う
+PERSIST_WRITE_BEHIND    = os.getenv("PERSIST_WRITE_BEHIND", "1") == "1"
+PERSIST_BATCH_SIZE      = int(os.getenv("PERSIST_BATCH_SIZE", "25"))          # batch_write_item の上限も25件
+PERSIST_FLUSH_INTERVAL_SEC = float(os.getenv("PERSIST_FLUSH_INTERVAL_SEC", "1.0"))
+PERSIST_MAX_RETRIES     = int(os.getenv("PERSIST_MAX_RETRIES", "5"))          # UnprocessedItems の再送回数
+PERSIST_RETRY_BASE_SEC  = float(os.getenv("PERSIST_RETRY_BASE_SEC", "0.1"))
+# 結果ログ（固定スキーマの gzip CSV、サイズか経過時間でローテーション）
+RESULTS_ROTATE_BYTES    = int(os.getenv("RESULTS_ROTATE_BYTES", str(8*1024*1024)))
+RESULTS_ROTATE_SEC      = int(os.getenv("RESULTS_ROTATE_SEC", "3600"))
+# DynamoDB の結果アイテム（compact: 要約のみ inline + 生データは gzip / 大きければ S3、full: 従来どおり全量）
+RESULT_STORE_MODE       = os.getenv("RESULT_STORE_MODE", "compact").lower()
+RESULT_TOP_K            = int(os.getenv("RESULT_TOP_K", "5"))
+RESULT_INLINE_RAW_MAX_BYTES = int(os.getenv("RESULT_INLINE_RAW_MAX_BYTES", str(64*1024)))  # 圧縮後サイズ
+RESULT_RAW_S3_PREFIX    = os.getenv("RESULT_RAW_S3_PREFIX", "raw-results/")
+
+# 同一リクエストの集約（memory | dynamodb）。dynamodb はテーブルのリースでインスタンス間も1回にまとめる
+SINGLEFLIGHT_BACKEND    = os.getenv("SINGLEFLIGHT_BACKEND", "memory").lower()
+SINGLEFLIGHT_LEASE_SEC  = int(os.getenv("SINGLEFLIGHT_LEASE_SEC", "60"))
+SINGLEFLIGHT_POLL_SEC   = float(os.getenv("SINGLEFLIGHT_POLL_SEC", "0.2"))
+
+# クライアント側レート制限（プロバイダー/デプロイメント単位、0 は無制限）
+PROVIDER_RATE_LIMITS    = {
+    "azure": {
+        "rpm": int(os.getenv("AZURE_RPM", "0")),
+        "tpm": int(os.getenv("AZURE_TPM", "0")),
+        "max_inflight": int(os.getenv("AZURE_MAX_INFLIGHT", "0")),
+    },
+    "bedrock": {
+        "rpm": int(os.getenv("BEDROCK_RPM", "0")),
+        "tpm": int(os.getenv("BEDROCK_TPM", "0")),
+        "max_inflight": int(os.getenv("BEDROCK_MAX_INFLIGHT", "0")),
+    },
+    "sagemaker": {
+        "rpm": int(os.getenv("SAGEMAKER_RPM", "0")),
+        "tpm": 0,
+        "max_inflight": int(os.getenv("SAGEMAKER_MAX_INFLIGHT", "0")),
+    },
+}
+RATE_LIMIT_BACKEND      = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()  # memory | dynamodb
+RATE_LIMIT_MAX_WAIT_SEC = float(os.getenv("RATE_LIMIT_MAX_WAIT_SEC", "10"))
+RATE_LIMIT_IMAGE_TOKENS = int(os.getenv("RATE_LIMIT_IMAGE_TOKENS", "800"))  # 画像1枚あたりの入力トークン見積もり
+
+# サーキットブレーカー（プロバイダー単位）
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "1") == "1"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))      # 連続失敗でopen
+CIRCUIT_OPEN_SEC        = float(os.getenv("CIRCUIT_OPEN_SEC", "30"))              # open を維持する秒数
+CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_MAX_CALLS", "1"))  # half-open で同時に試す件数
+CIRCUIT_SUCCESS_THRESHOLD = int(os.getenv("CIRCUIT_SUCCESS_THRESHOLD", "1"))      # half-open → closed に必要な成功数
 
 # Azure
 AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "").rstrip("/")
@@ -58,16 +147,107 @@ ALERT_SNS_TOPIC_ARN = os.getenv("ALERT_SNS_TOPIC_ARN", "")
 # ルーティング設定
 MODEL_PRESET_COST = os.getenv("MODEL_PRESET_COST", "azure:gpt-4o-mini")
 MODEL_PRESET_QUALITY = os.getenv("MODEL_PRESET_QUALITY", "aws:anthropic.claude-3-haiku-20240307-v1:0")
+ROUTER_WINDOW_SIZE = int(os.getenv("ROUTER_WINDOW_SIZE", "100"))
+ROUTER_WINDOW_SEC = int(os.getenv("ROUTER_WINDOW_SEC", "300"))
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_MAX_THROTTLE_RATE = float(os.getenv("ROUTER_MAX_THROTTLE_RATE", "0.3"))
+# ヘッジ（一定時間応答がなければ別プロバイダーにも投げ、先に返った方を採用）
+ROUTE_HEDGE_ENABLED = os.getenv("ROUTE_HEDGE_ENABLED", "0") == "1"
+ROUTE_HEDGE_PERCENTILE = float(os.getenv("ROUTE_HEDGE_PERCENTILE", "95"))
+ROUTE_HEDGE_DELAY_MS = int(os.getenv("ROUTE_HEDGE_DELAY_MS", "3000"))       # サンプル不足時の既定値
+ROUTE_HEDGE_MIN_DELAY_MS = int(os.getenv("ROUTE_HEDGE_MIN_DELAY_MS", "200"))
+ROUTE_HEDGE_BUDGET_RATIO = float(os.getenv("ROUTE_HEDGE_BUDGET_RATIO", "0.1"))  # リクエストあたりに貯まるヘッジ枠
+ROUTE_HEDGE_BUDGET_MAX = float(os.getenv("ROUTE_HEDGE_BUDGET_MAX", "10"))
 
 # Guardrails / Pipeline
 USE_GUARDRAILS = os.getenv("USE_GUARDRAILS", "0") in ("1", "true", "TRUE", "True")
 BEDROCK_GUARDRAIL_ID = os.getenv("BEDROCK_GUARDRAIL_ID", "")
 BEDROCK_GUARDRAIL_VERSION = os.getenv("BEDROCK_GUARDRAIL_VERSION", "")
 PIPELINE_TTL_SECONDS = int(os.getenv("PIPELINE_TTL_SECONDS", str(24 * 3600)))
+PIPELINE_ARTIFACT_PREFIX = os.getenv("PIPELINE_ARTIFACT_PREFIX", "derived/")
+PIPELINE_ARTIFACT_CACHE_ITEMS = int(os.getenv("PIPELINE_ARTIFACT_CACHE_ITEMS", "16"))
+LLM_IMAGE_MAX_SIDE = int(os.getenv("LLM_IMAGE_MAX_SIDE", "512"))
+LLM_IMAGE_JPEG_QUALITY = int(os.getenv("LLM_IMAGE_JPEG_QUALITY", "80"))
+
+# 一括解析ジョブ
+BULK_JOB_MAX_KEYS = int(os.getenv("BULK_JOB_MAX_KEYS", "10000"))
+BULK_JOB_CHUNK_SIZE = int(os.getenv("BULK_JOB_CHUNK_SIZE", "100"))    # 結果の書き込み・再開の単位
+BULK_JOB_WORKERS = int(os.getenv("BULK_JOB_WORKERS", "8"))            # 1ジョブで同時に処理する画像数
+BULK_JOB_MAX_RUNNING = int(os.getenv("BULK_JOB_MAX_RUNNING", "2"))    # ローカル実行時にプロセス内で同時実行するジョブ数
+BULK_JOB_PROVIDER_CONCURRENCY = {
+    "azure": int(os.getenv("AZURE_BULK_CONCURRENCY", "2")),
+    "sagemaker": int(os.getenv("SAGEMAKER_BULK_CONCURRENCY", "4")),
+    "bedrock": int(os.getenv("BEDROCK_BULK_CONCURRENCY", "2")),
+}
+BULK_JOB_STALE_SEC = int(os.getenv("BULK_JOB_STALE_SEC", "300"))      # 更新がこの秒数止まった実行中ジョブは中断扱い
+BULK_JOB_TTL_SEC = int(os.getenv("BULK_JOB_TTL_SEC", str(7 * 24 * 3600)))
+# ジョブの実行先 Lambda（既定: 自分自身）。InvocationType=Event で非同期起動し、API リクエストを処理した環境の外で実行する。
+# 空ならこのプロセスのスレッドで実行（Lambda 外のローカル開発用）
+BULK_JOB_FUNCTION_NAME = os.getenv("BULK_JOB_FUNCTION_NAME", os.getenv("AWS_LAMBDA_FUNCTION_NAME", ""))
+BULK_JOB_RESERVE_SEC = int(os.getenv("BULK_JOB_RESERVE_SEC", "10"))  # 残り時間が「1件の最長所要時間 + この秒数」を切ったら新しい画像を始めず次の起動に引き継ぐ
+
+# 起動前に初期化を済ませるか（auto: Provisioned Concurrency / SnapStart の初期化フェーズのみ、1: 常に、0: しない）
+LAMBDA_PREINIT = os.getenv("LAMBDA_PREINIT", "auto").lower()
+
+class _LazyInit:
+    """
+    初回の属性アクセスで factory() を呼んで実体を作るプロキシ。
+    boto3 のクライアント生成（サービス定義 JSON の読み込み）は1つ数十 ms かかるため、
+    /healthz などクライアントを使わない呼び出しのコールドスタートでは作らない。
+    """
+    _lock = threading.RLock()  # boto3 の既定セッション生成はスレッドセーフでないため全インスタンスで共有
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            with _LazyInit._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    @property
+    def initialized(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"<lazy {self._name}{'' if self._target is None else ' (initialized)'}>"
 
-s3  = boto3.client("s3", region_name=AWS_REGION, config=Config(signature_version="s3v4"))
-ddb = boto3.resource("dynamodb", region_name=AWS_REGION).Table(DDB_TABLE)
-sfn = boto3.client("stepfunctions", region_name=AWS_REGION)
+def _lazy_module(name: str) -> _LazyInit:
+    return _LazyInit(name, lambda: importlib.import_module(name))
+
+# 画像処理・推論前後の数値処理・非同期 HTTP を使わない呼び出し（/healthz など）では読み込まない（合計で約 120ms）
+np = _lazy_module("numpy")
+Image = _lazy_module("PIL.Image")
+httpx = _lazy_module("httpx")
+postprocess = _lazy_module("postprocess")
+
+def _boto3_client(service: str, **kwargs):
+    import boto3
+    with _LazyInit._lock:
+        return boto3.client(service, **kwargs)
+
+def _make_s3_client():
+    from botocore.client import Config
+    return _boto3_client("s3", region_name=AWS_REGION, config=Config(signature_version="s3v4"))
+
+def _make_ddb_table():
+    import boto3
+    with _LazyInit._lock:
+        return boto3.resource("dynamodb", region_name=AWS_REGION).Table(DDB_TABLE)
+
+s3  = _LazyInit("s3", _make_s3_client)
+ddb = _LazyInit("dynamodb", _make_ddb_table)
+sfn = _LazyInit("stepfunctions", lambda: _boto3_client("stepfunctions", region_name=AWS_REGION))
+lambda_client = _LazyInit("lambda", lambda: _boto3_client("lambda", region_name=AWS_REGION))
 
 # ==== SageMaker Runtime (遅延初期化) ====
 _smr_client = None
@@ -76,7 +256,9 @@ def _get_smr():
     global _smr_client
     if _smr_client is None:
         region = os.environ.get("AWS_REGION", "ap-northeast-1")
-        _smr_client = boto3.client("sagemaker-runtime", region_name=region)
+        with _LazyInit._lock:
+            if _smr_client is None:
+                _smr_client = _boto3_client("sagemaker-runtime", region_name=region)
     return _smr_client
 
 # ==== Bedrock Runtime (遅延初期化) ====
@@ -86,7 +268,9 @@ def _get_bedrock_rt():
     global _bedrock_rt
     if _bedrock_rt is None:
         region = os.environ.get("AWS_REGION", "ap-northeast-1")
-        _bedrock_rt = boto3.client("bedrock-runtime", region_name=region)
+        with _LazyInit._lock:
+            if _bedrock_rt is None:
+                _bedrock_rt = _boto3_client("bedrock-runtime", region_name=region)
     return _bedrock_rt
 
 print("USE_REAL =", USE_REAL)
@@ -107,6 +291,68 @@ def log_json(**kwargs):
     except Exception:
         logger.info(str(kwargs))
 
+def metric_scope(fn):
+    """
+    aws_embedded_metrics.metric_scope の代わり（同期関数用）。
+    - aws_embedded_metrics は import 時に aiohttp まで読み込むため、初回のメトリクス送信時に import する
+    - 本家の同期版は flush を asyncio.get_event_loop().run_until_complete で送るため、ループのないワーカースレッド
+      （write-behind・スレッドプール）と実行中のイベントループ上ではどちらも失敗する。送信は _flush_metrics で行う
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
+        metrics = create_metrics_logger()
+        try:
+            return fn(*args, metrics=metrics, **kwargs)
+        finally:
+            _flush_metrics(metrics)
+    return wrapper
+
+_metrics_executor = None
+_metrics_pending: set = set()
+_metrics_lock = threading.Lock()
+
+def _run_metrics_flush(metrics) -> None:
+    """使い捨てのイベントループで flush する（呼び出し元スレッドでループが動いていないこと）"""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(metrics.flush())
+    finally:
+        loop.close()
+
+def _flush_metrics(metrics) -> None:
+    """
+    ループのないスレッドではその場で送る。イベントループ上ではループを止めないよう専用スレッドに渡す
+    （Lambda では返却前に drain_metrics で送り切る）。
+    """
+    global _metrics_executor
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _run_metrics_flush(metrics)
+        return
+    with _metrics_lock:
+        if _metrics_executor is None:
+            _metrics_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+        future = _metrics_executor.submit(_run_metrics_flush, metrics)
+        _metrics_pending.add(future)
+    future.add_done_callback(_metric_flush_done)
+
+def _metric_flush_done(future) -> None:
+    with _metrics_lock:
+        _metrics_pending.discard(future)
+    if future.exception() is not None:
+        logger.debug("metric emit failed: %s", future.exception())
+
+def drain_metrics(timeout: float = 2.0) -> None:
+    """専用スレッドに渡したメトリクスの送信を待つ（Lambda の返却前・シャットダウン時）"""
+    with _metrics_lock:
+        pending = list(_metrics_pending)
+    if pending:
+        futures_wait(pending, timeout=timeout)
+
+atexit.register(drain_metrics)
+
 @metric_scope
 def _put_latency_metric(metrics, route_name: str, latency_ms: int, success_flag: bool):
     metrics.set_namespace("PoC/MissionControl")
@@ -114,6 +360,49 @@ def _put_latency_metric(metrics, route_name: str, latency_ms: int, success_flag:
     metrics.put_metric("LatencyMs", latency_ms, "Milliseconds")
     metrics.put_metric("Success", 1 if success_flag else 0, "Count")
 
+@metric_scope
+def _put_persist_metric(metrics, sink: str, queue_depth: int, flush_ms: int, items: int, failed: int):
+    metrics.set_namespace("PoC/MissionControl")
+    metrics.put_dimensions({"Sink": sink})
+    metrics.put_metric("PersistQueueDepth", queue_depth, "Count")
+    metrics.put_metric("PersistFlushMs", flush_ms, "Milliseconds")
+    metrics.put_metric("PersistItems", items, "Count")
+    metrics.put_metric("PersistFailed", failed, "Count")
+
+def _record_persist_flush(sink: str, queue_depth: int, start_time: float, items: int, failed: int) -> None:
+    try:
+        _put_persist_metric(sink=sink, queue_depth=queue_depth, flush_ms=int((time.time() - start_time) * 1000), items=items, failed=failed)
+    except Exception as exc:
+        logger.debug("metric emit failed: %s", exc)
+
+@metric_scope
+def _put_stream_metric(metrics, route_name: str, ttft_ms: int, tokens_per_sec: float):
+    metrics.set_namespace("PoC/MissionControl")
+    metrics.put_dimensions({"Route": route_name})
+    metrics.put_metric("TimeToFirstTokenMs", ttft_ms, "Milliseconds")
+    metrics.put_metric("TokensPerSecond", tokens_per_sec, "Count/Second")
+
+_CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+@metric_scope
+def _put_circuit_metric(metrics, provider: str, state: str, rejected: bool):
+    metrics.set_namespace("PoC/MissionControl")
+    metrics.put_dimensions({"Provider": provider})
+    metrics.put_metric("CircuitState", _CIRCUIT_STATE_VALUES[state], "None")
+    metrics.put_metric("CircuitRejected", 1 if rejected else 0, "Count")
+
+def _record_circuit_state(provider: str, state: str, rejected: bool = False) -> None:
+    try:
+        _put_circuit_metric(provider=provider, state=state, rejected=rejected)
+    except Exception as exc:
+        logger.debug("metric emit failed: %s", exc)
+
+def _record_stream_metrics(route_name: str, ttft_ms: int, tokens_per_sec: float) -> None:
+    try:
+        _put_stream_metric(route_name=route_name, ttft_ms=ttft_ms, tokens_per_sec=tokens_per_sec)
+    except Exception as exc:
+        logger.debug("metric emit failed: %s", exc)
+
 def _record_latency(route_name: str, start_time: float, success: bool) -> int:
     latency_ms = int((time.time() - start_time) * 1000)
     try:
@@ -141,7 +430,60 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-handler = Mangum(app)
+class _UploadSizeLimit:
+    """
+    /api/upload の本文を受信しながら数え、上限を超えたらその場で 413 にする（ASGI の receive を包む）。
+    Content-Length で超過が分かれば本文を読まずに返し、chunked 転送（Content-Length なし）や
+    申告より長い本文も、multipart の解析（SpooledTemporaryFile への書き出し）が上限を超えて進む前に打ち切る。
+    """
+
+    def __init__(self, app, path: str = "/api/upload"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        # multipart の境界・ヘッダー分の余裕を持たせる
+        limit = MAX_IMAGE_BYTES + 64 * 1024
+        detail = f"image too large: exceeds {MAX_IMAGE_BYTES} bytes"
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI は本文解析中の HTTPException をそのまま返す（400 に変換しない）
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(_UploadSizeLimit)
+
+# lifespan ハンドラは使っていないため、呼び出しごとの startup/shutdown のやり取りを省く
+_asgi_handler = Mangum(app, lifespan="off")
+
+def handler(event, context):
+    """
+    Lambda エントリポイント。応答を返す前に書き込みキューを流し切る（返却後は環境が凍結されるため）。
+    {"bulk_job": {"job_id": ...}} は一括解析ジョブの非同期起動（_dispatch_job）としてこの呼び出しの中で実行する。
+    """
+    try:
+        if isinstance(event, dict) and "bulk_job" in event:
+            remaining = (lambda: context.get_remaining_time_in_millis() / 1000) if context is not None else None
+            return _run_bulk_job(event["bulk_job"]["job_id"], remaining)
+        return _asgi_handler(event, context)
+    finally:
+        _persistence.drain()
+        drain_metrics()
 
 # ==== スキーマ ====
 class AnalyzeRequest(BaseModel):
@@ -163,6 +505,8 @@ class RouteRequest(BaseModel):
     request_id: str
     s3_uri: Optional[str] = None
     policy: str
+    latency_slo_ms: Optional[int] = None
+    hedge: Optional[bool] = None
 
 class RouteResponse(BaseModel):
     chosen: str
@@ -171,6 +515,38 @@ class RouteResponse(BaseModel):
 
 class S3AnalyzeReq(BaseModel):
     s3_key: str
+    refresh: bool = False
+
+class S3BatchAnalyzeReq(BaseModel):
+    s3_keys: List[str]
+
+class BulkJobRequest(BaseModel):
+    s3_keys: Optional[List[str]] = None
+    s3_prefix: Optional[str] = None
+    providers: Optional[List[str]] = None
+    refresh: bool = False
+
+class MultipartInitiateRequest(BaseModel):
+    content_type: str = "image/jpeg"
+    size: Optional[int] = None  # 指定すると全パートの署名付きURLをまとめて返す
+
+class MultipartPartUrlsRequest(BaseModel):
+    key: str
+    upload_id: str
+    part_numbers: List[int]
+
+class MultipartPart(BaseModel):
+    part_number: int
+    etag: str
+
+class MultipartCompleteRequest(BaseModel):
+    key: str
+    upload_id: str
+    parts: List[MultipartPart]
+
+class MultipartAbortRequest(BaseModel):
+    key: str
+    upload_id: str
 
 class PipelineStartRequest(BaseModel):
     request_id: str
@@ -187,24 +563,179 @@ class PipelineStatusResponse(BaseModel):
 
 # ==== Util ====
 def _log_csv(row: dict):
-    LOGS_DIR.mkdir(parents=True, exist_ok=True)
-    csv_path = LOGS_DIR / "poc_results.csv"
-    new_file = not csv_path.exists()
-    with open(csv_path, "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=list(row.keys()))
-        if new_file:
-            w.writeheader()
-        w.writerow(row)
+    """結果ログ1行を書き込みキューに積む（_results_sink がまとめて gzip CSV に書く）"""
+    _persistence.append_csv({"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), **row})
+
+def _sniff_image_header(head: bytes) -> Optional[tuple]:
+    """先頭バイト列だけで画像ヘッダーを読む（Image.open は遅延でピクセルはデコードしない）。判定できなければ None"""
+    try:
+        with Image.open(io.BytesIO(head)) as im:
+            return im.format, im.size[0], im.size[1]
+    except Exception:
+        return None
+
+def _stream_upload_to_disk(src, dest: pathlib.Path) -> dict:
+    """
+    アップロードを UPLOAD_CHUNK_BYTES ずつ dest に書き出す（メモリ使用量は一定）。
+    - 書きながら sha256 を計算し、先頭 UPLOAD_SNIFF_BYTES までに画像ヘッダーを判定できなければ 415
+    - MAX_IMAGE_BYTES を超えた時点で中断して 413（受信中の打ち切りは _UploadSizeLimit。ここは画像部分だけの厳密な上限）
+    途中で失敗した場合は書きかけのファイルを残さない。
+    """
+    part = dest.with_name(dest.name + ".part")
+    digest = hashlib.sha256()
+    size, head, header = 0, bytearray(), None
+    try:
+        with open(part, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise HTTPException(status_code=413, detail=f"image too large: exceeds {MAX_IMAGE_BYTES} bytes")
+                if header is None:
+                    head += chunk
+                    header = _sniff_image_header(bytes(head))
+                    if header is not None:
+                        head = bytearray()
+                    elif len(head) >= UPLOAD_SNIFF_BYTES:
+                        raise HTTPException(status_code=415, detail="unsupported media type: not an image")
+                digest.update(chunk)
+                out.write(chunk)
+        if header is None:
+            raise HTTPException(status_code=415, detail="unsupported media type: not an image")
+        os.replace(part, dest)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    fmt, width, height = header
+    return {"sha256": digest.hexdigest(), "bytes": size, "format": fmt, "width": width, "height": height}
+
+class _ImageIndex:
+    """
+    request_id → 画像ファイル名（"<request_id>__<file_name>"）のインデックス。
+    - 参照はメモリの dict → SQLite サイドカー（他プロセスのアップロード分）の順。見つからなければディレクトリは走査しない
+    - 初回利用時にサイドカーを読み込む。サイドカーが無い / IMAGE_INDEX_REBUILD=1 ならディレクトリを走査して作り直す
+      （索引外に置いたファイルは IMAGE_INDEX_REBUILD=1 で起動するか POST /api/debug/image-index/rebuild で取り込む）
+    - IMAGES_MAX_FILES を超えたら古い順にファイルとエントリを削除
+    """
+
+    def __init__(self, images_dir: pathlib.Path, backend: str = IMAGE_INDEX_BACKEND, max_files: int = IMAGES_MAX_FILES):
+        self.images_dir = images_dir
+        self.max_files = max_files
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if backend == "sqlite":
+            self._db = self._open_db(images_dir.parent / f"{images_dir.name}.index.sqlite3")
+        loaded = self._load() if self._db is not None and not IMAGE_INDEX_REBUILD else 0
+        if not loaded:
+            self.rebuild()
+
+    @staticmethod
+    def _open_db(path: pathlib.Path) -> Optional[sqlite3.Connection]:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(path), check_same_thread=False, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS images (request_id TEXT PRIMARY KEY, file_name TEXT NOT NULL, created_at REAL NOT NULL)")
+            return db
+        except sqlite3.Error as e:
+            log_json(stage="image_index", action="sidecar_unavailable", path=str(path), error=str(e))
+            return None
+
+    def _load(self) -> int:
+        rows = self._db.execute("SELECT request_id, file_name FROM images ORDER BY created_at").fetchall()
+        with self._lock:
+            self._entries = OrderedDict(rows)
+        return len(rows)
+
+    def rebuild(self) -> int:
+        """ディレクトリを1回走査してインデックス（とサイドカー）を作り直す"""
+        t0 = time.perf_counter()
+        found = []
+        if self.images_dir.is_dir():
+            with os.scandir(self.images_dir) as it:
+                for e in it:
+                    if "__" in e.name and e.is_file():
+                        found.append((e.stat().st_mtime, e.name.split("__", 1)[0], e.name))
+        found.sort()
+        with self._lock:
+            self._entries = OrderedDict((req_id, name) for _, req_id, name in found)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("BEGIN")
+                    self._db.execute("DELETE FROM images")
+                    self._db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", [(r, n, m) for m, r, n in found])
+        log_json(stage="image_index", action="rebuilt", entries=len(found), elapsed_ms=int((time.perf_counter() - t0) * 1000))
+        return len(found)
+
+    def add(self, req_id: str, file_name: str):
+        with self._lock:
+            self._entries[req_id] = file_name
+            self._entries.move_to_end(req_id)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", (req_id, file_name, time.time()))
+            evicted = []
+            while self.max_files and len(self._entries) > self.max_files:
+                evicted.append(self._entries.popitem(last=False))
+            if evicted and self._db is not None:
+                self._db.executemany("DELETE FROM images WHERE request_id = ?", [(r,) for r, _ in evicted])
+        for old_id, name in evicted:
+            (self.images_dir / name).unlink(missing_ok=True)
+            log_json(stage="image_index", action="evicted", request_id=old_id)
+
+    def remove(self, req_id: str):
+        with self._lock:
+            self._entries.pop(req_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM images WHERE request_id = ?", (req_id,))
+
+    def lookup(self, req_id: str) -> Optional[pathlib.Path]:
+        with self._lock:
+            name = self._entries.get(req_id)
+            if name is None and self._db is not None:
+                row = self._db.execute("SELECT file_name FROM images WHERE request_id = ?", (req_id,)).fetchone()
+                name = row[0] if row else None
+        if name is None:
+            return None
+        path = self.images_dir / name
+        if path.is_file():
+            return path
+        self.remove(req_id)  # 外部で削除された
+        return None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {"images_dir": str(self.images_dir), "entries": entries,
+                "sidecar": self._db is not None, "max_files": self.max_files}
+
+_image_index_lock = threading.Lock()
+_image_index_instance: Optional[_ImageIndex] = None
+
+def _image_index() -> _ImageIndex:
+    """初回利用時にインデックスを作る（IMAGES_DIR が差し替えられたら作り直す）"""
+    global _image_index_instance
+    with _image_index_lock:
+        if _image_index_instance is None or _image_index_instance.images_dir != IMAGES_DIR:
+            _image_index_instance = _ImageIndex(IMAGES_DIR)
+        return _image_index_instance
 
 def _find_image_path_by_request_id(req_id: str) -> pathlib.Path:
-    candidates = list(IMAGES_DIR.glob(f"{req_id}__*"))
-    if not candidates:
+    path = _image_index().lookup(req_id)
+    if path is None:
         raise FileNotFoundError(f"image not found for request_id={req_id}")
-    return candidates[0]
+    return path
 
-def _downscale_to_jpeg_b64(path: pathlib.Path, max_side: int = 512, quality: int = 80):
-    """画像を512px以内に縮小・JPEG再圧縮してbase64化"""
-    im = Image.open(path).convert("RGB")
+def _downscale_to_jpeg_b64(path: pathlib.Path, max_side: Optional[int] = None, quality: Optional[int] = None):
+    """画像を max_side（既定: LLM_IMAGE_MAX_SIDE）以内に縮小・JPEG再圧縮（既定: LLM_IMAGE_JPEG_QUALITY）してbase64化"""
+    prepared = PreparedImage(path.read_bytes(), llm_max_side=max_side, llm_quality=quality)
+    return prepared.llm_jpeg_b64, "image/jpeg"
+
+def _downscale_image_to_jpeg(im: "Image.Image", max_side: int = 512, quality: int = 80) -> bytes:
+    """PIL画像を max_side 以内に縮小して JPEG バイト列にする"""
+    im = im.convert("RGB")
     w, h = im.size
     if max(w, h) > max_side:
         if w >= h:
@@ -213,253 +744,1657 @@ def _downscale_to_jpeg_b64(path: pathlib.Path, max_side: int = 512, quality: int
         else:
             nw = int(w * (max_side / h))
             nh = max_side
-        im = im.resize((nw, nh))
+        im = im.resize((nw, nh), reducing_gap=2.0)
     buf = io.BytesIO()
     im.save(buf, format="JPEG", quality=quality, optimize=True)
-    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    return b64, "image/jpeg"
+    return buf.getvalue()
 
-# ==== モック応答 ====
-def _mock_result(provider: str, model: str) -> AnalyzeResponse:
-    return AnalyzeResponse(
-        provider=provider,
-        model=model,
-        caption="テーブルの上に寿司が並べられています。",
-        tags=["寿司", "テーブル", "食べ物"],
-        latency_ms=0,
-        tokens={"input": 50, "output": 30},
-        cost_estimate={"usd": 0.0, "method": "mock"},
-        raw={}
-    )
+class PreparedImage:
+    """
+    画像を1回だけデコードし、各プロバイダー向けの派生物を遅延生成・メモ化する。
+    - JPEG は Image.draft で必要サイズ以上を保つ最小スケールでデコード（DCT 段階で縮小）
+    - llm_jpeg / llm_jpeg_b64: Bedrock / Azure 向けの縮小 JPEG（LLM_IMAGE_MAX_SIDE、0 以下なら原本）
+    - sagemaker_tensor(): SageMaker 向け 3x224x224 テンソル
+    複数スレッド（プロバイダー並列実行）から共有されるため生成はロックで直列化する。
+    """
 
-# ==== 実API: Azure (gpt-4o-mini) ====
-def call_azure_real(req_id: str) -> AnalyzeResponse:
-    img_path = _find_image_path_by_request_id(req_id)
-    b64, mime = _downscale_to_jpeg_b64(img_path)
+    def __init__(self, raw: bytes, llm_max_side: Optional[int] = None, llm_quality: Optional[int] = None):
+        self.raw = raw
+        self.llm_max_side = LLM_IMAGE_MAX_SIDE if llm_max_side is None else llm_max_side
+        self.llm_quality = LLM_IMAGE_JPEG_QUALITY if llm_quality is None else llm_quality
+        self._memo = {}
+        self._lock = threading.RLock()
 
-    system_prompt = (
-        "次の画像を説明してください。出力は必ず有効なJSONのみ、余計な文章は禁止。\n"
-        '{ "caption": "日本語で1〜2文、50文字以内", "tags": ["日本語の単語を最大5個"] }'
-    )
+    def _memoize(self, key, build):
+        with self._lock:
+            if key not in self._memo:
+                self._memo[key] = build()
+            return self._memo[key]
 
-    user_content = [
-        {"type": "text", "text": "画像を要約し、JSONのみで返してください。"},
-        {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}}
-    ]
+    @property
+    def sha256(self) -> str:
+        return self._memoize("sha256", lambda: hashlib.sha256(self.raw).hexdigest())
 
-    url = f"{AZURE_ENDPOINT}/openai/deployments/{AZURE_DEPLOY}/chat/completions?api-version={AZURE_API_VERSION}"
-    headers = {"api-key": AZURE_KEY, "Content-Type": "application/json"}
-    body = {
-        "messages": [
-            {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
-            {"role": "user", "content": user_content}
-        ],
-        "temperature": 0.2,
-        "max_tokens": 128  # 抑えめ
-    }
+    @property
+    def image(self) -> "Image.Image":
+        return self._memoize("image", self._decode)
 
-    t0 = time.time()
-    out = None
-    for attempt in range(3):
-        resp = requests.post(url, headers=headers, json=body, timeout=60)
-        if resp.status_code == 429:
-            ra = resp.headers.get("Retry-After")
-            wait = int(ra) if ra and ra.isdigit() else (2 * (attempt + 1))
-            print(f"[Azure 429] retry in {wait}s (attempt {attempt+1}/3)")
-            time.sleep(wait)
-            continue
-        if not resp.ok:
-            print("AZURE ERROR", resp.status_code, resp.text[:300])
-            resp.raise_for_status()
-        out = resp.json()
-        break
-    if out is None:
-        resp.raise_for_status()
+    def _decode(self) -> "Image.Image":
+        im = Image.open(io.BytesIO(self.raw))
+        self._memo["format"] = im.format
+        if im.format == "JPEG":
+            target = max(SAGEMAKER_INPUT_SIZE, self.llm_max_side)
+            im.draft("RGB", (target, target))
+        return im.convert("RGB")
 
-    content = out["choices"][0]["message"]["content"]
-    if isinstance(content, list):
-        text = "".join([c.get("text", "") for c in content if isinstance(c, dict)])
-    else:
-        text = content or ""
+    @property
+    def llm_jpeg(self) -> bytes:
+        return self._memoize("llm_jpeg", self._build_llm_jpeg)
 
-    try:
-        payload = json.loads(text)
-    except Exception:
-        s, e = text.find("{"), text.rfind("}")
-        payload = json.loads(text[s:e + 1])
+    def _build_llm_jpeg(self) -> bytes:
+        if self.llm_max_side <= 0:
+            return self.raw
+        im = self.image
+        # 既に上限内の JPEG は再圧縮しない（前処理アーティファクトなど）
+        if self._memo.get("format") == "JPEG" and max(im.size) <= self.llm_max_side:
+            return self.raw
+        return _downscale_image_to_jpeg(im, max_side=self.llm_max_side, quality=self.llm_quality)
 
-    latency = int((time.time() - t0) * 1000)
-    return AnalyzeResponse(
-        provider="azure",
-        model="gpt-4o-mini",
-        caption=str(payload.get("caption", "")),
-        tags=list(payload.get("tags", [])),
-        latency_ms=latency,
-        tokens={"input": 0, "output": 0},
-        cost_estimate={"usd": 0.0, "method": "token_based"},
-        raw=out,
-    )
+    @property
+    def llm_jpeg_b64(self) -> str:
+        return self._memoize("llm_jpeg_b64", lambda: base64.b64encode(self.llm_jpeg).decode("utf-8"))
 
-# ==== Azure呼び出し：指数バックオフ＋タイムアウト ====
-def _build_azure_payload(img_bytes: bytes, user_prompt: str) -> dict:
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-    return {
-        "messages": [
-            {"role":"system","content":[{"type":"text","text":"You are a helpful vision assistant. Describe the image briefly and output 3 tags."}]},
-            {"role":"user","content":[
-                {"type":"text","text": user_prompt},
-                {"type":"image_url","image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-            ]}
-        ],
-        "max_tokens": 128
-    }
+    def sagemaker_tensor(self, normalize: bool = True) -> "np.ndarray":
+        return self._memoize(("sagemaker_tensor", normalize), lambda: _sagemaker_tensor_from_image(self.image, normalize=normalize))
 
-def azure_chat_completion_with_retry(endpoint: str, deployment: str, api_version: str, api_key: str, img_bytes: bytes, user_prompt: str) -> dict:
-    url = f"{endpoint}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
-    payload = _build_azure_payload(img_bytes, user_prompt)
-    headers = {"api-key": api_key, "Content-Type":"application/json"}
+    def cache_params(self) -> dict:
+        """結果キャッシュのキーに含める派生物の設定"""
+        return {"llm_max_side": self.llm_max_side, "llm_quality": self.llm_quality}
 
-    session = Session()
-    for attempt in range(1, AZURE_MAX_RETRIES+1):
-        t0 = time.time()
-        try:
-            resp = session.post(
-                url, headers=headers, json=payload,
-                timeout=(REQUEST_TIMEOUT_CONNECT, REQUEST_TIMEOUT_TOTAL)
-            )
-            if resp.status_code in (429, 500, 502, 503, 504):
-                # リトライ系
-                retry_after = resp.headers.get("retry-after")
-                wait = float(retry_after) if retry_after else (AZURE_RETRY_BASE_SEC * (2 ** (attempt-1)))
-                log_json(stage="azure_call", status="retry", attempt=attempt, code=resp.status_code, wait_sec=wait)
-                time.sleep(wait)
-                continue
-            resp.raise_for_status()
-            rt = round((time.time()-t0)*1000)
-            log_json(stage="azure_call", status="ok", code=resp.status_code, rt_ms=rt)
-            return resp.json()
-        except RequestException as e:
-            # 接続/タイムアウトもリトライ対象
-            wait = AZURE_RETRY_BASE_SEC * (2 ** (attempt-1))
-            log_json(stage="azure_call", status="exception", attempt=attempt, error=str(e), wait_sec=wait)
-            if attempt < AZURE_MAX_RETRIES:
-                time.sleep(wait)
-            else:
-                raise
-    raise RuntimeError("Azure call exhausted retries")
+def _as_prepared(img) -> PreparedImage:
+    return img if isinstance(img, PreparedImage) else PreparedImage(img)
 
-def call_azure_from_bytes(img_bytes: bytes) -> dict:
-    endpoint = os.environ["AZURE_OPENAI_ENDPOINT"].rstrip("/")
-    deployment = os.environ["AZURE_OPENAI_DEPLOYMENT_MINI"]
-    api_ver = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-10-21")
-    api_key = os.environ["AZURE_OPENAI_API_KEY"]
+# ==== 書き込みキュー（DynamoDB / CSV の write-behind） ====
+def _make_type_serializer():
+    from boto3.dynamodb.types import TypeSerializer
+    return TypeSerializer()
 
-    # 画像サイズバリデーション（過大入力抑止）
-    if len(img_bytes) > MAX_IMAGE_BYTES:
-        raise HTTPException(status_code=413, detail=f"image too large: {len(img_bytes)} bytes (limit {MAX_IMAGE_BYTES})")
+_serializer = _LazyInit("TypeSerializer", _make_type_serializer)
 
-    return azure_chat_completion_with_retry(
-        endpoint=endpoint,
-        deployment=deployment,
-        api_version=api_ver,
-        api_key=api_key,
-        img_bytes=img_bytes,
-        user_prompt="この画像の内容を短く説明し、日本語で3つのタグを箇条書きで出力して下さい。"
-    )
+def _to_dynamo(value):
+    """float を Decimal に変換（DynamoDB は float を受け付けない）。bytes（Binary 属性）はそのまま"""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamo(v) for v in value]
+    return value
 
-# ==== SageMaker呼び出し ====
-def _prepare_sagemaker_payload(img_bytes: bytes) -> bytes:
-    """画像を前処理して SageMaker に渡す JSON バイト列を作成"""
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    img = img.resize((224, 224))
-    img_array = np.array(img, dtype=np.float32)
-    img_array = img_array.transpose(2, 0, 1)
-    mean = np.array([0.485, 0.456, 0.406]).reshape(3, 1, 1)
-    std = np.array([0.229, 0.224, 0.225]).reshape(3, 1, 1)
-    img_array = (img_array / 255.0 - mean) / std
-    img_array = np.expand_dims(img_array, axis=0)
-    return json.dumps(img_array.tolist()).encode("utf-8")
-
-def call_sagemaker_from_bytes(img_bytes: bytes) -> dict:
-    """
-    SageMaker Serverless Endpoint に画像をJSON形式で投げ、分類結果(JSON)を返す。
+class _WriteBehind:
+    """
+    DynamoDB の put と CSV の追記をキューにため、バックグラウンドスレッドがまとめて書き込む。
+    - PERSIST_BATCH_SIZE 件たまるか PERSIST_FLUSH_INTERVAL_SEC 経過でフラッシュ
+    - DynamoDB は batch_write_item（25件ずつ）で、UnprocessedItems は指数バックオフで再送
+    - 結果アイテムの compact 化（gzip・大きい全量の S3 退避）もフラッシュ時に行い、リクエスト経路では行わない
+    - drain() は呼び出し元スレッドで同期的に流し切る（Lambda の返却前・シャットダウン時）
+    フラッシュごとにキュー深さ・所要時間を EMF で出力する。
     """
-    endpoint = os.environ["SAGEMAKER_ENDPOINT_NAME"]
-    payload = _prepare_sagemaker_payload(img_bytes)
 
-    smr = _get_smr()
-    resp = smr.invoke_endpoint(
-        EndpointName=endpoint,
-        ContentType="application/json",
-        Body=payload,
-    )
-    body = resp["Body"].read()
-    try:
-        txt = body.decode("utf-8", errors="ignore")
-        data = json.loads(txt)
-        
-        # 最も高いスコアのクラスを取得
-        if isinstance(data, list) and len(data) > 0:
-            scores = data[0]
-            max_idx = int(np.argmax(scores))
-            max_score = float(max(scores))
-            
-            result = {
-                "predicted_class_index": max_idx,
-                "confidence_score": max_score,
-                "top_5_indices": [int(i) for i in np.argsort(scores)[-5:][::-1]],
-                "all_scores": data
-            }
-        else:
-            result = {"raw": data}
-            
-    except Exception as e:
-        result = {"raw": body.decode("utf-8", errors="ignore"), "error": str(e)}
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._items: List[dict] = []
+        self._rows: List[dict] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.stats = {"enqueued": 0, "written": 0, "failed": 0, "flushes": 0}
 
-    return {
-        "provider": "sagemaker",
-        "endpoint": endpoint,
-        "raw": result,
-    }
+    def put_item(self, item: dict) -> None:
+        if not self.enabled:
+            self._flush_dynamo([item], 1)
+            return
+        self._enqueue(self._items, item)
 
-def _guardrail_kwargs() -> Dict[str, str]:
-    if USE_GUARDRAILS and BEDROCK_GUARDRAIL_ID and BEDROCK_GUARDRAIL_VERSION:
-        return {
-            "guardrailIdentifier": BEDROCK_GUARDRAIL_ID,
-            "guardrailVersion": BEDROCK_GUARDRAIL_VERSION
-        }
-    return {}
+    def append_csv(self, row: dict) -> None:
+        if not self.enabled:
+            self._flush_csv([row], 1)
+            return
+        self._enqueue(self._rows, row)
 
-# ==== Bedrock呼び出し ====
-def _build_bedrock_payload(img_bytes: bytes, media_type: str = "image/jpeg") -> dict:
-    """Step Functions用に Bedrock メッセージボディを生成"""
-    b64 = base64.b64encode(img_bytes).decode("utf-8")
-    return {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 512,
-        "temperature": 0.2,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": b64
-                        }
-                    },
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._items) + len(self._rows)
+
+    def _enqueue(self, buffer: list, entry: dict) -> None:
+        with self._cond:
+            buffer.append(entry)
+            self.stats["enqueued"] += 1
+            if len(self._items) + len(self._rows) >= PERSIST_BATCH_SIZE:
+                self._cond.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._items) + len(self._rows) >= PERSIST_BATCH_SIZE, timeout=PERSIST_FLUSH_INTERVAL_SEC)
+            try:
+                self.drain()
+            except Exception as exc:
+                log_json(stage="persist", action="flush_failed", error=str(exc))
+
+    def drain(self) -> None:
+        with self._flush_lock:
+            with self._cond:
+                items, self._items = self._items, []
+                rows, self._rows = self._rows, []
+            depth = len(items) + len(rows)
+            if items:
+                self._flush_dynamo(items, depth)
+            if rows:
+                self._flush_csv(rows, depth)
+
+    def _flush_dynamo(self, items: List[dict], depth: int) -> None:
+        t0 = time.time()
+        # 同じキーが1バッチに2つあると batch_write_item 全体が失敗するため、後勝ちでまとめる
+        latest = {item["request_id"]: item for item in items}
+        requests, failed = [], 0
+        for item in latest.values():
+            try:
+                # S3 に全量を置く場合は、その put が済んでから DynamoDB に参照を書く
+                item = _compact_result_item(item)
+                requests.append({"PutRequest": {"Item": {k: _serializer.serialize(v) for k, v in _to_dynamo(item).items()}}})
+            except Exception as exc:
+                failed += 1
+                log_json(stage="persist", action="serialize_failed", request_id=item.get("request_id"), error=str(exc))
+        for i in range(0, len(requests), 25):
+            failed += self._write_batch(requests[i:i + 25])
+        self.stats["flushes"] += 1
+        self.stats["written"] += len(latest) - failed
+        self.stats["failed"] += failed
+        _record_persist_flush("dynamodb", depth, t0, len(items), failed)
+
+    def _write_batch(self, batch: List[dict]) -> int:
+        """1バッチを書き込み、最後まで書けなかった件数を返す"""
+        pending = {DDB_TABLE: batch}
+        for attempt in range(PERSIST_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(PERSIST_RETRY_BASE_SEC * (2 ** (attempt - 1)))
+            try:
+                resp = ddb.meta.client.batch_write_item(RequestItems=pending)
+            except Exception as exc:
+                log_json(stage="persist", action="batch_write_failed", attempt=attempt, error=str(exc))
+                continue
+            pending = resp.get("UnprocessedItems") or {}
+            if not pending:
+                return 0
+        dropped = len(pending.get(DDB_TABLE, []))
+        log_json(stage="persist", action="dropped", count=dropped)
+        return dropped
+
+    def _flush_csv(self, rows: List[dict], depth: int) -> None:
+        t0 = time.time()
+        failed = 0
+        try:
+            _results_sink.write(rows)
+        except Exception as exc:
+            failed = len(rows)
+            log_json(stage="persist", action="csv_failed", error=str(exc))
+        _record_persist_flush("csv", depth, t0, len(rows), failed)
+
+    def snapshot(self) -> dict:
+        return {"enabled": self.enabled, "queue_depth": self.depth(), **self.stats}
+
+_persistence = _WriteBehind(PERSIST_WRITE_BEHIND)
+atexit.register(_persistence.drain)
+
+# ==== 結果アイテムの圧縮（要約 inline + 生データ gzip / S3） ====
+def _parse_caption_tags(text: str) -> dict:
+    """LLM の応答テキストから caption / tags を取り出す（JSON 優先、なければ箇条書きをタグとみなす）"""
+    text = (text or "").strip()
+    s, e = text.find("{"), text.rfind("}")
+    if s != -1 and e > s:
+        try:
+            payload = json.loads(text[s:e + 1])
+            return {"caption": str(payload.get("caption", "")), "tags": [str(t) for t in payload.get("tags", [])][:10]}
+        except Exception:
+            pass
+    caption_lines, tags = [], []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] in "-*・•#" or (line[0].isdigit() and line[1:3].strip(" ") in (".", ")")):
+            tags.append(line.lstrip("-*・•#0123456789.) ").strip())
+        else:
+            caption_lines.append(line)
+    return {"caption": " ".join(caption_lines)[:200], "tags": [t for t in tags if t][:10]}
+
+def _compact_provider_result(entry: dict) -> dict:
+    """_run_providers の1件を要約（SageMaker: top-k、LLM: caption/tags）にする"""
+    provider = entry.get("provider")
+    if "error" in entry:
+        return {"provider": provider, "status": "error", "error": str(entry["error"])[:500]}
+    result = entry.get("result") or {}
+    summary = {"provider": provider, "status": "ok"}
+    if provider == "sagemaker":
+        raw = result.get("raw") or {}
+        summary["predicted_class_index"] = raw.get("predicted_class_index")
+        summary["confidence_score"] = raw.get("confidence_score")
+        if raw.get("top_k"):
+            summary["predicted_label"] = raw.get("predicted_label")
+            summary["top_k"] = raw["top_k"][:RESULT_TOP_K]
+        else:
+            # 後処理モジュール導入前の結果（top_k なし）
+            scores = (raw.get("all_scores") or [[]])[0]
+            summary["top_k"] = [
+                {"index": int(i), "score": float(scores[i]) if i < len(scores) else None}
+                for i in (raw.get("top_5_indices") or [])[:RESULT_TOP_K]
+            ]
+    elif provider == "azure":
+        try:
+            content = result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            content = ""
+        if isinstance(content, list):
+            content = "".join(c.get("text", "") for c in content if isinstance(c, dict))
+        summary.update(_parse_caption_tags(content))
+    elif provider == "bedrock":
+        summary["model"] = result.get("model")
+        summary.update(_parse_caption_tags((result.get("result") or {}).get("text", "")))
+    return summary
+
+def _compact_result_item(item: dict) -> dict:
+    """
+    results を要約（summary）に置き換え、全量は gzip して results_gz（Binary）に入れる。
+    圧縮後も RESULT_INLINE_RAW_MAX_BYTES を超える場合は S3 に置き、results_s3_key で参照する。
+    """
+    if RESULT_STORE_MODE != "compact" or "results" not in item:
+        return item
+    compact = {k: v for k, v in item.items() if k != "results"}
+    compact["result_format"] = "compact-v1"
+    compact["summary"] = [_compact_provider_result(r) for r in item["results"]]
+    raw = gzip.compress(json.dumps(item["results"], ensure_ascii=False, default=str).encode("utf-8"))
+    if len(raw) <= RESULT_INLINE_RAW_MAX_BYTES:
+        compact["results_gz"] = raw
+    else:
+        key = f"{RESULT_RAW_S3_PREFIX}{item['request_id']}.json.gz"
+        s3.put_object(Bucket=S3_UPLOAD_BUCKET, Key=key, Body=raw, ContentType="application/json", ContentEncoding="gzip")
+        compact["results_s3_key"] = key
+    return compact
+
+def _rehydrate_result_item(item: dict) -> dict:
+    """compact 形式のアイテムを従来の results 付きの形に戻す（従来形式はそのまま返す）"""
+    if item.get("result_format") != "compact-v1":
+        return item
+    item = dict(item)
+    blob = item.pop("results_gz", None)
+    s3_key = item.pop("results_s3_key", None)
+    try:
+        if blob is not None:
+            raw = blob.value if hasattr(blob, "value") else bytes(blob)
+        else:
+            raw = s3.get_object(Bucket=S3_UPLOAD_BUCKET, Key=s3_key)["Body"].read()
+        item["results"] = json.loads(gzip.decompress(raw))
+    except Exception as exc:
+        log_json(stage="get_result", action="rehydrate_failed", request_id=item.get("request_id"), error=str(exc))
+        item["results"] = None
+        item["results_error"] = "failed to load raw results"
+    return item
+
+# ==== 結果ログ（ローテーション付き gzip CSV）と集計 ====
+RESULTS_COLUMNS = ["ts", "request_id", "policy", "provider", "model", "latency_ms", "cost_usd"]
+
+class _ResultsSink:
+    """
+    LOGS_DIR/poc_results-<UTC時刻>-<pid>-<連番>.csv.gz に固定スキーマで追記する。
+    フラッシュごとに gzip メンバーを1つ追加し、RESULTS_ROTATE_BYTES / RESULTS_ROTATE_SEC を超えたら次のファイルへ。
+    """
+
+    def __init__(self):
+        self._path: Optional[pathlib.Path] = None
+        self._opened_at = 0.0
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _current_path(self) -> pathlib.Path:
+        now = time.time()
+        if (
+            self._path is None
+            or self._path.parent != LOGS_DIR
+            or now - self._opened_at > RESULTS_ROTATE_SEC
+            or (self._path.exists() and self._path.stat().st_size > RESULTS_ROTATE_BYTES)
+        ):
+            LOGS_DIR.mkdir(parents=True, exist_ok=True)
+            self._seq += 1
+            self._path = LOGS_DIR / f"poc_results-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}-{os.getpid()}-{self._seq:04d}.csv.gz"
+            self._opened_at = now
+        return self._path
+
+    def write(self, rows: List[dict]) -> None:
+        with self._lock:
+            path = self._current_path()
+            new_file = not path.exists()
+            with gzip.open(path, "at", newline="", encoding="utf-8") as f:
+                w = csv.DictWriter(f, fieldnames=RESULTS_COLUMNS, extrasaction="ignore")
+                if new_file:
+                    w.writeheader()
+                w.writerows(rows)
+
+_results_sink = _ResultsSink()
+
+def _iter_result_rows(since: Optional[str] = None):
+    """結果ログを1行ずつ読む（旧形式の poc_results.csv も対象）。since は ISO8601（タイムゾーン省略時は UTC）"""
+    since_epoch = None
+    if since:
+        since_dt = datetime.fromisoformat(since)
+        since_dt = (since_dt if since_dt.tzinfo else since_dt.replace(tzinfo=timezone.utc)).astimezone(timezone.utc)
+        since_epoch = since_dt.timestamp()
+        since = since_dt.isoformat(timespec="milliseconds")  # ts 列と同じ形式にそろえて文字列比較する
+    legacy = LOGS_DIR / "poc_results.csv"
+    paths = ([legacy] if legacy.exists() else []) + sorted(LOGS_DIR.glob("poc_results-*.csv.gz"))
+    for path in paths:
+        if since_epoch is not None and path.stat().st_mtime < since_epoch:
+            continue
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if since and row.get("ts", "") < since:
+                    continue
+                yield row
+
+def _percentile_from_counts(counts: Counter, total: int, q: float) -> Optional[int]:
+    rank = q / 100 * (total - 1)
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen > rank:
+            return value
+    return None
+
+def _summarize_results(since: Optional[str] = None) -> dict:
+    """
+    プロバイダー別の件数・コスト合計・レイテンシのパーセンタイル。
+    レイテンシは ms 値ごとの件数で持つため、メモリは行数ではなく値の種類数に比例する。
+    """
+    acc: Dict[str, dict] = {}
+    for row in _iter_result_rows(since):
+        stats = acc.setdefault(row.get("provider") or "unknown", {"count": 0, "cost_usd": 0.0, "latency": Counter()})
+        stats["count"] += 1
+        try:
+            stats["cost_usd"] += float(row.get("cost_usd") or 0)
+            stats["latency"][int(float(row["latency_ms"]))] += 1
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    summary = {}
+    for provider, stats in acc.items():
+        n = sum(stats["latency"].values())
+        summary[provider] = {
+            "count": stats["count"],
+            "cost_usd": round(stats["cost_usd"], 6),
+            "cost_per_request_usd": round(stats["cost_usd"] / stats["count"], 6),
+            "latency_ms": {
+                f"p{q}": _percentile_from_counts(stats["latency"], n, q) if n else None
+                for q in (50, 90, 95, 99)
+            },
+        }
+    return summary
+
+# ==== 結果キャッシュ（画像ハッシュ + プロバイダー + パラメータ） ====
+def _cache_key(provider: str, digest: str, params: dict) -> str:
+    param_digest = hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    return f"{provider}:{digest}:{param_digest}"
+
+class _LRUResultCache:
+    """プロセス内 LRU。TTL 切れと件数/合計バイト数の上限で古いものから追い出す"""
+
+    def __init__(self, ttl_sec: int, max_items: int, max_bytes: int):
+        self.ttl_sec = ttl_sec
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expire_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+            return entry[2]
+
+    def set(self, key: str, value: dict) -> None:
+        size = len(json.dumps(value, ensure_ascii=False, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            self._items[key] = (time.time() + self.ttl_sec, size, value)
+            self._bytes += size
+            while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._items)))
+
+    def _pop(self, key: str) -> None:
+        _, size, _ = self._items.pop(key)
+        self._bytes -= size
+
+class _DynamoResultCache:
+    """既存テーブルを共有キャッシュとして使う（request_id="cache#<key>"、expire_at で TTL 削除）"""
+
+    def __init__(self, table, ttl_sec: int):
+        self.table = table
+        self.ttl_sec = ttl_sec
+
+    def get(self, key: str) -> Optional[dict]:
+        r = self.table.get_item(Key={"request_id": f"cache#{key}"})
+        item = r.get("Item")
+        if not item or int(item.get("expire_at", 0)) < time.time():
+            return None
+        return json.loads(item["cache_value"])
+
+    def set(self, key: str, value: dict) -> None:
+        now = int(time.time())
+        self.table.put_item(Item={
+            "request_id": f"cache#{key}",
+            "cache_value": json.dumps(value, ensure_ascii=False, default=str),
+            "created_at": now,
+            "expire_at": now + self.ttl_sec,
+        })
+
+class _TieredResultCache:
+    """L1(プロセス内) → L2(共有) の順に参照し、L2 ヒット時は L1 に昇格する"""
+
+    def __init__(self, l1, l2):
+        self.l1 = l1
+        self.l2 = l2
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.l1.get(key)
+        if value is None:
+            value = self.l2.get(key)
+            if value is not None:
+                self.l1.set(key, value)
+        return value
+
+    def set(self, key: str, value: dict) -> None:
+        self.l1.set(key, value)
+        self.l2.set(key, value)
+
+def _build_result_cache():
+    if RESULT_CACHE_BACKEND == "memory":
+        return _LRUResultCache(RESULT_CACHE_TTL_SEC, RESULT_CACHE_MAX_ITEMS, RESULT_CACHE_MAX_BYTES)
+    if RESULT_CACHE_BACKEND == "dynamodb":
+        return _DynamoResultCache(ddb, RESULT_CACHE_TTL_SEC)
+    if RESULT_CACHE_BACKEND == "tiered":
+        return _TieredResultCache(
+            _LRUResultCache(RESULT_CACHE_TTL_SEC, RESULT_CACHE_MAX_ITEMS, RESULT_CACHE_MAX_BYTES),
+            _DynamoResultCache(ddb, RESULT_CACHE_TTL_SEC),
+        )
+    return None
+
+_result_cache = _build_result_cache()
+
+# ==== 同一リクエストの集約（single-flight） ====
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class _DynamoLease:
+    """
+    インスタンス間の single-flight 用リース（request_id="flight#<key>"、条件付き書き込み）。
+    取得できなかった側は lease_value が書かれるまでポーリングし、リースが消えたら自分で実行する。
+    """
+
+    RESULT_SEC = 5  # 結果を後続に渡すために残しておく秒数
+
+    def __init__(self, table, lease_sec: int, poll_sec: float):
+        self.table = table
+        self.lease_sec = lease_sec
+        self.poll_sec = poll_sec
+
+    def acquire(self, key: str) -> bool:
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={"request_id": f"flight#{key}", "created_at": now, "expire_at": now + self.lease_sec},
+                ConditionExpression="attribute_not_exists(request_id) OR expire_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+            return True
+        except Exception as exc:
+            if _client_error_code(exc) == "ConditionalCheckFailedException":
+                return False
+            # リース層の障害では止めない（このインスタンス内の集約のみで続行）
+            log_json(stage="single_flight", action="lease_failed", error=str(exc))
+            return True
+
+    def publish(self, key: str, value) -> None:
+        now = int(time.time())
+        try:
+            self.table.put_item(Item={
+                "request_id": f"flight#{key}",
+                "lease_value": json.dumps(value, ensure_ascii=False, default=str),
+                "created_at": now,
+                "expire_at": now + self.RESULT_SEC,
+            })
+        except Exception as exc:
+            log_json(stage="single_flight", action="publish_failed", error=str(exc))
+
+    def release(self, key: str) -> None:
+        try:
+            self.table.delete_item(Key={"request_id": f"flight#{key}"})
+        except Exception as exc:
+            log_json(stage="single_flight", action="release_failed", error=str(exc))
+
+    def wait(self, key: str):
+        deadline = time.time() + self.lease_sec
+        while time.time() < deadline:
+            time.sleep(self.poll_sec)
+            try:
+                item = self.table.get_item(Key={"request_id": f"flight#{key}"}, ConsistentRead=True).get("Item")
+            except Exception as exc:
+                log_json(stage="single_flight", action="wait_failed", error=str(exc))
+                return None
+            if not item or int(item.get("expire_at", 0)) < time.time():
+                return None
+            if "lease_value" in item:
+                return json.loads(item["lease_value"])
+        return None
+
+class _SingleFlight:
+    """
+    同じキーの処理が実行中なら、後から来た呼び出しはその完了を待って結果（または例外）を共有する。
+    lease を渡すと、他インスタンスで実行中の同じキーも待ち合わせる（結果は JSON 化できる値に限る）。
+    """
+
+    def __init__(self, name: str, lease: Optional[_DynamoLease] = None):
+        self.name = name
+        self.lease = lease
+        self.stats = {"leaders": 0, "followers": 0, "remote_followers": 0}
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._run(key, fn)
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _run(self, key: str, fn):
+        if self.lease is None:
+            return fn()
+        if not self.lease.acquire(key):
+            value = self.lease.wait(key)
+            if value is not None:
+                with self._lock:
+                    self.stats["remote_followers"] += 1
+                return value
+        try:
+            value = fn()
+        except Exception:
+            self.lease.release(key)
+            raise
+        self.lease.publish(key, value)
+        return value
+
+class _AsyncSingleFlight:
+    """イベントループ上の single-flight。1つの呼び出し元がキャンセルされても共有タスクは止めない"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stats = {"leaders": 0, "followers": 0}
+        self._tasks: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, coro_fn):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _t, k=key: self._tasks.pop(k, None))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+        return await asyncio.shield(task)
+
+_provider_flight = _SingleFlight(
+    "provider",
+    _DynamoLease(ddb, SINGLEFLIGHT_LEASE_SEC, SINGLEFLIGHT_POLL_SEC) if SINGLEFLIGHT_BACKEND == "dynamodb" else None,
+)
+_s3_flight = _SingleFlight("s3_analyze")
+_request_flight = _AsyncSingleFlight("analyze_request")
+
+def _with_result_cache(provider: str, content_digest: str, params: dict, refresh: bool, call):
+    """
+    キャッシュ経由でプロバイダーを呼ぶ。refresh=True の場合は参照をスキップして結果を上書きする。
+    ヒット/ミスは _record_latency("cache_<provider>", ...) の Success で記録（1=ヒット）。
+    キャッシュ層の障害は推論を止めない。
+    同じキーで実行中の推論があれば、新たに呼ばずにその結果を待つ（_provider_flight）。
+    refresh=True は別の flight にする（他インスタンスが直前に publish した結果を読まず、必ず推論し直す）。
+    """
+    key = _cache_key(provider, content_digest, params)
+    flight_key = f"{key}|refresh={refresh}"
+    if _result_cache is None:
+        return _provider_flight.do(flight_key, call)
+
+    if not refresh:
+        t0 = time.time()
+        try:
+            cached = _result_cache.get(key)
+        except Exception as exc:
+            log_json(stage="result_cache", action="get_failed", provider=provider, error=str(exc))
+            cached = None
+        _record_latency(f"cache_{provider}", t0, cached is not None)
+        if cached is not None:
+            return cached
+
+    def call_and_store():
+        result = call()
+        try:
+            _result_cache.set(key, result)
+        except Exception as exc:
+            log_json(stage="result_cache", action="set_failed", provider=provider, error=str(exc))
+        return result
+
+    return _provider_flight.do(flight_key, call_and_store)
+
+# ==== モック応答 ====
+def _mock_result(provider: str, model: str) -> AnalyzeResponse:
+    return AnalyzeResponse(
+        provider=provider,
+        model=model,
+        caption="テーブルの上に寿司が並べられています。",
+        tags=["寿司", "テーブル", "食べ物"],
+        latency_ms=0,
+        tokens={"input": 50, "output": 30},
+        cost_estimate={"usd": 0.0, "method": "mock"},
+        raw={}
+    )
+
+# ==== Azure HTTP 接続プール（ウォーム起動時は DNS/TCP/TLS を再利用） ====
+_azure_session = None
+_azure_async_client = None
+_azure_http_lock = threading.Lock()
+
+def _get_azure_session():
+    """同期経路（call_azure_real / azure_chat_completion_with_retry）で共有する Session"""
+    global _azure_session
+    if _azure_session is None:
+        with _azure_http_lock:
+            if _azure_session is None:
+                from requests import Session
+                from requests.adapters import HTTPAdapter
+                session = Session()
+                adapter = HTTPAdapter(pool_connections=AZURE_HTTP_POOL_SIZE, pool_maxsize=AZURE_HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _azure_session = session
+    return _azure_session
+
+def _get_azure_async_client() -> "httpx.AsyncClient":
+    """非同期経路で共有する AsyncClient（同じプールサイズ・keep-alive 設定）"""
+    global _azure_async_client
+    if _azure_async_client is None or _azure_async_client.is_closed:
+        with _azure_http_lock:
+            if _azure_async_client is None or _azure_async_client.is_closed:
+                _azure_async_client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=AZURE_HTTP_POOL_SIZE,
+                        max_keepalive_connections=AZURE_HTTP_POOL_SIZE,
+                        keepalive_expiry=AZURE_HTTP_KEEPALIVE_SEC,
+                    ),
+                    timeout=httpx.Timeout(REQUEST_TIMEOUT_TOTAL, connect=REQUEST_TIMEOUT_CONNECT),
+                    event_hooks={"request": [_count_azure_async_request]},
+                )
+    return _azure_async_client
+
+_azure_async_counts = {"requests": 0, "new_connections": 0}
+
+async def _count_azure_async_request(request: "httpx.Request") -> None:
+    """AsyncClient の request フック: 送信数を数え、trace 拡張で新規接続の確立を数える（プール内部は読まない）"""
+    _azure_async_counts["requests"] += 1
+    request.extensions["trace"] = _trace_azure_async_connection
+
+async def _trace_azure_async_connection(event_name: str, info: dict) -> None:
+    if event_name == "connection.connect_tcp.complete":
+        _azure_async_counts["new_connections"] += 1
+
+def _azure_http_stats() -> dict:
+    """接続プールの再利用状況（requests - new_connections が再利用された回数）"""
+    stats = {"sync": {"requests": 0, "new_connections": 0, "reused": 0}, "async": {"requests": 0, "new_connections": 0, "reused": 0}}
+    if _azure_session is not None:
+        from requests.adapters import HTTPAdapter
+        for adapter in set(_azure_session.adapters.values()):
+            if not isinstance(adapter, HTTPAdapter):
+                continue
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                stats["sync"]["requests"] += pool.num_requests
+                stats["sync"]["new_connections"] += pool.num_connections
+        stats["sync"]["reused"] = max(0, stats["sync"]["requests"] - stats["sync"]["new_connections"])
+    stats["async"].update(_azure_async_counts)
+    stats["async"]["reused"] = max(0, _azure_async_counts["requests"] - _azure_async_counts["new_connections"])
+    return stats
+
+# ==== クライアント側レート制限（requests/min・tokens/min・同時実行数） ====
+class ProviderThrottled(RuntimeError):
+    """待ち時間が RATE_LIMIT_MAX_WAIT_SEC を超えるため送信前に打ち切った（429 相当として扱う）"""
+
+class _TokenBucket:
+    """1分あたり per_minute を補充するバケット。予約は先に差し引き、不足分を待ち秒数として返す"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, n: float, now: float) -> float:
+        self._refill(now)
+        deficit = n - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def adjust(self, delta: float) -> None:
+        self.level = min(self.capacity, self.level + delta)
+
+    def clamp(self, remaining: float, now: float) -> None:
+        """サーバーが返した残量より手元の見積もりが多ければ合わせる"""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+class _DynamoRateCounter:
+    """
+    複数 Lambda インスタンスで上限を共有する1分窓カウンター。
+    request_id="ratelimit#<key>#<kind>#<window>" に条件付き ADD し、上限超過なら次の窓までの秒数を返す。
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def reserve(self, key: str, kind: str, n: int, limit: int) -> tuple:
+        """(待ち秒数, 予約した窓) を返す。待ち秒数が 0 より大きい / 窓が None なら予約していない"""
+        now = time.time()
+        window = int(now // 60)
+        try:
+            self.table.update_item(
+                Key={"request_id": f"ratelimit#{key}#{kind}#{window}"},
+                UpdateExpression="ADD used :n SET expire_at = :exp",
+                ConditionExpression="attribute_not_exists(used) OR used <= :max",
+                ExpressionAttributeValues={":n": n, ":max": limit - n, ":exp": (window + 2) * 60},
+            )
+        except Exception as exc:
+            if _client_error_code(exc) == "ConditionalCheckFailedException":
+                return (window + 1) * 60 - now, None
+            # 共有カウンターの障害では止めない（ローカルのバケットのみで制御）
+            log_json(stage="rate_limit", action="counter_failed", key=key, error=str(exc))
+            return 0.0, None
+        return 0.0, window
+
+    def release(self, key: str, kind: str, n: int, window: int) -> None:
+        """reserve で予約した分を同じ窓のカウンターから差し引く"""
+        try:
+            self.table.update_item(
+                Key={"request_id": f"ratelimit#{key}#{kind}#{window}"},
+                UpdateExpression="ADD used :n",
+                ConditionExpression="attribute_exists(used)",
+                ExpressionAttributeValues={":n": -n},
+            )
+        except Exception as exc:
+            if _client_error_code(exc) != "ConditionalCheckFailedException":
+                log_json(stage="rate_limit", action="counter_release_failed", key=key, error=str(exc))
+
+def _client_error_code(exc: Exception) -> str:
+    response = getattr(exc, "response", None)
+    return response.get("Error", {}).get("Code", "") if isinstance(response, dict) else ""
+
+def _http_status(exc: Exception) -> Optional[int]:
+    """requests / httpx の HTTP エラーと botocore の ClientError から HTTP ステータスを取り出す"""
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        # SageMaker の ModelError(424) はコンテナが返したステータスを OriginalStatusCode に持つ
+        status = response.get("OriginalStatusCode") or response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    else:
+        status = getattr(response, "status_code", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _is_client_error(exc: Exception) -> bool:
+    """リクエスト内容が原因の 4xx（コンテンツフィルター・ValidationError など）。429 とタイムアウト(408)は除く"""
+    status = _http_status(exc)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+def _header_float(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers else None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class _ProviderLimiter:
+    """
+    1プロバイダー/デプロイメント分のレート制限。
+    - rpm / tpm のトークンバケット（予約方式なのでバースト時は到着順に短時間キューイングされる）
+    - max_inflight のセマフォ
+    - defer(): 429 の Retry-After を受けて、このキーへの送信を全体で一時停止
+    """
+
+    def __init__(self, key: str, rpm: int, tpm: int, max_inflight: int):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_inflight = max_inflight
+        self.requests = _TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = _TokenBucket(tpm) if tpm > 0 else None
+        self._inflight = threading.BoundedSemaphore(max_inflight) if max_inflight > 0 else None
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.stats = {"acquired": 0, "waited": 0, "wait_ms_total": 0, "rejected": 0, "deferred": 0}
+        self._lock = threading.Lock()
+
+    def _reserve(self, est_tokens: int) -> float:
+        """バケットから予約し、送信までに待つ秒数を返す"""
+        n_tokens = min(est_tokens, self.tokens.capacity) if self.tokens else 0
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.wait_for(1, now))
+            if self.tokens:
+                wait = max(wait, self.tokens.wait_for(n_tokens, now))
+            if wait > RATE_LIMIT_MAX_WAIT_SEC:
+                self.stats["rejected"] += 1
+                raise ProviderThrottled(f"{self.key}: client-side rate limit (wait {wait:.1f}s)")
+            if self.requests:
+                self.requests.adjust(-1)
+            if self.tokens:
+                self.tokens.adjust(-n_tokens)
+            self.stats["acquired"] += 1
+            if wait > 0:
+                self.stats["waited"] += 1
+                self.stats["wait_ms_total"] += int(wait * 1000)
+        return wait
+
+    def _global_wait(self, est_tokens: int) -> float:
+        """共有カウンター（RATE_LIMIT_BACKEND=dynamodb）での待ち秒数。0 なら送信可"""
+        if _rate_counter is None:
+            return 0.0
+        reserved = []
+        for kind, limit, n in (("rpm", self.rpm, 1), ("tpm", self.tpm, est_tokens)):
+            if limit > 0:
+                n = min(n, limit)
+                wait, window = _rate_counter.reserve(self.key, kind, n, limit)
+                if wait > 0:
+                    # 先に取れた枠（rpm）は返す。待って再試行するたびに送っていないリクエストが数えられるのを防ぐ
+                    for done_kind, done_n, done_window in reserved:
+                        _rate_counter.release(self.key, done_kind, done_n, done_window)
+                    return wait
+                if window is not None:
+                    reserved.append((kind, n, window))
+        return 0.0
+
+    def _check_deadline(self, wait: float, deadline: float) -> None:
+        if time.monotonic() + wait > deadline:
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise ProviderThrottled(f"{self.key}: shared rate limit (wait {wait:.1f}s)")
+
+    def _enter(self) -> None:
+        with self._lock:
+            self.inflight += 1
+
+    def _exit(self) -> None:
+        with self._lock:
+            self.inflight -= 1
+        if self._inflight:
+            self._inflight.release()
+
+    @contextmanager
+    def slot(self, est_tokens: int = 0):
+        """同期経路用: 枠が空くまで待ってから送信する"""
+        deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SEC
+        time.sleep(self._reserve(est_tokens))
+        while True:
+            wait = self._global_wait(est_tokens)
+            if wait <= 0:
+                break
+            self._check_deadline(wait, deadline)
+            time.sleep(wait)
+        if self._inflight and not self._inflight.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise ProviderThrottled(f"{self.key}: max in-flight {self.max_inflight} reached")
+        self._enter()
+        try:
+            yield self
+        finally:
+            self._exit()
+
+    @asynccontextmanager
+    async def slot_async(self, est_tokens: int = 0):
+        """非同期経路用: slot と同じ制御を asyncio.sleep で待つ"""
+        deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SEC
+        await asyncio.sleep(self._reserve(est_tokens))
+        while _rate_counter is not None:
+            wait = await asyncio.to_thread(self._global_wait, est_tokens)
+            if wait <= 0:
+                break
+            self._check_deadline(wait, deadline)
+            await asyncio.sleep(wait)
+        while self._inflight and not self._inflight.acquire(blocking=False):
+            self._check_deadline(0.02, deadline)
+            await asyncio.sleep(0.02)
+        self._enter()
+        try:
+            yield self
+        finally:
+            self._exit()
+
+    def observe(self, headers) -> Optional[float]:
+        """
+        レスポンスヘッダで見積もりを補正する。
+        x-ratelimit-remaining-requests / -tokens でバケットを絞り、Retry-After（秒 or ms）を返す。
+        """
+        remaining_requests = _header_float(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_float(headers, "x-ratelimit-remaining-tokens")
+        with self._lock:
+            now = time.monotonic()
+            if self.requests and remaining_requests is not None:
+                self.requests.clamp(remaining_requests, now)
+            if self.tokens and remaining_tokens is not None:
+                self.tokens.clamp(remaining_tokens, now)
+        retry_after = _header_float(headers, "retry-after")
+        if retry_after is None:
+            retry_after_ms = _header_float(headers, "retry-after-ms")
+            retry_after = retry_after_ms / 1000 if retry_after_ms is not None else None
+        return retry_after
+
+    def defer(self, seconds: float) -> float:
+        """
+        429 を受けたら、このキーへの送信をまとめて止める（リトライの集中を防ぐ）。
+        止めるのは RATE_LIMIT_MAX_WAIT_SEC まで（超えると次の slot が待たずに ProviderThrottled になるため）。
+        seconds がそれを超える場合は seconds を返すので、リトライする呼び出し側はその秒数を自分で sleep する
+        （上限内なら 0 を返し、待ちは次の slot で行う）。
+        """
+        paused = min(seconds, RATE_LIMIT_MAX_WAIT_SEC)
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + paused)
+            self.stats["deferred"] += 1
+        return seconds if seconds > paused else 0.0
+
+    def settle(self, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        """見積もりと実際の使用トークン数の差をバケットに戻す/追加で差し引く"""
+        if not self.tokens or not actual_tokens:
+            return
+        with self._lock:
+            self.tokens.adjust(min(est_tokens, self.tokens.capacity) - actual_tokens)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket._refill(now)
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "max_inflight": self.max_inflight,
+                "inflight": self.inflight,
+                "requests_available": round(self.requests.level, 1) if self.requests else None,
+                "tokens_available": round(self.tokens.level, 1) if self.tokens else None,
+                "paused_sec": round(max(0.0, self.paused_until - now), 2),
+                **self.stats,
+            }
+
+_rate_counter = _DynamoRateCounter(ddb) if RATE_LIMIT_BACKEND == "dynamodb" else None
+_rate_limiters: Dict[str, _ProviderLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def _get_limiter(provider: str, deployment: str) -> _ProviderLimiter:
+    key = f"{provider}:{deployment}"
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        with _rate_limiters_lock:
+            limiter = _rate_limiters.get(key)
+            if limiter is None:
+                limiter = _ProviderLimiter(key, **PROVIDER_RATE_LIMITS[provider])
+                _rate_limiters[key] = limiter
+    return limiter
+
+def _estimate_tokens(max_tokens: int) -> int:
+    """送信前の tokens/min 予約量（画像入力の見積もり + 出力上限）"""
+    return RATE_LIMIT_IMAGE_TOKENS + max_tokens
+
+def _usage_tokens(out: dict) -> Optional[int]:
+    """Azure（total_tokens）/ Bedrock（input_tokens + output_tokens）の使用量"""
+    usage = out.get("usage") if isinstance(out, dict) else None
+    if not isinstance(usage, dict):
+        return None
+    if "total_tokens" in usage:
+        return int(usage["total_tokens"])
+    return int(usage.get("input_tokens", 0)) + int(usage.get("output_tokens", 0)) or None
+
+def _defer_on_throttle(limiter: _ProviderLimiter, exc: Exception, wait: float) -> None:
+    if not isinstance(exc, ProviderThrottled) and _is_throttle_error(exc):
+        limiter.defer(wait)
+
+# ==== サーキットブレーカー（障害中はリトライを使い切らずに即失敗） ====
+class CircuitOpenError(RuntimeError):
+    """ブレーカーが open のため、プロバイダーを呼ばずに失敗した"""
+
+class CircuitBreaker:
+    """
+    - closed: 連続失敗が failure_threshold に達したら open
+    - open: open_sec の間は呼び出さずに CircuitOpenError
+    - half_open: half_open_max_calls 件まで試行し、success_threshold 件成功で closed、失敗すれば再び open
+    状態遷移と拒否は EMF（CircuitState / CircuitRejected）で出力する。
+    """
+
+    # 入力不正・クライアント側の待ち打ち切り・キャンセルはプロバイダーの障害として数えない
+    # （プロバイダーが返した 429 以外の 4xx も _is_client_error で同じ扱い。不正な画像数件で全体を止めないため）
+    NEUTRAL_ERRORS = (HTTPException, FileNotFoundError, ProviderThrottled)
+
+    def __init__(self, name: str, failure_threshold: int, open_sec: float, half_open_max_calls: int, success_threshold: int):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.half_open_max_calls = half_open_max_calls
+        self.success_threshold = success_threshold
+        self.state = "closed"
+        self.failures = 0
+        self.successes = 0
+        self.probes = 0
+        self.opened_at = 0.0
+        self.stats = {"opened": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str) -> None:
+        self.state = state
+        self.failures = self.successes = self.probes = 0
+        if state == "open":
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        log_json(stage="circuit", provider=self.name, state=state)
+
+    def before_call(self) -> None:
+        transitioned = rejected = False
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.open_sec:
+                self._transition("half_open")
+                transitioned = True
+            if self.state == "open" or (self.state == "half_open" and self.probes >= self.half_open_max_calls):
+                rejected = True
+                self.stats["rejected"] += 1
+                retry_in = max(0.0, self.open_sec - (time.monotonic() - self.opened_at))
+            elif self.state == "half_open":
+                self.probes += 1
+            state = self.state
+        if transitioned or rejected:
+            _record_circuit_state(self.name, state, rejected)
+        if rejected:
+            raise CircuitOpenError(f"{self.name} circuit {state} (retry in {retry_in:.1f}s)")
+
+    def after_call(self, ok: Optional[bool]) -> None:
+        """ok=None は判定対象外（half-open の試行枠だけ返す）"""
+        previous = self.state
+        with self._lock:
+            if self.state == "half_open":
+                self.probes = max(0, self.probes - 1)
+                if ok is True:
+                    self.successes += 1
+                    if self.successes >= self.success_threshold:
+                        self._transition("closed")
+                elif ok is False:
+                    self._transition("open")
+            elif self.state == "closed":
+                if ok is True:
+                    self.failures = 0
+                elif ok is False:
+                    self.failures += 1
+                    if self.failures >= self.failure_threshold:
+                        self._transition("open")
+            state = self.state
+        if state != previous:
+            _record_circuit_state(self.name, state)
+
+    @contextmanager
+    def guard(self):
+        if not CIRCUIT_BREAKER_ENABLED:
+            yield
+            return
+        self.before_call()
+        ok = None
+        try:
+            yield
+            ok = True
+        except self.NEUTRAL_ERRORS:
+            raise
+        except Exception as exc:
+            ok = None if _is_client_error(exc) else False
+            raise
+        finally:
+            self.after_call(ok)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = max(0.0, self.open_sec - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "half_open_probes": self.probes,
+                "retry_in_sec": round(retry_in, 2),
+                **self.stats,
+            }
+
+_circuit_breakers = {
+    name: CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SEC, CIRCUIT_HALF_OPEN_MAX_CALLS, CIRCUIT_SUCCESS_THRESHOLD)
+    for name in ("azure", "sagemaker", "bedrock")
+}
+
+def _circuit(provider: str):
+    """プロバイダー呼び出し（リトライ込み）をブレーカーで包むデコレーター。同期/非同期の両方に対応"""
+    breaker = _circuit_breakers[provider]
+
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with breaker.guard():
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with breaker.guard():
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# ==== 実API: Azure (gpt-4o-mini) ====
+def _build_azure_real_request(req_id: str):
+    """ローカル保存画像を縮小して Azure chat/completions の (url, headers, body) を作る（CPU処理）"""
+    img_path = _find_image_path_by_request_id(req_id)
+    b64, mime = _downscale_to_jpeg_b64(img_path)
+
+    system_prompt = (
+        "次の画像を説明してください。出力は必ず有効なJSONのみ、余計な文章は禁止。\n"
+        '{ "caption": "日本語で1〜2文、50文字以内", "tags": ["日本語の単語を最大5個"] }'
+    )
+
+    user_content = [
+        {"type": "text", "text": "画像を要約し、JSONのみで返してください。"},
+        {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}}
+    ]
+
+    url = f"{AZURE_ENDPOINT}/openai/deployments/{AZURE_DEPLOY}/chat/completions?api-version={AZURE_API_VERSION}"
+    headers = {"api-key": AZURE_KEY, "Content-Type": "application/json"}
+    body = {
+        "messages": [
+            {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0.2,
+        "max_tokens": 128  # 抑えめ
+    }
+    return url, headers, body
+
+@_circuit("azure")
+def call_azure_real(req_id: str) -> AnalyzeResponse:
+    url, headers, body = _build_azure_real_request(req_id)
+
+    limiter = _get_limiter("azure", AZURE_DEPLOY)
+    est_tokens = _estimate_tokens(body["max_tokens"])
+    t0 = time.time()
+    out = None
+    for attempt in range(3):
+        with limiter.slot(est_tokens):
+            resp = _get_azure_session().post(url, headers=headers, json=body, timeout=60)
+        ra = limiter.observe(resp.headers)
+        if resp.status_code == 429:
+            wait = ra if ra is not None else (2 * (attempt + 1))
+            print(f"[Azure 429] retry in {wait}s (attempt {attempt+1}/3)")
+            time.sleep(limiter.defer(wait))
+            continue
+        if not resp.ok:
+            print("AZURE ERROR", resp.status_code, resp.text[:300])
+            resp.raise_for_status()
+        out = resp.json()
+        limiter.settle(est_tokens, _usage_tokens(out))
+        break
+    if out is None:
+        resp.raise_for_status()
+    return _parse_azure_real_response(out, t0)
+
+def _parse_azure_real_response(out: dict, t0: float) -> AnalyzeResponse:
+    content = out["choices"][0]["message"]["content"]
+    if isinstance(content, list):
+        text = "".join([c.get("text", "") for c in content if isinstance(c, dict)])
+    else:
+        text = content or ""
+
+    try:
+        payload = json.loads(text)
+    except Exception:
+        s, e = text.find("{"), text.rfind("}")
+        payload = json.loads(text[s:e + 1])
+
+    latency = int((time.time() - t0) * 1000)
+    return AnalyzeResponse(
+        provider="azure",
+        model="gpt-4o-mini",
+        caption=str(payload.get("caption", "")),
+        tags=list(payload.get("tags", [])),
+        latency_ms=latency,
+        tokens={"input": 0, "output": 0},
+        cost_estimate={"usd": 0.0, "method": "token_based"},
+        raw=out,
+    )
+
+# ==== Azure呼び出し：指数バックオフ＋タイムアウト ====
+def _build_azure_payload(img_bytes, user_prompt: str) -> dict:
+    img_b64 = _as_prepared(img_bytes).llm_jpeg_b64
+    return {
+        "messages": [
+            {"role":"system","content":[{"type":"text","text":"You are a helpful vision assistant. Describe the image briefly and output 3 tags."}]},
+            {"role":"user","content":[
+                {"type":"text","text": user_prompt},
+                {"type":"image_url","image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
+            ]}
+        ],
+        "max_tokens": 128
+    }
+
+@_circuit("azure")
+def azure_chat_completion_with_retry(endpoint: str, deployment: str, api_version: str, api_key: str, img_bytes, user_prompt: str) -> dict:
+    url = f"{endpoint}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+    payload = _build_azure_payload(img_bytes, user_prompt)
+    headers = {"api-key": api_key, "Content-Type":"application/json"}
+
+    session = _get_azure_session()
+    from requests import RequestException
+    limiter = _get_limiter("azure", deployment)
+    est_tokens = _estimate_tokens(payload["max_tokens"])
+    for attempt in range(1, AZURE_MAX_RETRIES+1):
+        t0 = time.time()
+        try:
+            with limiter.slot(est_tokens):
+                resp = session.post(
+                    url, headers=headers, json=payload,
+                    timeout=(REQUEST_TIMEOUT_CONNECT, REQUEST_TIMEOUT_TOTAL)
+                )
+            retry_after = limiter.observe(resp.headers)
+            if resp.status_code in (429, 500, 502, 503, 504):
+                # リトライ系（429 は同じデプロイメントへの他リクエストも待たせる）
+                wait = retry_after if retry_after is not None else (AZURE_RETRY_BASE_SEC * (2 ** (attempt-1)))
+                log_json(stage="azure_call", status="retry", attempt=attempt, code=resp.status_code, wait_sec=wait)
+                if resp.status_code == 429:
+                    time.sleep(limiter.defer(wait))
+                else:
+                    time.sleep(wait)
+                continue
+            resp.raise_for_status()
+            rt = round((time.time()-t0)*1000)
+            log_json(stage="azure_call", status="ok", code=resp.status_code, rt_ms=rt)
+            out = resp.json()
+            limiter.settle(est_tokens, _usage_tokens(out))
+            return out
+        except RequestException as e:
+            # 接続/タイムアウトもリトライ対象
+            wait = AZURE_RETRY_BASE_SEC * (2 ** (attempt-1))
+            log_json(stage="azure_call", status="exception", attempt=attempt, error=str(e), wait_sec=wait)
+            if attempt < AZURE_MAX_RETRIES:
+                time.sleep(wait)
+            else:
+                raise
+    raise RuntimeError("Azure call exhausted retries")
+
+@_circuit("azure")
+async def azure_chat_completion_with_retry_async(endpoint: str, deployment: str, api_version: str, api_key: str, img_bytes, user_prompt: str) -> dict:
+    """azure_chat_completion_with_retry の非同期版（共有 AsyncClient + asyncio.sleep）"""
+    url = f"{endpoint}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+    payload = _build_azure_payload(img_bytes, user_prompt)
+    headers = {"api-key": api_key, "Content-Type":"application/json"}
+
+    client = _get_azure_async_client()
+    limiter = _get_limiter("azure", deployment)
+    est_tokens = _estimate_tokens(payload["max_tokens"])
+    for attempt in range(1, AZURE_MAX_RETRIES+1):
+        t0 = time.time()
+        try:
+            async with limiter.slot_async(est_tokens):
+                resp = await client.post(url, headers=headers, json=payload)
+            retry_after = limiter.observe(resp.headers)
+            if resp.status_code in (429, 500, 502, 503, 504):
+                wait = retry_after if retry_after is not None else (AZURE_RETRY_BASE_SEC * (2 ** (attempt-1)))
+                log_json(stage="azure_call", status="retry", attempt=attempt, code=resp.status_code, wait_sec=wait)
+                if resp.status_code == 429:
+                    await asyncio.sleep(limiter.defer(wait))
+                else:
+                    await asyncio.sleep(wait)
+                continue
+            resp.raise_for_status()
+            rt = round((time.time()-t0)*1000)
+            log_json(stage="azure_call", status="ok", code=resp.status_code, rt_ms=rt)
+            out = resp.json()
+            limiter.settle(est_tokens, _usage_tokens(out))
+            return out
+        except httpx.HTTPError as e:
+            wait = AZURE_RETRY_BASE_SEC * (2 ** (attempt-1))
+            log_json(stage="azure_call", status="exception", attempt=attempt, error=str(e), wait_sec=wait)
+            if attempt < AZURE_MAX_RETRIES:
+                await asyncio.sleep(wait)
+            else:
+                raise
+    raise RuntimeError("Azure call exhausted retries")
+
+_AZURE_S3_PROMPT = "この画像の内容を短く説明し、日本語で3つのタグを箇条書きで出力して下さい。"
+
+def call_azure_from_bytes(img_bytes, refresh: bool = False) -> dict:
+    """img_bytes は画像バイナリまたは PreparedImage（送信するのは縮小 JPEG）"""
+    prepared = _as_prepared(img_bytes)
+    endpoint = os.environ["AZURE_OPENAI_ENDPOINT"].rstrip("/")
+    deployment = os.environ["AZURE_OPENAI_DEPLOYMENT_MINI"]
+    api_ver = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-10-21")
+    api_key = os.environ["AZURE_OPENAI_API_KEY"]
+
+    # 画像サイズバリデーション（過大入力抑止）
+    if len(prepared.raw) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"image too large: {len(prepared.raw)} bytes (limit {MAX_IMAGE_BYTES})")
+
+    params = {"endpoint": endpoint, "deployment": deployment, "api_version": api_ver, "prompt": _AZURE_S3_PROMPT, "max_tokens": 128, **prepared.cache_params()}
+    return _with_result_cache("azure", prepared.sha256, params, refresh, lambda: azure_chat_completion_with_retry(
+        endpoint=endpoint,
+        deployment=deployment,
+        api_version=api_ver,
+        api_key=api_key,
+        img_bytes=prepared,
+        user_prompt=_AZURE_S3_PROMPT
+    ))
+
+# ==== SageMaker呼び出し ====
+# ImageNet 正規化係数を事前計算: (x/255 - mean)/std = x*scale + bias（HWC でブロードキャスト）
+@functools.lru_cache(maxsize=1)
+def _imagenet_norm() -> tuple:
+    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    return (1.0 / (255.0 * std)).astype(np.float32), (-mean / std).astype(np.float32)
+
+SAGEMAKER_INPUT_SIZE = 224
+SAGEMAKER_PAYLOAD_MODES = ("json", "npy", "float32", "float16", "uint8")
+SAGEMAKER_MAX_BATCH = int(os.getenv("SAGEMAKER_MAX_BATCH", "16"))
+# Serverless Inference のリクエスト上限(4MB)に余裕を持たせた既定値
+SAGEMAKER_MAX_PAYLOAD_BYTES = int(os.getenv("SAGEMAKER_MAX_PAYLOAD_BYTES", str(4 * 1024 * 1024 - 64 * 1024)))
+SAGEMAKER_BATCH_MAX_KEYS = int(os.getenv("SAGEMAKER_BATCH_MAX_KEYS", "64"))
+# 出力の後処理（top-k 件数 / ロジットを返すモデル向けの softmax / all_scores を結果に含めるか / ラベル表）
+SAGEMAKER_TOP_K = int(os.getenv("SAGEMAKER_TOP_K", "5"))
+SAGEMAKER_APPLY_SOFTMAX = os.getenv("SAGEMAKER_APPLY_SOFTMAX", "0") == "1"
+SAGEMAKER_INCLUDE_ALL_SCORES = os.getenv("SAGEMAKER_INCLUDE_ALL_SCORES", "1") == "1"
+SAGEMAKER_LABELS_PATH = os.getenv("SAGEMAKER_LABELS_PATH", "")
+
+def _load_class_labels() -> Optional[List[str]]:
+    """起動時に1回だけクラスラベル表を読む。読めなければラベルなしで続行"""
+    if not SAGEMAKER_LABELS_PATH:
+        return None
+    try:
+        labels = postprocess.load_labels(SAGEMAKER_LABELS_PATH)
+    except (OSError, ValueError) as e:
+        log_json(stage="startup", action="labels_load_failed", path=SAGEMAKER_LABELS_PATH, error=str(e))
+        return None
+    if labels:
+        log_json(stage="startup", action="labels_loaded", path=SAGEMAKER_LABELS_PATH, count=len(labels))
+    return labels
+
+_class_labels = _load_class_labels()
+# ラベル表の中身が変わったらキャッシュを引き直すため、パスではなく読み込んだ内容のハッシュをキーに使う
+_class_labels_digest = hashlib.sha256(json.dumps(_class_labels).encode("utf-8")).hexdigest()[:16] if _class_labels else None
+
+def _sagemaker_cache_params(endpoint: str) -> dict:
+    """結果キャッシュのキーにする設定（送信形式に加え、出力の後処理設定も結果を変えるので含める）"""
+    return {
+        "endpoint": endpoint,
+        "mode": SAGEMAKER_PAYLOAD_MODE,
+        "input_size": SAGEMAKER_INPUT_SIZE,
+        "top_k": SAGEMAKER_TOP_K,
+        "softmax": SAGEMAKER_APPLY_SOFTMAX,
+        "all_scores": SAGEMAKER_INCLUDE_ALL_SCORES,
+        "labels": _class_labels_digest,
+    }
+
+def _sagemaker_tensor_from_image(img: "Image.Image", normalize: bool = True) -> "np.ndarray":
+    """PIL画像を 3x224x224 (CHW) のテンソルに変換。normalize=False なら uint8 のまま返す"""
+    img = img.convert("RGB").resize((SAGEMAKER_INPUT_SIZE, SAGEMAKER_INPUT_SIZE), reducing_gap=2.0)
+    hwc = np.asarray(img, dtype=np.uint8)
+    if normalize:
+        scale, bias = _imagenet_norm()
+        hwc = hwc.astype(np.float32) * scale + bias
+    return np.ascontiguousarray(hwc.transpose(2, 0, 1))
+
+def _encode_sagemaker_payload(batch: "np.ndarray", mode: str):
+    """
+    NCHW テンソルを SageMaker 送信用にエンコードし (body, content_type, custom_attributes) を返す。
+    - json: 従来形式のネストしたリスト（旧エンドポイント互換）
+    - npy: np.save 形式（dtype/shape をヘッダーに含む）
+    - float32 / float16: 生バイト列。dtype と shape は CustomAttributes で伝える
+    - uint8: 正規化前の uint8 テンソルを npy で送る（正規化はエンドポイント側）
+    """
+    if mode == "json":
+        return json.dumps(batch.tolist()).encode("utf-8"), "application/json", None
+    if mode in ("npy", "uint8"):
+        buf = io.BytesIO()
+        np.save(buf, batch, allow_pickle=False)
+        return buf.getvalue(), "application/x-npy", None
+    if mode in ("float32", "float16"):
+        arr = batch.astype(f"<f{2 if mode == 'float16' else 4}", copy=False)
+        shape = ",".join(str(d) for d in arr.shape)
+        return arr.tobytes(), "application/octet-stream", f"dtype={mode};shape={shape}"
+    raise ValueError(f"unknown SageMaker payload mode: {mode}")
+
+def _prepare_sagemaker_payload(img_bytes, mode: Optional[str] = None):
+    """画像を前処理して SageMaker に渡す (body, content_type, custom_attributes) を作成"""
+    mode = (mode or SAGEMAKER_PAYLOAD_MODE).lower()
+    tensor = _as_prepared(img_bytes).sagemaker_tensor(normalize=(mode != "uint8"))
+    return _encode_sagemaker_payload(np.expand_dims(tensor, axis=0), mode)
+
+@_circuit("sagemaker")
+def _invoke_sagemaker(endpoint: str, payload: bytes, content_type: str, custom_attrs: Optional[str]) -> bytes:
+    extra = {"CustomAttributes": custom_attrs} if custom_attrs else {}
+    smr = _get_smr()
+    limiter = _get_limiter("sagemaker", endpoint)
+    try:
+        with limiter.slot():
+            resp = smr.invoke_endpoint(
+                EndpointName=endpoint,
+                ContentType=content_type,
+                Accept="application/json",
+                Body=payload,
+                **extra,
+            )
+    except Exception as exc:
+        _defer_on_throttle(limiter, exc, AZURE_RETRY_BASE_SEC)
+        raise
+    return resp["Body"].read()
+
+def _summarize_sagemaker_body(body: bytes) -> List[dict]:
+    """レスポンス本文を (N, C) 配列にして画像ごとの分類結果（top-k・ラベル付き）にする"""
+    return postprocess.summarize_scores(
+        postprocess.parse_scores(body),
+        k=SAGEMAKER_TOP_K,
+        labels=_class_labels,
+        apply_softmax=SAGEMAKER_APPLY_SOFTMAX,
+        include_all_scores=SAGEMAKER_INCLUDE_ALL_SCORES,
+    )
+
+def call_sagemaker_from_bytes(img_bytes, refresh: bool = False) -> dict:
+    """
+    SageMaker Serverless Endpoint に画像テンソルを投げ、分類結果(JSON)を返す。
+    送信形式は SAGEMAKER_PAYLOAD_MODE（既定: json）で切り替える。
+    """
+    endpoint = os.environ["SAGEMAKER_ENDPOINT_NAME"]
+    prepared = _as_prepared(img_bytes)
+    params = _sagemaker_cache_params(endpoint)
+    return _with_result_cache("sagemaker", prepared.sha256, params, refresh, lambda: _call_sagemaker_single(endpoint, prepared))
+
+def call_sagemaker_from_tensor(tensor: "np.ndarray", refresh: bool = False) -> dict:
+    """前処理済みの 3x224x224 テンソル（パイプライン前処理アーティファクト）で SageMaker を呼び出す"""
+    endpoint = os.environ["SAGEMAKER_ENDPOINT_NAME"]
+    params = _sagemaker_cache_params(endpoint)
+    encoded = _encode_sagemaker_payload(np.expand_dims(tensor, axis=0), SAGEMAKER_PAYLOAD_MODE)
+    digest = hashlib.sha256(tensor.tobytes()).hexdigest()
+    return _with_result_cache("sagemaker", digest, params, refresh, lambda: _call_sagemaker_single(endpoint, encoded=encoded))
+
+def _call_sagemaker_single(endpoint: str, img_bytes=None, encoded: Optional[tuple] = None) -> dict:
+    payload, content_type, custom_attrs = encoded or _prepare_sagemaker_payload(img_bytes)
+    body = _invoke_sagemaker(endpoint, payload, content_type, custom_attrs)
+    try:
+        # 最も高いスコアのクラスと top-k を取得
+        result = _summarize_sagemaker_body(body)[0]
+    except ValueError:
+        try:
+            result = {"raw": json.loads(body.decode("utf-8", errors="ignore"))}
+        except Exception as e:
+            result = {"raw": body.decode("utf-8", errors="ignore"), "error": str(e)}
+    except Exception as e:
+        result = {"raw": body.decode("utf-8", errors="ignore"), "error": str(e)}
+
+    return {
+        "provider": "sagemaker",
+        "endpoint": endpoint,
+        "raw": result,
+    }
+
+def _split_sagemaker_batch(batch: "np.ndarray", mode: str) -> List[tuple]:
+    """
+    NCHW バッチをエンドポイントのペイロード上限(SAGEMAKER_MAX_PAYLOAD_BYTES)に収まるチャンクへ分割し、
+    [(start_index, size, (body, content_type, custom_attributes)), ...] を返す。
+    """
+    chunks = []
+    pending = [(i, batch[i:i + SAGEMAKER_MAX_BATCH]) for i in range(0, len(batch), SAGEMAKER_MAX_BATCH)]
+    while pending:
+        start, part = pending.pop(0)
+        encoded = _encode_sagemaker_payload(part, mode)
+        if len(encoded[0]) <= SAGEMAKER_MAX_PAYLOAD_BYTES:
+            chunks.append((start, len(part), encoded))
+        elif len(part) == 1:
+            raise ValueError(f"single image payload exceeds limit: {len(encoded[0])} bytes (limit {SAGEMAKER_MAX_PAYLOAD_BYTES})")
+        else:
+            # 上限超過時は半分に割って再エンコード
+            half = len(part) // 2
+            pending[:0] = [(start, part[:half]), (start + half, part[half:])]
+    return chunks
+
+def call_sagemaker_batch_from_bytes(images: List[bytes], mode: Optional[str] = None) -> List[dict]:
+    """
+    複数画像を1テンソル(N x 3 x 224 x 224)にまとめて SageMaker を呼び出し、画像ごとの分類結果を返す。
+    - ペイロード上限を超える場合はチャンクに分割して順に呼び出す
+    - 前処理やチャンク呼び出しの失敗は該当画像の {"error": ...} として返す
+    """
+    endpoint = os.environ["SAGEMAKER_ENDPOINT_NAME"]
+    mode = (mode or SAGEMAKER_PAYLOAD_MODE).lower()
+    results: List[Optional[dict]] = [None] * len(images)
+
+    tensors, positions = [], []
+    for i, img_bytes in enumerate(images):
+        try:
+            tensors.append(_as_prepared(img_bytes).sagemaker_tensor(normalize=(mode != "uint8")))
+            positions.append(i)
+        except Exception as e:
+            results[i] = {"provider": "sagemaker", "error": f"preprocess failed: {e}"}
+    if not tensors:
+        return results
+
+    batch = np.stack(tensors)
+    for start, size, (payload, content_type, custom_attrs) in _split_sagemaker_batch(batch, mode):
+        chunk_positions = positions[start:start + size]
+        try:
+            body = _invoke_sagemaker(endpoint, payload, content_type, custom_attrs)
+            summaries = _summarize_sagemaker_body(body)
+            if len(summaries) != len(chunk_positions):
+                raise ValueError(f"unexpected response shape for batch of {len(chunk_positions)}")
+            for pos, summary in zip(chunk_positions, summaries):
+                results[pos] = {"provider": "sagemaker", "endpoint": endpoint, "raw": summary}
+        except Exception as e:
+            log_json(stage="sagemaker_batch", action="chunk_failed", start=start, size=len(chunk_positions), error=str(e))
+            for pos in chunk_positions:
+                results[pos] = {"provider": "sagemaker", "error": str(e)}
+    return results
+
+def _guardrail_kwargs() -> Dict[str, str]:
+    if USE_GUARDRAILS and BEDROCK_GUARDRAIL_ID and BEDROCK_GUARDRAIL_VERSION:
+        return {
+            "guardrailIdentifier": BEDROCK_GUARDRAIL_ID,
+            "guardrailVersion": BEDROCK_GUARDRAIL_VERSION
+        }
+    return {}
+
+# ==== Bedrock呼び出し ====
+_BEDROCK_S3_PROMPT = "画像の内容を短く説明し、3つのタグを日本語で列挙してください。"
+
+def _build_bedrock_payload(img_bytes, media_type: str = "image/jpeg") -> dict:
+    """Step Functions用に Bedrock メッセージボディを生成（画像は縮小 JPEG）"""
+    b64 = _as_prepared(img_bytes).llm_jpeg_b64
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 512,
+        "temperature": 0.2,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": media_type,
+                            "data": b64
+                        }
+                    },
                     {
                         "type": "text",
-                        "text": "画像の内容を短く説明し、3つのタグを日本語で列挙してください。"
+                        "text": _BEDROCK_S3_PROMPT
                     }
                 ]
             }
         ]
     }
 
-def call_bedrock_from_bytes(img_bytes: bytes) -> dict:
+def call_bedrock_from_bytes(img_bytes, refresh: bool = False) -> dict:
     """
     Bedrock Claude 3 Haiku に画像を渡して説明文を生成。
     - 入力: 画像バイナリ
@@ -467,27 +2402,37 @@ def call_bedrock_from_bytes(img_bytes: bytes) -> dict:
     - リトライ: 最大3回、指数バックオフ
     """
     model_id = os.environ.get("BEDROCK_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+    guardrail_opts = _guardrail_kwargs()
+    prepared = _as_prepared(img_bytes)
+    params = {"model": model_id, "prompt": _BEDROCK_S3_PROMPT, "max_tokens": 512, "temperature": 0.2, "guardrail": guardrail_opts, **prepared.cache_params()}
+    return _with_result_cache("bedrock", prepared.sha256, params, refresh, lambda: _invoke_bedrock_with_retry(model_id, prepared, guardrail_opts))
+
+@_circuit("bedrock")
+def _invoke_bedrock_with_retry(model_id: str, img_bytes, guardrail_opts: Dict[str, str]) -> dict:
     brt = _get_bedrock_rt()
     body_payload = _build_bedrock_payload(img_bytes)
-    guardrail_opts = _guardrail_kwargs()
+    limiter = _get_limiter("bedrock", model_id)
+    est_tokens = _estimate_tokens(body_payload["max_tokens"])
 
     max_retries = int(os.getenv("BEDROCK_MAX_RETRIES", "3"))
     last_error = None
 
     for attempt in range(1, max_retries + 1):
         try:
-            resp = brt.invoke_model(
-                modelId=model_id,
-                body=json.dumps(body_payload).encode("utf-8"),
-                contentType="application/json",
-                accept="application/json",
-                **guardrail_opts,
-            )
+            with limiter.slot(est_tokens):
+                resp = brt.invoke_model(
+                    modelId=model_id,
+                    body=json.dumps(body_payload).encode("utf-8"),
+                    contentType="application/json",
+                    accept="application/json",
+                    **guardrail_opts,
+                )
             raw = resp["body"].read().decode("utf-8", errors="ignore")
 
             # 正規化（content[0].text を取り出す）
             try:
                 data = json.loads(raw)
+                limiter.settle(est_tokens, _usage_tokens(data))
                 stop_reason = data.get("stop_reason")
                 if stop_reason and "guardrail" in stop_reason:
                     norm = {"text": "ガードレールにより応答がブロックされました。", "stop_reason": stop_reason}
@@ -508,81 +2453,997 @@ def call_bedrock_from_bytes(img_bytes: bytes) -> dict:
                 "result": norm
             }
 
-        except Exception as e:
-            last_error = e
-            wait = AZURE_RETRY_BASE_SEC * (2 ** (attempt - 1))
-            log_json(stage="bedrock_call", status="retry", attempt=attempt, error=str(e), wait_sec=wait)
-            if attempt < max_retries:
-                time.sleep(wait)
-            else:
-                log_json(stage="bedrock_call", status="exhausted", error=str(e))
-                raise RuntimeError(f"Bedrock call failed after {max_retries} retries: {last_error}")
+        except ProviderThrottled:
+            raise
+        except Exception as e:
+            last_error = e
+            wait = AZURE_RETRY_BASE_SEC * (2 ** (attempt - 1))
+            log_json(stage="bedrock_call", status="retry", attempt=attempt, error=str(e), wait_sec=wait)
+            if attempt < max_retries:
+                # スロットリングは同じモデルへの他リクエストも待たせる（次の slot で待機）
+                if _is_throttle_error(e):
+                    time.sleep(limiter.defer(wait))
+                else:
+                    time.sleep(wait)
+            else:
+                log_json(stage="bedrock_call", status="exhausted", error=str(e))
+                raise RuntimeError(f"Bedrock call failed after {max_retries} retries: {last_error}")
+
+# ==== 実API: Bedrock (Claude 3 Haiku) ====
+def _build_bedrock_real_body(req_id: str) -> dict:
+    """ローカル保存画像を縮小して Bedrock invoke_model のボディを作る（CPU処理）"""
+    img_path = _find_image_path_by_request_id(req_id)
+    b64, mime = _downscale_to_jpeg_b64(img_path)
+
+    system_prompt = (
+        "次の画像を説明してください。出力は必ず有効なJSONのみ、余計な文章は禁止。\n"
+        '{ "caption": "日本語で1〜2文、50文字以内", "tags": ["日本語の単語を最大5個"] }'
+    )
+    user_content = [
+        {"type": "image", "source": {"type": "base64", "media_type": mime, "data": b64}},
+        {"type": "text", "text": "画像を要約し、上記仕様のJSONのみで返してください。"}
+    ]
+
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 400,
+        "temperature": 0.2,
+        "system": system_prompt,
+        "messages": [{"role": "user", "content": user_content}]
+    }
+
+@_circuit("bedrock")
+def _invoke_bedrock_real(body: dict) -> dict:
+    guardrail_opts = _guardrail_kwargs()
+    limiter = _get_limiter("bedrock", BEDROCK_MODEL_ID)
+    est_tokens = _estimate_tokens(body["max_tokens"])
+    try:
+        with limiter.slot(est_tokens):
+            resp = _get_bedrock_rt().invoke_model(
+                modelId=BEDROCK_MODEL_ID,
+                contentType="application/json",
+                accept="application/json",
+                body=json.dumps(body),
+                **guardrail_opts,
+            )
+    except Exception as exc:
+        _defer_on_throttle(limiter, exc, AZURE_RETRY_BASE_SEC)
+        raise
+    out = json.loads(resp["body"].read())
+    limiter.settle(est_tokens, _usage_tokens(out))
+    return out
+
+def call_bedrock_real(req_id: str) -> AnalyzeResponse:
+    body = _build_bedrock_real_body(req_id)
+    t0 = time.time()
+    return _parse_bedrock_real_response(_invoke_bedrock_real(body), t0)
+
+def _parse_bedrock_real_response(out: dict, t0: float) -> AnalyzeResponse:
+    text = ""
+    if out.get("content"):
+        text = out["content"][0]["text"]
+
+    if out.get("stop_reason") and "guardrail" in out["stop_reason"]:
+        payload = {"caption": "Guardrail violation", "tags": ["guardrail"], "stop_reason": out["stop_reason"]}
+    else:
+        parsed = text or json.dumps({"caption": "", "tags": []}, ensure_ascii=False)
+        try:
+            payload = json.loads(parsed)
+        except Exception:
+            s, e = parsed.find("{"), parsed.rfind("}")
+            payload = json.loads(parsed[s:e + 1]) if s != -1 else {"caption": parsed, "tags": []}
+
+    latency = int((time.time() - t0) * 1000)
+    return AnalyzeResponse(
+        provider="aws",
+        model=BEDROCK_MODEL_ID,
+        caption=str(payload.get("caption", "")),
+        tags=list(payload.get("tags", [])),
+        latency_ms=latency,
+        tokens={"input": 0, "output": 0},
+        cost_estimate={"usd": 0.0, "method": "token_based"},
+        raw=out,
+    )
+
+# ==== 非同期アダプター（イベントループをブロックしない） ====
+_cpu_pool = ThreadPoolExecutor(max_workers=CPU_POOL_WORKERS, thread_name_prefix="cpu")
+
+async def _run_cpu(fn, *args):
+    """PIL などの CPU 処理を専用 executor に逃がす"""
+    return await asyncio.get_running_loop().run_in_executor(_cpu_pool, fn, *args)
+
+@_circuit("azure")
+async def call_azure_real_async(req_id: str) -> AnalyzeResponse:
+    """call_azure_real の非同期版（共有 AsyncClient + asyncio.sleep によるバックオフ）"""
+    url, headers, body = await _run_cpu(_build_azure_real_request, req_id)
+
+    client = _get_azure_async_client()
+    limiter = _get_limiter("azure", AZURE_DEPLOY)
+    est_tokens = _estimate_tokens(body["max_tokens"])
+    t0 = time.time()
+    out = None
+    for attempt in range(3):
+        async with limiter.slot_async(est_tokens):
+            resp = await client.post(url, headers=headers, json=body, timeout=60)
+        ra = limiter.observe(resp.headers)
+        if resp.status_code == 429:
+            wait = ra if ra is not None else (2 * (attempt + 1))
+            print(f"[Azure 429] retry in {wait}s (attempt {attempt+1}/3)")
+            await asyncio.sleep(limiter.defer(wait))
+            continue
+        if not resp.is_success:
+            print("AZURE ERROR", resp.status_code, resp.text[:300])
+            resp.raise_for_status()
+        out = resp.json()
+        limiter.settle(est_tokens, _usage_tokens(out))
+        break
+    if out is None:
+        resp.raise_for_status()
+    return _parse_azure_real_response(out, t0)
+
+async def call_bedrock_real_async(req_id: str) -> AnalyzeResponse:
+    """call_bedrock_real の非同期版（boto3 はブロッキングのためスレッドへオフロード）"""
+    body = await _run_cpu(_build_bedrock_real_body, req_id)
+    t0 = time.time()
+    out = await asyncio.to_thread(_invoke_bedrock_real, body)
+    return _parse_bedrock_real_response(out, t0)
+
+# ==== Bedrock ストリーミング（SSE） ====
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _iter_bedrock_stream(body: dict):
+    """
+    invoke_model_with_response_stream のイベントを非同期に1件ずつ返す。
+    boto3 のイベントストリームはブロッキングなので、読み取りはスレッドで行いキュー経由で受け取る。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        limiter = _get_limiter("bedrock", BEDROCK_MODEL_ID)
+        try:
+            with _circuit_breakers["bedrock"].guard(), limiter.slot(_estimate_tokens(body["max_tokens"])):
+                resp = _get_bedrock_rt().invoke_model_with_response_stream(
+                    modelId=BEDROCK_MODEL_ID,
+                    contentType="application/json",
+                    accept="application/json",
+                    body=json.dumps(body),
+                    **_guardrail_kwargs(),
+                )
+                for event in resp["body"]:
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+        except Exception as exc:
+            _defer_on_throttle(limiter, exc, AZURE_RETRY_BASE_SEC)
+            loop.call_soon_threadsafe(queue.put_nowait, exc)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    loop.run_in_executor(None, produce)
+    while True:
+        item = await queue.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+async def _mock_bedrock_stream():
+    """USE_REAL=0 用: モック応答を Bedrock のストリームイベント形式で返す"""
+    mock = _mock_result("aws", "bedrock-claude-3-haiku")
+    text = json.dumps({"caption": mock.caption, "tags": mock.tags}, ensure_ascii=False)
+    chunks = [{"type": "message_start", "message": {"usage": {"input_tokens": mock.tokens["input"]}}}]
+    chunks += [{"type": "content_block_delta", "delta": {"type": "text_delta", "text": text[i:i + 8]}} for i in range(0, len(text), 8)]
+    chunks.append({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": mock.tokens["output"]}})
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield {"chunk": {"bytes": json.dumps(chunk, ensure_ascii=False).encode("utf-8")}}
+
+async def stream_bedrock_real(req: AnalyzeRequest):
+    """
+    Bedrock の応答を SSE で逐次返す。
+    - event: delta   … テキスト断片 {"text": "..."}
+    - event: guardrail … ガードレール介入（以降の断片は破棄）
+    - event: result  … 最終的な AnalyzeResponse（raw.stream_metrics に TTFT / tokens/sec）
+    - event: error   … ストリーム途中の失敗
+    """
+    t0 = time.time()
+    success = True
+    text, stop_reason, guardrail_action = "", None, None
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    ttft_ms = None
+    try:
+        if USE_REAL:
+            body = await _run_cpu(_build_bedrock_real_body, req.request_id)
+            events = _iter_bedrock_stream(body)
+        else:
+            events = _mock_bedrock_stream()
+
+        async for event in events:
+            if "chunk" not in event:
+                # modelStreamErrorException / throttlingException などはストリーム内で返る
+                name = next(iter(event), "unknown")
+                raise RuntimeError(f"bedrock stream error: {name}: {event.get(name)}")
+            chunk = json.loads(event["chunk"]["bytes"])
+            if chunk.get("amazon-bedrock-guardrailAction") == "INTERVENED":
+                guardrail_action = "INTERVENED"
+            ctype = chunk.get("type")
+            if ctype == "message_start":
+                usage["input_tokens"] = chunk.get("message", {}).get("usage", {}).get("input_tokens", 0)
+            elif ctype == "content_block_delta" and not guardrail_action:
+                delta = chunk.get("delta", {}).get("text", "")
+                if delta:
+                    if ttft_ms is None:
+                        ttft_ms = int((time.time() - t0) * 1000)
+                    text += delta
+                    yield _sse("delta", {"text": delta})
+            elif ctype == "message_delta":
+                stop_reason = chunk.get("delta", {}).get("stop_reason") or stop_reason
+                usage["output_tokens"] = chunk.get("usage", {}).get("output_tokens", usage["output_tokens"])
+            if guardrail_action or (stop_reason and "guardrail" in stop_reason):
+                stop_reason = stop_reason or "guardrail_intervened"
+                yield _sse("guardrail", {"stop_reason": stop_reason})
+                break
+
+        out = {"content": [{"type": "text", "text": text}] if text else [], "stop_reason": stop_reason, "usage": usage}
+        res = _parse_bedrock_real_response(out, t0)
+        if not USE_REAL:
+            res.model = "bedrock-claude-3-haiku"
+        elapsed = max(time.time() - t0 - (ttft_ms or 0) / 1000, 1e-6)
+        tokens_per_sec = round(usage["output_tokens"] / elapsed, 2) if usage["output_tokens"] else 0.0
+        res.tokens = {"input": usage["input_tokens"], "output": usage["output_tokens"]}
+        res.raw = {**out, "stream_metrics": {"ttft_ms": ttft_ms, "tokens_per_sec": tokens_per_sec, "latency_ms": res.latency_ms}}
+        _record_stream_metrics("analyze_aws_stream", ttft_ms or res.latency_ms, tokens_per_sec)
+        _log_csv({
+            "request_id": req.request_id,
+            "policy": req.model_preset or "cheap",
+            "provider": "aws",
+            "model": res.model,
+            "latency_ms": res.latency_ms,
+            "cost_usd": res.cost_estimate["usd"]
+        })
+        yield _sse("result", res.model_dump())
+    except Exception as exc:
+        success = False
+        log_json(stage="analyze_aws_stream", action="stream_failed", request_id=req.request_id, error=str(exc))
+        yield _sse("error", {"error": str(exc)})
+    finally:
+        _record_latency("analyze_aws_stream", t0, success)
+
+# ==== プロバイダー並列実行 ====
+_provider_pool = ThreadPoolExecutor(max_workers=PROVIDER_MAX_WORKERS, thread_name_prefix="provider")
+
+def _enabled_providers() -> List[str]:
+    """USE_AZURE / USE_SAGEMAKER / USE_BEDROCK で有効なプロバイダーを従来の順序で返す"""
+    flags = [("azure", "USE_AZURE"), ("sagemaker", "USE_SAGEMAKER"), ("bedrock", "USE_BEDROCK")]
+    return [name for name, env in flags if os.environ.get(env, "0") == "1"]
+
+def _provider_call(provider: str):
+    return {
+        "azure": call_azure_from_bytes,
+        "sagemaker": call_sagemaker_from_bytes,
+        "bedrock": call_bedrock_from_bytes,
+    }[provider]
+
+def _run_providers(img_bytes, providers: List[str], stage: str = "analyze_s3", refresh: bool = False) -> List[dict]:
+    """
+    有効なプロバイダーを呼び出し、{"provider", "result"|"error"} のリストを providers の順で返す。
+    - parallel: スレッドプールで同時実行し、プロバイダーごとの期限(PROVIDER_DEADLINE_SEC)で打ち切る
+    - sequential: 従来どおり1件ずつ実行
+    - refresh=True で結果キャッシュを参照せずに再推論する
+    画像は PreparedImage にまとめ、デコード・縮小・base64 化を全プロバイダーで共有する。
+    """
+    img_bytes = _as_prepared(img_bytes)
+    if ANALYZE_FANOUT_MODE != "parallel" or len(providers) <= 1:
+        results = []
+        for name in providers:
+            try:
+                results.append({"provider": name, "result": _provider_call(name)(img_bytes, refresh=refresh)})
+            except Exception as e:
+                log_json(stage=stage, action=f"{name}_failed", error=str(e))
+                results.append({"provider": name, "error": str(e)})
+        return results
+
+    started = time.time()
+    futures = {name: _provider_pool.submit(_provider_call(name), img_bytes, refresh=refresh) for name in providers}
+    by_provider = {}
+    # 期限の短いものから待つことで、各プロバイダーの期限を開始時刻基準で守る
+    for name in sorted(providers, key=lambda n: PROVIDER_DEADLINE_SEC.get(n, REQUEST_TIMEOUT_TOTAL)):
+        deadline = PROVIDER_DEADLINE_SEC.get(name, REQUEST_TIMEOUT_TOTAL)
+        remaining = max(0.0, deadline - (time.time() - started))
+        try:
+            by_provider[name] = {"provider": name, "result": futures[name].result(timeout=remaining)}
+        except FutureTimeoutError:
+            # 実行中のスレッドは止められないため、結果を待たずに打ち切る
+            futures[name].cancel()
+            error = f"{name} deadline exceeded ({deadline:.1f}s)"
+            log_json(stage=stage, action=f"{name}_failed", error=error)
+            by_provider[name] = {"provider": name, "error": error}
+        except Exception as e:
+            log_json(stage=stage, action=f"{name}_failed", error=str(e))
+            by_provider[name] = {"provider": name, "error": str(e)}
+    return [by_provider[name] for name in providers]
+
+# ==== 適応ルーター（レイテンシ・エラー率・429率に基づくプリセット選択） ====
+class _PresetStats:
+    """
+    プリセット単位のスライディングウィンドウ（件数・時間の両方で制限）と EWMA レイテンシ。
+    censored はヘッジで負けてキャンセルされた呼び出し（実際のレイテンシは latency_ms 以上）。
+    パーセンタイルには下限値として含め（遅い呼び出しほど取り消されるため、除くと p95 が低く偏る）、EWMA には含めない。
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=ROUTER_WINDOW_SIZE)  # (ts, latency_ms, ok, throttled, censored)
+        self.ewma_ms: Optional[float] = None
+
+    def record(self, latency_ms: int, ok: bool, throttled: bool, censored: bool = False) -> None:
+        self.samples.append((time.time(), latency_ms, ok, throttled, censored))
+        if ok and not censored:
+            self.ewma_ms = latency_ms if self.ewma_ms is None else (
+                ROUTER_EWMA_ALPHA * latency_ms + (1 - ROUTER_EWMA_ALPHA) * self.ewma_ms
+            )
+
+    def summary(self) -> dict:
+        horizon = time.time() - ROUTER_WINDOW_SEC
+        recent = [x for x in self.samples if x[0] >= horizon]
+        latencies = np.array([x[1] for x in recent if x[2]], dtype=np.float64)
+        n = len(recent)
+        pct = (lambda q: float(np.percentile(latencies, q))) if latencies.size else (lambda q: None)
+        return {
+            "samples": n,
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "ewma_ms": self.ewma_ms,
+            "error_rate": (sum(1 for x in recent if not x[2]) / n) if n else 0.0,
+            "throttle_rate": (sum(1 for x in recent if x[3]) / n) if n else 0.0,
+            "censored": sum(1 for x in recent if x[4]),
+        }
+
+class AdaptiveRouter:
+    def __init__(self):
+        self._stats: Dict[str, _PresetStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, preset: str, latency_ms: int, ok: bool, throttled: bool = False, censored: bool = False) -> None:
+        with self._lock:
+            self._stats.setdefault(preset, _PresetStats()).record(latency_ms, ok, throttled, censored)
+
+    def summary(self, preset: str) -> dict:
+        with self._lock:
+            stats = self._stats.get(preset)
+            return stats.summary() if stats else _PresetStats().summary()
+
+    def latency_percentile(self, preset: str, q: float) -> Optional[float]:
+        """成功レイテンシ（ヘッジで取り消された呼び出しは経過時間を下限値として含む）の q パーセンタイル（サンプル不足なら None）"""
+        horizon = time.time() - ROUTER_WINDOW_SEC
+        with self._lock:
+            stats = self._stats.get(preset)
+            latencies = [x[1] for x in stats.samples if x[0] >= horizon and x[2]] if stats else []
+        if len(latencies) < ROUTER_MIN_SAMPLES:
+            return None
+        return float(np.percentile(latencies, q))
+
+    def is_degraded(self, summary: dict) -> bool:
+        if summary["samples"] < ROUTER_MIN_SAMPLES:
+            return False
+        return summary["error_rate"] > ROUTER_MAX_ERROR_RATE or summary["throttle_rate"] > ROUTER_MAX_THROTTLE_RATE
+
+    def candidates(self, policy: str, slo_ms: Optional[int] = None) -> List[tuple]:
+        """
+        試行順に [(preset, reason), ...] を返す。
+        - cost / quality: ポリシーの優先順。latency: 直近 p95 の小さい順
+        - 劣化中（エラー率・429率が閾値超過）のプリセットは後ろに回す
+        - slo_ms 指定時は p95 が SLO を満たすプリセットを優先（サンプル不足は満たすとみなす）
+        """
+        order = [MODEL_PRESET_QUALITY, MODEL_PRESET_COST] if policy == "quality" else [MODEL_PRESET_COST, MODEL_PRESET_QUALITY]
+        order = list(dict.fromkeys(order))
+        summaries = {p: self.summary(p) for p in order}
+
+        def p95(preset):
+            value = summaries[preset]["p95_ms"]
+            return value if value is not None and summaries[preset]["samples"] >= ROUTER_MIN_SAMPLES else 0.0
+
+        if policy == "latency":
+            order.sort(key=p95)
+
+        def meets_slo(preset):
+            return slo_ms is None or p95(preset) <= slo_ms
+
+        ranked = sorted(order, key=lambda p: (self.is_degraded(summaries[p]), not meets_slo(p)))
+        result = []
+        for preset in ranked:
+            s = summaries[preset]
+            notes = [f"policy={policy}"]
+            if slo_ms is not None:
+                notes.append(f"p95={p95(preset):.0f}ms {'<=' if meets_slo(preset) else '>'} SLO {slo_ms}ms")
+            if self.is_degraded(s):
+                notes.append(f"劣化中(error={s['error_rate']:.0%}, 429={s['throttle_rate']:.0%})")
+            if preset != order[0] and not result:
+                primary = summaries[order[0]]
+                why = "劣化" if self.is_degraded(primary) else "SLO未達"
+                notes.append(f"{order[0].split(':', 1)[0]} が{why}のため切替")
+            result.append((preset, ", ".join(notes)))
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            presets = list(self._stats)
+        return {
+            "presets": {p: {**self.summary(p), "degraded": self.is_degraded(self.summary(p))} for p in presets},
+            "config": {
+                "window_size": ROUTER_WINDOW_SIZE,
+                "window_sec": ROUTER_WINDOW_SEC,
+                "ewma_alpha": ROUTER_EWMA_ALPHA,
+                "min_samples": ROUTER_MIN_SAMPLES,
+                "max_error_rate": ROUTER_MAX_ERROR_RATE,
+                "max_throttle_rate": ROUTER_MAX_THROTTLE_RATE,
+            },
+        }
+
+router = AdaptiveRouter()
+
+def _is_throttle_error(exc: Exception) -> bool:
+    """HTTP 429（requests / httpx）や Bedrock の ThrottlingException、クライアント側の打ち切りを判定"""
+    if isinstance(exc, ProviderThrottled):
+        return True
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        return code in ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException")
+    return getattr(response, "status_code", None) == 429
+
+# ==== ヘッジリクエスト（テールレイテンシ対策） ====
+class _HedgeBudget:
+    """リクエストごとに ratio 分の枠が貯まり（上限 max_tokens）、ヘッジ1回で1枠消費する"""
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+_hedge_budget = _HedgeBudget(ROUTE_HEDGE_BUDGET_RATIO, ROUTE_HEDGE_BUDGET_MAX)
+_hedge_counters = {"requests": 0, "hedged": 0, "backup_wins": 0, "primary_wins": 0, "budget_denied": 0, "failovers": 0}
+
+def _hedge_snapshot() -> dict:
+    c = dict(_hedge_counters)
+    return {
+        **c,
+        "hedge_rate": c["hedged"] / c["requests"] if c["requests"] else 0.0,
+        "backup_win_rate": c["backup_wins"] / c["hedged"] if c["hedged"] else 0.0,
+        "budget_tokens": round(_hedge_budget.tokens, 2),
+        "config": {
+            "enabled": ROUTE_HEDGE_ENABLED,
+            "percentile": ROUTE_HEDGE_PERCENTILE,
+            "default_delay_ms": ROUTE_HEDGE_DELAY_MS,
+            "min_delay_ms": ROUTE_HEDGE_MIN_DELAY_MS,
+            "budget_ratio": ROUTE_HEDGE_BUDGET_RATIO,
+            "budget_max": ROUTE_HEDGE_BUDGET_MAX,
+        },
+    }
+
+def _hedge_delay_sec(preset: str) -> float:
+    """プライマリの直近 ROUTE_HEDGE_PERCENTILE パーセンタイルをヘッジ発火までの待ち時間にする"""
+    delay_ms = router.latency_percentile(preset, ROUTE_HEDGE_PERCENTILE)
+    if delay_ms is None:
+        delay_ms = ROUTE_HEDGE_DELAY_MS
+    return max(delay_ms, ROUTE_HEDGE_MIN_DELAY_MS) / 1000
+
+def _parse_preset(preset: str):
+    """"provider:model" の形式をパース"""
+    try:
+        provider, model = preset.split(":", 1)
+    except ValueError:
+        raise HTTPException(status_code=500, detail=f"Invalid preset format: {preset}")
+    return provider, model
+
+async def _call_preset(preset: str, request_id: str) -> AnalyzeResponse:
+    """プリセットのプロバイダーを呼び出し、結果をルーターの統計に記録する"""
+    provider, model = _parse_preset(preset)
+    started = time.time()
+    try:
+        if provider == "azure":
+            result = await call_azure_real_async(request_id) if USE_REAL else _mock_result("azure", model)
+        elif provider == "aws":
+            result = await call_bedrock_real_async(request_id) if USE_REAL else _mock_result("aws", model)
+        else:
+            raise HTTPException(status_code=500, detail=f"Unknown provider: {provider}")
+    except (HTTPException, FileNotFoundError):
+        raise
+    except asyncio.CancelledError:
+        # ヘッジで負けて取り消された: 経過時間を打ち切りサンプル（レイテンシの下限）として残す
+        router.record(preset, int((time.time() - started) * 1000), ok=True, censored=True)
+        raise
+    except Exception as exc:
+        router.record(preset, int((time.time() - started) * 1000), ok=False, throttled=_is_throttle_error(exc))
+        log_json(stage="route", action="provider_failed", preset=preset, error=str(exc))
+        raise
+    router.record(preset, int((time.time() - started) * 1000), ok=True)
+    return result
+
+async def _hedged_call(primary: str, backup: str, request_id: str):
+    """
+    primary を呼び、_hedge_delay_sec 以内に応答がなければ（予算内で）backup にも投げる。
+    先に成功した方を採用し、残りはキャンセルする（スレッド実行中の呼び出しは結果を捨てる）。
+    primary が先に失敗した場合は予算を使わずに backup へフェイルオーバーする。
+    戻り値: (採用プリセット, 結果, 補足メモ)
+    """
+    loop = asyncio.get_running_loop()
+    _hedge_counters["requests"] += 1
+    _hedge_budget.deposit()
+    delay = _hedge_delay_sec(primary)
+    hedge_at = loop.time() + delay
+
+    tasks = {asyncio.create_task(_call_preset(primary, request_id)): primary}
+    pending = set(tasks)
+    backup_started = hedge_decided = hedged = False
+    errors = []
+    try:
+        while pending:
+            timeout = None if hedge_decided else max(0.0, hedge_at - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_decided = True
+                if _hedge_budget.try_spend():
+                    hedged = backup_started = True
+                    _hedge_counters["hedged"] += 1
+                    log_json(stage="route", action="hedge", primary=primary, backup=backup, delay_ms=int(delay * 1000))
+                    task = asyncio.create_task(_call_preset(backup, request_id))
+                    tasks[task] = backup
+                    pending.add(task)
+                else:
+                    _hedge_counters["budget_denied"] += 1
+                continue
+
+            for task in done:
+                exc = task.exception()
+                if exc is None:
+                    winner = tasks[task]
+                    note = ""
+                    if hedged:
+                        won = "backup_wins" if winner == backup else "primary_wins"
+                        _hedge_counters[won] += 1
+                        note = f"ヘッジ({int(delay * 1000)}ms)で{'バックアップ' if winner == backup else 'プライマリ'}が先着"
+                    elif errors:
+                        note = f"{primary.split(':', 1)[0]} 失敗のためフェイルオーバー"
+                    return winner, task.result(), note
+                if isinstance(exc, (HTTPException, FileNotFoundError)):
+                    raise exc
+                errors.append(exc)
+
+            if not pending and not backup_started:
+                backup_started = hedge_decided = True
+                _hedge_counters["failovers"] += 1
+                task = asyncio.create_task(_call_preset(backup, request_id))
+                tasks[task] = backup
+                pending.add(task)
+        raise errors[-1]
+    finally:
+        for task in pending:
+            task.cancel()
+
+# ==== 一括解析ジョブ（キー一覧 / S3 プレフィックス、チャンク単位で再開可能） ====
+# テーブル上のレイアウト:
+#   job#<id>           メタ情報（状態・件数・完了チャンク chunks_done）
+#   job#<id>#keys#<n>  n 番目のチャンクの S3 キー
+#   job#<id>#item#<i>  i 番目のキーの結果（_compact_result_item の形式。旧形式は results_json）
+# 実行権はメタの job_status / run_id を条件付き更新で取る（queued -> running）。
+# 実行中のメタ更新はすべて run_id を条件にし、実行権が他に移った実行はそこで止まる。
+_job_pool = ThreadPoolExecutor(max_workers=BULK_JOB_MAX_RUNNING, thread_name_prefix="job")
+_running_jobs: Dict[str, "_BulkJob"] = {}
+
+class _JobSuperseded(RuntimeError):
+    """このジョブの実行権（run_id）が他の実行に移った"""
+
+def _update_job_run(job_id: str, run_id: str, expression: str, values: dict) -> None:
+    """実行権を持っている間だけメタを更新する（run_id が変わっていれば _JobSuperseded）"""
+    try:
+        ddb.update_item(
+            Key={"request_id": f"job#{job_id}"},
+            UpdateExpression=expression,
+            ConditionExpression="run_id = :run",
+            ExpressionAttributeValues={**values, ":run": run_id},
+        )
+    except Exception as exc:
+        if _client_error_code(exc) == "ConditionalCheckFailedException":
+            raise _JobSuperseded(run_id) from exc
+        raise
+
+def _make_type_deserializer():
+    from boto3.dynamodb.types import TypeDeserializer
+    return TypeDeserializer()
+
+_deserializer = _LazyInit("TypeDeserializer", _make_type_deserializer)
+
+def _list_s3_keys(prefix: str, limit: int) -> List[str]:
+    """プレフィックス配下のオブジェクトキー（フォルダ・派生アーティファクト・結果の生データは除く）。limit を超えたら打ち切る"""
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_UPLOAD_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith("/") or key.startswith((PIPELINE_ARTIFACT_PREFIX, RESULT_RAW_S3_PREFIX)):
+                continue
+            keys.append(key)
+            if len(keys) > limit:
+                return keys
+    return keys
+
+def _batch_get_items(ids: List[str]) -> Dict[str, dict]:
+    """request_id のリストを BatchGetItem（100件ずつ、未処理分は再試行）で取得"""
+    found = {}
+    for i in range(0, len(ids), 100):
+        request = {DDB_TABLE: {"Keys": [{"request_id": {"S": rid}} for rid in ids[i:i + 100]]}}
+        for _ in range(5):
+            resp = ddb.meta.client.batch_get_item(RequestItems=request)
+            for raw in resp.get("Responses", {}).get(DDB_TABLE, []):
+                item = {k: _deserializer.deserialize(v) for k, v in raw.items()}
+                found[item["request_id"]] = item
+            request = resp.get("UnprocessedKeys") or {}
+            if not request:
+                break
+    return found
+
+def _load_job_keys(job_id: str, chunk_count: int) -> List[str]:
+    ids = [f"job#{job_id}#keys#{n}" for n in range(chunk_count)]
+    items = _batch_get_items(ids)
+    keys = []
+    for rid in ids:
+        if rid not in items:
+            raise HTTPException(status_code=500, detail=f"job key list is incomplete: {rid}")
+        keys.extend(items[rid]["s3_keys"])
+    return keys
+
+class _BulkJob:
+    """
+    1ジョブ分の実行。BULK_JOB_WORKERS 件ずつ並行に処理し、プロバイダー呼び出しは
+    BULK_JOB_PROVIDER_CONCURRENCY のセマフォで同時実行数を抑える。
+    チャンクが終わるごとに batch_writer で結果を書き、メタの chunks_done に記録する（再開時はスキップ）。
+    Lambda の残り時間が足りなくなればチャンクの途中でも新しい画像を始めず、終わった分だけ書いて引き継ぐ
+    （次の実行は書き込み済みの画像を飛ばしてそのチャンクを続ける）。
+    """
+
+    def __init__(self, job_id: str, run_id: str, keys: List[str], providers: List[str], refresh: bool, chunks_done=()):
+        self.job_id = job_id
+        self.run_id = run_id
+        self.keys = keys
+        self.providers = providers
+        self.refresh = refresh
+        self.chunks_done = {int(n) for n in chunks_done}
+        self.processed = 0  # この実行で処理した件数（スループット計算用）
+        self.slowest = 0.0  # この実行での1件あたりの最長所要時間（秒）
+        self.started = time.time()
+        self._semaphores = {name: threading.BoundedSemaphore(max(1, BULK_JOB_PROVIDER_CONCURRENCY.get(name, 1))) for name in providers}
+
+    def _update_meta(self, expression: str, values: dict) -> None:
+        _update_job_run(self.job_id, self.run_id, expression, values)
+
+    def _analyze(self, index: int, key: str) -> dict:
+        t0 = time.time()
+        results = []
+        try:
+            prepared = PreparedImage(_read_image_from_s3(key))
+        except Exception as e:
+            log_json(stage="bulk_job", action="s3_get_failed", job_id=self.job_id, s3_key=key, error=str(e))
+            results = [{"provider": name, "error": "failed to fetch object from S3"} for name in self.providers]
+        else:
+            for name in self.providers:
+                with self._semaphores[name]:
+                    try:
+                        results.append({"provider": name, "result": _provider_call(name)(prepared, refresh=self.refresh)})
+                    except Exception as e:
+                        results.append({"provider": name, "error": str(e)})
+
+        ok = sum(1 for r in results if "result" in r)
+        now = int(time.time())
+        # 結果は /api/s3/analyze と同じ形式（compact: 要約 + gzip、大きければ S3）で持ち、アイテム上限(400KB)を避ける
+        item = _compact_result_item({
+            "request_id": f"job#{self.job_id}#item#{index}",
+            "s3_key": key,
+            "item_status": "ok" if ok == len(results) else ("partial" if ok else "error"),
+            "results": results,
+            "created_at": now,
+            "expire_at": now + BULK_JOB_TTL_SEC,
+        })
+        self.slowest = max(self.slowest, time.time() - t0)
+        return item
+
+    def _out_of_time(self, remaining, started_any: bool) -> bool:
+        """今から1件始めても制限時間内に終わらない見込みか（1回の実行で最低1件は進める）"""
+        return remaining is not None and started_any and remaining() < self.slowest + BULK_JOB_RESERVE_SEC
+
+    def _process(self, pool, indices, remaining):
+        """indices の画像を並行に処理し (結果アイテム, 時間切れで打ち切ったか) を返す"""
+        items, running, stopped = [], {}, False
+        todo = iter(indices)
+        while True:
+            while not stopped and len(running) < BULK_JOB_WORKERS:
+                index = next(todo, None)
+                if index is None:
+                    break
+                if self._out_of_time(remaining, bool(self.processed or items or running)):
+                    stopped = True
+                    break
+                running[pool.submit(self._analyze, index, self.keys[index])] = index
+            if not running:
+                return items, stopped
+            done, _ = futures_wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                items.append(future.result())
+
+    def _checkpoint(self, n: int, items: List[dict], chunk_done: bool) -> None:
+        """結果を書き、件数（とチャンク完了）をメタに記録する"""
+        with ddb.batch_writer() as writer:
+            for item in items:
+                writer.put_item(Item=_to_dynamo(item))
+        succeeded = sum(1 for item in items if item["item_status"] != "error")
+        values = {":ok": succeeded, ":ng": len(items) - succeeded, ":c": len(items), ":t": int(time.time())}
+        if chunk_done:
+            self._update_meta("ADD chunks_done :n, succeeded :ok, failed :ng, run_processed :c SET updated_at = :t", {**values, ":n": {n}})
+            self.chunks_done.add(n)
+        else:
+            self._update_meta("ADD succeeded :ok, failed :ng, run_processed :c SET updated_at = :t", values)
+        self.processed += len(items)
+
+    def _written_indices(self, indices) -> set:
+        """前の実行が途中まで書いたチャンクの、書き込み済みの画像番号"""
+        found = _batch_get_items([f"job#{self.job_id}#item#{i}" for i in indices])
+        return {i for i in indices if f"job#{self.job_id}#item#{i}" in found}
 
-# ==== 実API: Bedrock (Claude 3 Haiku) ====
-def call_bedrock_real(req_id: str) -> AnalyzeResponse:
-    img_path = _find_image_path_by_request_id(req_id)
-    b64, mime = _downscale_to_jpeg_b64(img_path)
+    def run(self, remaining=None) -> str:
+        """
+        未完了のチャンクを順に処理し、最終的な状態を返す。
+        remaining（残り秒数を返す関数）があれば、残りが「1件の最長所要時間 + BULK_JOB_RESERVE_SEC」を切った時点で
+        新しい画像を始めずに終わった分を書き、queued に戻して次の起動に引き継ぐ。
+        """
+        log_json(stage="bulk_job", action="start", job_id=self.job_id, run_id=self.run_id,
+                 total=len(self.keys), skipped_chunks=len(self.chunks_done))
+        first_chunk = True
+        try:
+            with ThreadPoolExecutor(max_workers=BULK_JOB_WORKERS, thread_name_prefix=f"{self.job_id}") as pool:
+                for start in range(0, len(self.keys), BULK_JOB_CHUNK_SIZE):
+                    n = start // BULK_JOB_CHUNK_SIZE
+                    if n in self.chunks_done:
+                        continue
+                    indices = range(start, min(start + BULK_JOB_CHUNK_SIZE, len(self.keys)))
+                    if first_chunk:
+                        # 途中まで書かれている可能性があるのは、この実行で最初に扱う未完了チャンクだけ
+                        written = self._written_indices(indices)
+                        indices = [i for i in indices if i not in written]
+                        first_chunk = False
+                    items, stopped = self._process(pool, indices, remaining)
+                    self._checkpoint(n, items, chunk_done=not stopped)
+                    if stopped:
+                        return self._continue_later()
+            self._update_meta("SET job_status = :s, updated_at = :t REMOVE run_id", {":s": "completed", ":t": int(time.time())})
+            log_json(stage="bulk_job", action="done", job_id=self.job_id, processed=self.processed,
+                     rt_ms=round((time.time() - self.started) * 1000))
+            return "completed"
+        except _JobSuperseded:
+            log_json(stage="bulk_job", action="superseded", job_id=self.job_id, run_id=self.run_id, processed=self.processed)
+            return "superseded"
+        except Exception as exc:
+            log_json(stage="bulk_job", action="failed", job_id=self.job_id, error=str(exc))
+            try:
+                self._update_meta("SET job_status = :s, job_error = :e, updated_at = :t REMOVE run_id",
+                                  {":s": "failed", ":e": str(exc), ":t": int(time.time())})
+            except Exception as meta_exc:
+                log_json(stage="bulk_job", action="meta_update_failed", job_id=self.job_id, error=str(meta_exc))
+            return "failed"
 
-    system_prompt = (
-        "次の画像を説明してください。出力は必ず有効なJSONのみ、余計な文章は禁止。\n"
-        '{ "caption": "日本語で1〜2文、50文字以内", "tags": ["日本語の単語を最大5個"] }'
-    )
-    user_content = [
-        {"type": "image", "source": {"type": "base64", "media_type": mime, "data": b64}},
-        {"type": "text", "text": "画像を要約し、上記仕様のJSONのみで返してください。"}
-    ]
+    def _continue_later(self) -> str:
+        self._update_meta("SET job_status = :s, updated_at = :t REMOVE run_id", {":s": "queued", ":t": int(time.time())})
+        log_json(stage="bulk_job", action="continued", job_id=self.job_id, processed=self.processed,
+                 chunks_done=len(self.chunks_done))
+        try:
+            _dispatch_job(self.job_id)
+        except Exception as exc:
+            # queued のまま更新が止まるので、BULK_JOB_STALE_SEC 経過後に interrupted として再開できる
+            log_json(stage="bulk_job", action="continue_dispatch_failed", job_id=self.job_id, error=str(exc))
+        return "queued"
 
-    client = boto3.client("bedrock-runtime", region_name=AWS_REGION)
-    body = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 400,
-        "temperature": 0.2,
-        "system": system_prompt,
-        "messages": [{"role": "user", "content": user_content}]
-    }
+def _claim_job_run(job_id: str) -> Optional[str]:
+    """queued のジョブの実行権を取り、run_id を返す（他の実行が先に取っていれば None）"""
+    run_id = uuid.uuid4().hex
+    now = int(time.time())
+    try:
+        ddb.update_item(
+            Key={"request_id": f"job#{job_id}"},
+            UpdateExpression="SET job_status = :running, run_id = :run, run_started_at = :t, updated_at = :t, run_processed = :z REMOVE job_error",
+            ConditionExpression="job_status = :queued",
+            ExpressionAttributeValues={":running": "running", ":queued": "queued", ":run": run_id, ":t": now, ":z": 0},
+        )
+    except Exception as exc:
+        if _client_error_code(exc) == "ConditionalCheckFailedException":
+            return None
+        raise
+    return run_id
 
-    t0 = time.time()
-    guardrail_opts = _guardrail_kwargs()
-    resp = client.invoke_model(
-        modelId=BEDROCK_MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps(body),
-        **guardrail_opts,
-    )
-    out = json.loads(resp["body"].read())
-    text = ""
-    if out.get("content"):
-        text = out["content"][0]["text"]
+def _requeue_job(job_id: str) -> bool:
+    """
+    失敗したジョブ、または更新が BULK_JOB_STALE_SEC 止まっている queued / running のジョブを queued に戻す。
+    同時に来た再開要求のうち1つだけが成功する（戻した後の実行権は _claim_job_run で1つの実行だけが取る）。
+    """
+    now = int(time.time())
+    try:
+        ddb.update_item(
+            Key={"request_id": f"job#{job_id}"},
+            UpdateExpression="SET job_status = :queued, updated_at = :t REMOVE run_id",
+            ConditionExpression="job_status = :failed OR (job_status IN (:queued, :running) AND updated_at < :stale)",
+            ExpressionAttributeValues={
+                ":queued": "queued", ":running": "running", ":failed": "failed",
+                ":t": now, ":stale": now - BULK_JOB_STALE_SEC,
+            },
+        )
+    except Exception as exc:
+        if _client_error_code(exc) == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
 
-    if out.get("stop_reason") and "guardrail" in out["stop_reason"]:
-        payload = {"caption": "Guardrail violation", "tags": ["guardrail"], "stop_reason": out["stop_reason"]}
+def _dispatch_job(job_id: str) -> None:
+    """
+    queued のジョブを実行に回す。BULK_JOB_FUNCTION_NAME があれば Lambda を非同期起動（InvocationType=Event）し、
+    応答後に凍結されるリクエスト処理環境のスレッドには載せない。
+    """
+    if BULK_JOB_FUNCTION_NAME:
+        lambda_client.invoke(
+            FunctionName=BULK_JOB_FUNCTION_NAME,
+            InvocationType="Event",
+            Payload=json.dumps({"bulk_job": {"job_id": job_id}}).encode("utf-8"),
+        )
     else:
-        parsed = text or json.dumps({"caption": "", "tags": []}, ensure_ascii=False)
-        try:
-            payload = json.loads(parsed)
-        except Exception:
-            s, e = parsed.find("{"), parsed.rfind("}")
-            payload = json.loads(parsed[s:e + 1]) if s != -1 else {"caption": parsed, "tags": []}
+        _job_pool.submit(_run_bulk_job, job_id)
+
+def _start_job(job_id: str) -> None:
+    """_dispatch_job の失敗はジョブを failed にして 502 を返す（resume で再試行できる）"""
+    try:
+        _dispatch_job(job_id)
+    except Exception as exc:
+        log_json(stage="bulk_job", action="dispatch_failed", job_id=job_id, error=str(exc))
+        ddb.update_item(
+            Key={"request_id": f"job#{job_id}"},
+            UpdateExpression="SET job_status = :failed, job_error = :e, updated_at = :t",
+            ConditionExpression="job_status = :queued",
+            ExpressionAttributeValues={":failed": "failed", ":queued": "queued", ":e": f"dispatch failed: {exc}", ":t": int(time.time())},
+        )
+        raise HTTPException(status_code=502, detail="failed to start the job")
 
+def _run_bulk_job(job_id: str, remaining=None) -> dict:
+    """実行権を取ってジョブを進める（非同期起動された Lambda / ローカルのジョブスレッドから呼ばれる）"""
+    run_id = _claim_job_run(job_id)
+    if run_id is None:
+        log_json(stage="bulk_job", action="claim_skipped", job_id=job_id)
+        return {"job_id": job_id, "status": "skipped"}
+    try:
+        meta = _get_job_meta(job_id)
+        keys = _load_job_keys(job_id, int(meta["chunk_count"]))
+    except Exception as exc:
+        error = str(getattr(exc, "detail", exc))
+        log_json(stage="bulk_job", action="load_failed", job_id=job_id, error=error)
+        _update_job_run(job_id, run_id, "SET job_status = :s, job_error = :e, updated_at = :t REMOVE run_id",
+                        {":s": "failed", ":e": error, ":t": int(time.time())})
+        return {"job_id": job_id, "status": "failed"}
 
-    latency = int((time.time() - t0) * 1000)
-    return AnalyzeResponse(
-        provider="aws",
-        model=BEDROCK_MODEL_ID,
-        caption=str(payload.get("caption", "")),
-        tags=list(payload.get("tags", [])),
-        latency_ms=latency,
-        tokens={"input": 0, "output": 0},
-        cost_estimate={"usd": 0.0, "method": "token_based"},
-        raw=out,
-    )
+    job = _BulkJob(job_id, run_id, keys, list(meta["providers"]), bool(meta.get("refresh")), meta.get("chunks_done", ()))
+    _running_jobs[job_id] = job
+    try:
+        return {"job_id": job_id, "status": job.run(remaining)}
+    finally:
+        _running_jobs.pop(job_id, None)
+
+def _get_job_meta(job_id: str) -> dict:
+    item = ddb.get_item(Key={"request_id": f"job#{job_id}"}).get("Item")
+    if not item:
+        raise HTTPException(status_code=404, detail="job not found")
+    return item
+
+def _job_item_results(item: dict):
+    """ジョブの結果アイテムから results を取り出す（compact 形式は gzip / S3 から戻す）"""
+    if "results_json" in item:
+        return json.loads(item["results_json"])
+    return _rehydrate_result_item(item).get("results")
+
+def _job_status(meta: dict) -> str:
+    """queued / running のまま更新が BULK_JOB_STALE_SEC 止まっていれば interrupted とみなす（実行した Lambda がタイムアウト等で止まった）"""
+    status = meta["job_status"]
+    if status in ("queued", "running") and meta["job_id"] not in _running_jobs:
+        if time.time() - int(meta.get("updated_at", 0)) > BULK_JOB_STALE_SEC:
+            return "interrupted"
+    return status
 
 # ==== エンドポイント ====
 @app.get("/healthz")
 def healthz():
     return {"ok": True, "real": USE_REAL}
 
+@app.get("/api/debug/http-pool")
+def http_pool_stats():
+    return _azure_http_stats()
+
+@app.get("/api/debug/circuits")
+def circuit_state():
+    return {name: breaker.snapshot() for name, breaker in _circuit_breakers.items()}
+
+@app.get("/api/debug/persistence")
+def persistence_stats():
+    return _persistence.snapshot()
+
+@app.get("/api/debug/single-flight")
+def single_flight_stats():
+    return {f.name: dict(f.stats) for f in (_s3_flight, _provider_flight, _request_flight)}
+
+@app.get("/api/debug/rate-limits")
+def rate_limit_stats():
+    return {"backend": RATE_LIMIT_BACKEND, "limiters": {key: lim.snapshot() for key, lim in list(_rate_limiters.items())}}
+
+@app.get("/api/debug/startup")
+def startup_stats():
+    return {
+        **_startup_stats,
+        "initialization_type": os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE"),
+        "clients": {c._name: c.initialized for c in (s3, ddb, sfn)},
+        "modules": {m: m in sys.modules for m in ("boto3", "requests", "aws_embedded_metrics", "numpy", "PIL.Image", "httpx")},
+    }
+
+@app.get("/api/debug/image-index")
+def image_index_stats():
+    return _image_index().snapshot()
+
+@app.post("/api/debug/image-index/rebuild")
+def rebuild_image_index():
+    """results/images を走査してインデックスを作り直す（手動で置いた画像を参照できるようにする）"""
+    index = _image_index()
+    index.rebuild()
+    return index.snapshot()
+
+_presign_client = None
+_presign_client_lock = threading.Lock()
+
+def _s3_presign_client():
+    """
+    署名付きURL発行用の S3 クライアント（初回に1回だけ作って使い回す）
+    - ポイント: SigV4 + リージョン直URL(virtual hosting) を強制
+    """
+    global _presign_client
+    if _presign_client is None:
+        with _presign_client_lock:
+            if _presign_client is None:
+                from botocore.client import Config
+                _presign_client = _boto3_client(
+                    "s3",
+                    region_name=AWS_REGION,
+                    config=Config(
+                        signature_version="s3v4",
+                        s3={"addressing_style": "virtual"}  # URLを https://<bucket>.s3.<region>.amazonaws.com/... に
+                    ),
+                    endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com"
+                )
+    return _presign_client
+
+def _presign_put(content_type: str) -> dict:
+    key = f"uploads/{uuid.uuid4()}.jpg"
+    url = _s3_presign_client().generate_presigned_url(
+        ClientMethod="put_object",
+        Params={"Bucket": S3_UPLOAD_BUCKET, "Key": key, "ContentType": content_type},
+        ExpiresIn=S3_PRESIGN_EXPIRE_SEC,
+        HttpMethod="PUT",
+    )
+    return {"url": url, "key": key}
+
 @app.post("/api/s3/presign")
 def create_s3_presigned_url(content_type: str = Query("image/jpeg")):
     """
@@ -591,26 +3452,100 @@ def create_s3_presigned_url(content_type: str = Query("image/jpeg")):
     """
     if not content_type:
         raise HTTPException(status_code=400, detail="content_type is required")
+    return _presign_put(content_type)
+
+@app.post("/api/s3/presign/batch")
+def create_s3_presigned_urls(
+    count: int = Query(..., ge=1, le=S3_PRESIGN_BATCH_MAX),
+    content_type: str = Query("image/jpeg"),
+):
+    """複数画像をアップロードするクライアント向けに、署名付きURLを count 件まとめて発行する"""
+    if not content_type:
+        raise HTTPException(status_code=400, detail="content_type is required")
+    return {"items": [_presign_put(content_type) for _ in range(count)], "expires_in": S3_PRESIGN_EXPIRE_SEC}
+
+def _multipart_part_urls(key: str, upload_id: str, part_numbers: List[int]) -> List[dict]:
+    s3_client = _s3_presign_client()
+    return [
+        {
+            "part_number": n,
+            "url": s3_client.generate_presigned_url(
+                ClientMethod="upload_part",
+                Params={"Bucket": S3_UPLOAD_BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": n},
+                ExpiresIn=S3_PRESIGN_EXPIRE_SEC,
+                HttpMethod="PUT",
+            ),
+        }
+        for n in part_numbers
+    ]
+
+def _check_multipart_key(key: str):
+    # 署名付きアップロードで発行したキー（uploads/ 配下）以外は操作させない
+    if not key.startswith("uploads/") or ".." in key:
+        raise HTTPException(status_code=400, detail=f"invalid key: {key}")
+
+@app.post("/api/s3/multipart/initiate")
+def initiate_s3_multipart_upload(req: MultipartInitiateRequest):
+    """
+    大きな画像をブラウザから S3 に分割アップロードするためのマルチパートアップロードを開始する。
+    size を渡すとパート数を計算し、全パートの署名付きURL（PUT、各レスポンスの ETag を complete に渡す）を返す。
+    """
+    if not req.content_type:
+        raise HTTPException(status_code=400, detail="content_type is required")
+    part_count = None
+    if req.size is not None:
+        if req.size <= 0:
+            raise HTTPException(status_code=400, detail="size must be positive")
+        part_count = -(-req.size // S3_MULTIPART_PART_BYTES)
+        if part_count > S3_MULTIPART_MAX_PARTS:
+            raise HTTPException(status_code=400, detail=f"too many parts: {part_count} (limit {S3_MULTIPART_MAX_PARTS})")
 
     key = f"uploads/{uuid.uuid4()}.jpg"
+    upload_id = s3.create_multipart_upload(Bucket=S3_UPLOAD_BUCKET, Key=key, ContentType=req.content_type)["UploadId"]
+    log_json(stage="s3_multipart", action="initiate", key=key, size=req.size, part_count=part_count)
+    body = {"key": key, "upload_id": upload_id, "part_size": S3_MULTIPART_PART_BYTES, "expires_in": S3_PRESIGN_EXPIRE_SEC}
+    if part_count is not None:
+        body["part_count"] = part_count
+        body["parts"] = _multipart_part_urls(key, upload_id, list(range(1, part_count + 1)))
+    return body
 
-    s3_client = boto3.client(
-        "s3",
-        region_name=AWS_REGION,
-        config=Config(
-            signature_version="s3v4",
-            s3={"addressing_style": "virtual"}  # URLを https://<bucket>.s3.<region>.amazonaws.com/... に
-        ),
-        endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com"
-    )
+@app.post("/api/s3/multipart/part-urls")
+def s3_multipart_part_urls(req: MultipartPartUrlsRequest):
+    """パートの署名付きURLを（再）発行する（期限切れ・サイズ未指定で開始した場合）"""
+    _check_multipart_key(req.key)
+    bad = [n for n in req.part_numbers if not 1 <= n <= S3_MULTIPART_MAX_PARTS]
+    if not req.part_numbers or bad:
+        raise HTTPException(status_code=400, detail=f"part_numbers must be within 1..{S3_MULTIPART_MAX_PARTS}")
+    return {"key": req.key, "upload_id": req.upload_id, "parts": _multipart_part_urls(req.key, req.upload_id, req.part_numbers)}
 
-    url = s3_client.generate_presigned_url(
-        ClientMethod="put_object",
-        Params={"Bucket": S3_UPLOAD_BUCKET, "Key": key, "ContentType": content_type},
-        ExpiresIn=S3_PRESIGN_EXPIRE_SEC,
-        HttpMethod="PUT",
-    )
-    return {"url": url, "key": key}
+@app.post("/api/s3/multipart/complete")
+def complete_s3_multipart_upload(req: MultipartCompleteRequest):
+    _check_multipart_key(req.key)
+    if not req.parts:
+        raise HTTPException(status_code=400, detail="parts is required")
+    parts = sorted(req.parts, key=lambda p: p.part_number)
+    try:
+        resp = s3.complete_multipart_upload(
+            Bucket=S3_UPLOAD_BUCKET,
+            Key=req.key,
+            UploadId=req.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": p.part_number, "ETag": p.etag} for p in parts]},
+        )
+    except Exception as exc:
+        code = _client_error_code(exc)
+        log_json(stage="s3_multipart", action="complete_failed", key=req.key, error=str(exc))
+        if code in ("InvalidPart", "InvalidPartOrder", "EntityTooSmall", "NoSuchUpload"):
+            raise HTTPException(status_code=400, detail=f"{code}: multipart upload could not be completed")
+        raise HTTPException(status_code=502, detail="failed to complete multipart upload")
+    log_json(stage="s3_multipart", action="complete", key=req.key, parts=len(parts))
+    return {"key": req.key, "etag": resp.get("ETag")}
+
+@app.post("/api/s3/multipart/abort")
+def abort_s3_multipart_upload(req: MultipartAbortRequest):
+    _check_multipart_key(req.key)
+    s3.abort_multipart_upload(Bucket=S3_UPLOAD_BUCKET, Key=req.key, UploadId=req.upload_id)
+    log_json(stage="s3_multipart", action="abort", key=req.key)
+    return {"key": req.key, "aborted": True}
 
 @app.post("/api/upload")
 async def upload(file: UploadFile = File(...), file_name: Optional[str] = Form(None)):
@@ -618,9 +3553,11 @@ async def upload(file: UploadFile = File(...), file_name: Optional[str] = Form(N
     fn = file_name or file.filename
     IMAGES_DIR.mkdir(parents=True, exist_ok=True)
     save_path = IMAGES_DIR / f"{req_id}__{fn}"
-    with open(save_path, "wb") as out:
-        out.write(await file.read())
-    return {"request_id": req_id, "s3_uri": f"local://{save_path.name}"}
+    info = await asyncio.to_thread(_stream_upload_to_disk, file.file, save_path)
+    # 初回はインデックスの構築（ディレクトリ走査 + SQLite）になるためイベントループ外で行う
+    await asyncio.to_thread(lambda: _image_index().add(req_id, save_path.name))
+    log_json(stage="upload", request_id=req_id, **info)
+    return {"request_id": req_id, "s3_uri": f"local://{save_path.name}", **info}
 
 @app.post("/api/analyze/aws", response_model=AnalyzeResponse)
 async def analyze_aws(req: AnalyzeRequest):
@@ -628,7 +3565,7 @@ async def analyze_aws(req: AnalyzeRequest):
     success = True
     try:
         if USE_REAL:
-            res = call_bedrock_real(req.request_id)
+            res = await _request_flight.do(f"aws|{BEDROCK_MODEL_ID}|{req.request_id}", lambda: call_bedrock_real_async(req.request_id))
         else:
             res = _mock_result("aws", "bedrock-claude-3-haiku")
             res.latency_ms = int((time.time() - t0) * 1000)
@@ -648,13 +3585,26 @@ async def analyze_aws(req: AnalyzeRequest):
     })
     return res
 
+@app.post("/api/analyze/aws/stream")
+async def analyze_aws_stream(req: AnalyzeRequest):
+    """
+    /api/analyze/aws のストリーミング版（text/event-stream）。
+    逐次配信されるのは uvicorn などの ASGI サーバーで動かした場合のみ。Lambda（Mangum + Function URL / API Gateway）では
+    Mangum が応答全体をバッファしてから返すため、全イベントが完了時にまとめて届く（TTFT の短縮は得られない）。
+    """
+    return StreamingResponse(
+        stream_bedrock_real(req),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/analyze/azure", response_model=AnalyzeResponse)
 async def analyze_azure(req: AnalyzeRequest):
     t0 = time.time()
     success = True
     try:
         if USE_REAL:
-            res = call_azure_real(req.request_id)
+            res = await _request_flight.do(f"azure|{AZURE_DEPLOY}|{req.request_id}", lambda: call_azure_real_async(req.request_id))
         else:
             res = _mock_result("azure", "gpt-4o-mini")
             res.latency_ms = int((time.time() - t0) * 1000)
@@ -676,41 +3626,49 @@ async def analyze_azure(req: AnalyzeRequest):
 
 @app.post("/api/route", response_model=RouteResponse)
 async def route(req: RouteRequest):
-    # ポリシーに応じたプリセットを取得
-    if req.policy == "cost":
-        preset = MODEL_PRESET_COST
-    elif req.policy == "quality":
-        preset = MODEL_PRESET_QUALITY
-    else:
-        # デフォルトはコスト優先
-        preset = MODEL_PRESET_COST
-
-    # "provider:model" の形式をパース
-    try:
-        provider, model = preset.split(":", 1)
-    except ValueError:
-        raise HTTPException(status_code=500, detail=f"Invalid preset format: {preset}")
+    # ポリシー・SLO・直近の健全性から試行順を決める（先頭が失敗したら次へフェイルオーバー）
+    candidates = router.candidates(req.policy, req.latency_slo_ms)
+    hedge = ROUTE_HEDGE_ENABLED if req.hedge is None else req.hedge
 
-    chosen = provider
-    reason = f"policy={req.policy} により {provider} ({model}) を選択"
-
-    # プロバイダーに応じて呼び出し
     t0 = time.time()
     success = True
     try:
-        if provider == "azure":
-            result = call_azure_real(req.request_id) if USE_REAL else _mock_result("azure", model)
-        elif provider == "aws":
-            result = call_bedrock_real(req.request_id) if USE_REAL else _mock_result("aws", model)
-        else:
-            raise HTTPException(status_code=500, detail=f"Unknown provider: {provider}")
+        if hedge and len(candidates) > 1:
+            (primary, reason), (backup, backup_reason) = candidates[0], candidates[1]
+            preset, result, note = await _hedged_call(primary, backup, req.request_id)
+            if preset == backup:
+                reason = backup_reason
+            if note:
+                reason += f", {note}"
+            provider, model = _parse_preset(preset)
+            return RouteResponse(chosen=provider, reason=f"{reason} により {provider} ({model}) を選択", result=result)
+
+        failures = []
+        for preset, reason in candidates:
+            provider, model = _parse_preset(preset)
+            try:
+                result = await _call_preset(preset, req.request_id)
+            except (HTTPException, FileNotFoundError):
+                raise
+            except Exception as exc:
+                failures.append((provider, exc))
+                continue
+
+            if failures:
+                reason += f", {'/'.join(p for p, _ in failures)} 失敗のためフェイルオーバー"
+            reason = f"{reason} により {provider} ({model}) を選択"
+            return RouteResponse(chosen=provider, reason=reason, result=result)
+
+        raise failures[-1][1]
     except Exception:
         success = False
         raise
     finally:
         _record_latency("route", t0, success)
 
-    return RouteResponse(chosen=chosen, reason=reason, result=result)
+@app.get("/api/debug/router")
+def router_state():
+    return {**router.snapshot(), "hedge": _hedge_snapshot()}
 
 @app.post("/api/s3/analyze")
 def analyze_from_s3(request: Request, req: S3AnalyzeReq):
@@ -726,38 +3684,18 @@ def analyze_from_s3(request: Request, req: S3AnalyzeReq):
 
         log_json(stage="analyze_s3", action="start", request_id=request_id, s3_key=key)
 
-        try:
-            obj = s3.get_object(Bucket=S3_UPLOAD_BUCKET, Key=key)
-            img_bytes = obj["Body"].read()
-        except Exception as e:
-            log_json(stage="analyze_s3", action="s3_get_failed", error=str(e))
-            raise HTTPException(status_code=502, detail="failed to fetch object from S3")
-
-        results = []
-
-        if os.environ.get("USE_AZURE", "0") == "1":
-            try:
-                azure_result = call_azure_from_bytes(img_bytes)
-                results.append({"provider": "azure", "result": azure_result})
-            except Exception as e:
-                log_json(stage="analyze_s3", action="azure_failed", error=str(e))
-                results.append({"provider": "azure", "error": str(e)})
-
-        if os.environ.get("USE_SAGEMAKER", "0") == "1":
+        def fetch_and_analyze():
             try:
-                sm_result = call_sagemaker_from_bytes(img_bytes)
-                results.append({"provider": "sagemaker", "result": sm_result})
+                img_bytes = _s3_get_bytes(key)
             except Exception as e:
-                log_json(stage="analyze_s3", action="sagemaker_failed", error=str(e))
-                results.append({"provider": "sagemaker", "error": str(e)})
+                log_json(stage="analyze_s3", action="s3_get_failed", error=str(e))
+                raise HTTPException(status_code=502, detail="failed to fetch object from S3")
+            return _run_providers(img_bytes, providers, refresh=req.refresh)
 
-        if os.environ.get("USE_BEDROCK", "0") == "1":
-            try:
-                bd_result = call_bedrock_from_bytes(img_bytes)
-                results.append({"provider": "bedrock", "result": bd_result})
-            except Exception as e:
-                log_json(stage="analyze_s3", action="bedrock_failed", error=str(e))
-                results.append({"provider": "bedrock", "error": str(e)})
+        # 同じオブジェクトの解析が実行中なら、S3 読み込みと推論はその1回に相乗りする（保存・起動は各リクエストで行う）
+        providers = _enabled_providers()
+        flight_key = f"{S3_UPLOAD_BUCKET}/{key}|{','.join(providers)}|refresh={req.refresh}"
+        results = _s3_flight.do(flight_key, fetch_and_analyze)
 
         try:
             ttl = int(time.time()) + 24*3600
@@ -768,7 +3706,7 @@ def analyze_from_s3(request: Request, req: S3AnalyzeReq):
                 "created_at": int(time.time()),
                 "expire_at": ttl
             }
-            ddb.put_item(Item=item)
+            _persistence.put_item(item)
         except Exception as e:
             log_json(stage="analyze_s3", action="dynamo_failed", error=str(e))
 
@@ -819,6 +3757,166 @@ def analyze_from_s3(request: Request, req: S3AnalyzeReq):
     finally:
         _record_latency("analyze_s3", t0, success)
 
+@app.post("/api/s3/analyze/sagemaker-batch")
+def analyze_batch_from_s3(request: Request, req: S3BatchAnalyzeReq):
+    """複数の S3 キーをまとめて SageMaker でバッチ推論する"""
+    require_api_key(request)  # 任意
+    t0 = time.time()
+    success = True
+    request_id = f"req-{int(time.time()*1000)}"
+    keys = req.s3_keys
+
+    try:
+        if not keys:
+            raise HTTPException(status_code=400, detail="s3_keys is required")
+        if len(keys) > SAGEMAKER_BATCH_MAX_KEYS:
+            raise HTTPException(status_code=400, detail=f"too many s3_keys: {len(keys)} (limit {SAGEMAKER_BATCH_MAX_KEYS})")
+
+        log_json(stage="analyze_s3_batch", action="start", request_id=request_id, count=len(keys))
+
+        # S3 読み込みは並列で行い、失敗した画像は個別エラーとして返す
+        fetches = [_s3_fetch_pool.submit(_read_image_from_s3, key) for key in keys]
+        results: List[Optional[dict]] = [None] * len(keys)
+        images, positions = [], []
+        for i, (key, fut) in enumerate(zip(keys, fetches)):
+            try:
+                images.append(fut.result())
+                positions.append(i)
+            except Exception as e:
+                log_json(stage="analyze_s3_batch", action="s3_get_failed", s3_key=key, error=str(e))
+                results[i] = {"s3_key": key, "provider": "sagemaker", "error": "failed to fetch object from S3"}
+
+        if images:
+            try:
+                batch_results = call_sagemaker_batch_from_bytes(images)
+            except Exception as e:
+                log_json(stage="analyze_s3_batch", action="sagemaker_failed", error=str(e))
+                batch_results = [{"provider": "sagemaker", "error": str(e)}] * len(images)
+            for pos, res in zip(positions, batch_results):
+                if "error" in res:
+                    results[pos] = {"s3_key": keys[pos], "provider": "sagemaker", "error": res["error"]}
+                else:
+                    results[pos] = {"s3_key": keys[pos], "provider": "sagemaker", "result": res}
+
+        rt = round((time.time()-t0)*1000)
+        log_json(stage="analyze_s3_batch", action="done", request_id=request_id, count=len(keys), rt_ms=rt)
+        return {"request_id": request_id, "results": results}
+    except HTTPException:
+        success = False
+        raise
+    except Exception:
+        success = False
+        raise
+    finally:
+        _record_latency("analyze_s3_batch", t0, success)
+
+@app.post("/api/jobs")
+def create_bulk_job(request: Request, req: BulkJobRequest):
+    """S3 キー一覧またはプレフィックスを一括解析するジョブを作成し、非同期起動した Lambda（ローカルではスレッド）で実行する"""
+    require_api_key(request)  # 任意
+    if bool(req.s3_keys) == bool(req.s3_prefix):
+        raise HTTPException(status_code=400, detail="either s3_keys or s3_prefix is required")
+    providers = req.providers or _enabled_providers()
+    unknown = [name for name in providers if name not in PROVIDER_DEADLINE_SEC]
+    if not providers or unknown:
+        raise HTTPException(status_code=400, detail=f"invalid providers: {unknown or providers}")
+
+    keys = list(dict.fromkeys(req.s3_keys)) if req.s3_keys else _list_s3_keys(req.s3_prefix, BULK_JOB_MAX_KEYS)
+    if not keys:
+        raise HTTPException(status_code=400, detail="no objects to analyze")
+    if len(keys) > BULK_JOB_MAX_KEYS:
+        raise HTTPException(status_code=400, detail=f"too many keys (limit {BULK_JOB_MAX_KEYS})")
+
+    job_id = f"job-{uuid.uuid4().hex}"
+    now = int(time.time())
+    chunk_count = (len(keys) + BULK_JOB_CHUNK_SIZE - 1) // BULK_JOB_CHUNK_SIZE
+    with ddb.batch_writer() as writer:
+        writer.put_item(Item={
+            "request_id": f"job#{job_id}",
+            "job_id": job_id,
+            "job_status": "queued",
+            "total": len(keys),
+            "chunk_size": BULK_JOB_CHUNK_SIZE,
+            "chunk_count": chunk_count,
+            "providers": providers,
+            "refresh": req.refresh,
+            "s3_prefix": req.s3_prefix or "",
+            "succeeded": 0,
+            "failed": 0,
+            "created_at": now,
+            "updated_at": now,
+            "expire_at": now + BULK_JOB_TTL_SEC,
+        })
+        for n in range(chunk_count):
+            writer.put_item(Item={
+                "request_id": f"job#{job_id}#keys#{n}",
+                "s3_keys": keys[n * BULK_JOB_CHUNK_SIZE:(n + 1) * BULK_JOB_CHUNK_SIZE],
+                "created_at": now,
+                "expire_at": now + BULK_JOB_TTL_SEC,
+            })
+
+    log_json(stage="bulk_job", action="created", job_id=job_id, total=len(keys), providers=providers)
+    _start_job(job_id)
+    return {"job_id": job_id, "status": "queued", "total": len(keys), "chunk_count": chunk_count}
+
+@app.get("/api/jobs/{job_id}")
+def get_bulk_job(job_id: str, offset: int = Query(0, ge=0), limit: int = Query(20, ge=0, le=100)):
+    """進捗・スループットと、offset から limit 件の結果（書き込み済みのもののみ）を返す"""
+    meta = _get_job_meta(job_id)
+    status = _job_status(meta)
+    total = int(meta["total"])
+    succeeded, failed = int(meta.get("succeeded", 0)), int(meta.get("failed", 0))
+    processed = succeeded + failed
+
+    job = _running_jobs.get(job_id)
+    if job is not None and job.processed:
+        throughput = job.processed / max(time.time() - job.started, 1e-6)
+    else:
+        elapsed = int(meta.get("updated_at", 0)) - int(meta.get("run_started_at", meta["created_at"]))
+        throughput = int(meta.get("run_processed", 0)) / elapsed if elapsed > 0 else 0.0
+
+    ids = [f"job#{job_id}#item#{i}" for i in range(offset, min(offset + limit, total))]
+    items = _batch_get_items(ids) if ids else {}
+    results = [
+        {"index": offset + i, "s3_key": items[rid]["s3_key"], "status": items[rid]["item_status"], "results": _job_item_results(items[rid])}
+        for i, rid in enumerate(ids) if rid in items
+    ]
+    return {
+        "job_id": job_id,
+        "status": status,
+        "resumable": status in ("interrupted", "failed"),
+        "total": total,
+        "processed": processed,
+        "succeeded": succeeded,
+        "failed": failed,
+        "progress": round(processed / total, 4) if total else 1.0,
+        "throughput_per_sec": round(throughput, 3),
+        "chunks_done": len(meta.get("chunks_done", [])),
+        "chunk_count": int(meta["chunk_count"]),
+        "error": meta.get("job_error"),
+        "offset": offset,
+        "results": results,
+    }
+
+@app.post("/api/jobs/{job_id}/resume")
+def resume_bulk_job(request: Request, job_id: str):
+    """中断・失敗したジョブを、完了済みチャンクを飛ばして再開する"""
+    require_api_key(request)  # 任意
+    meta = _get_job_meta(job_id)
+    status = _job_status(meta)
+    if status == "completed":
+        return {"job_id": job_id, "status": status}
+    if status not in ("interrupted", "failed"):
+        raise HTTPException(status_code=409, detail=f"job is {status}")
+    # 判定と再開の間に他の再開要求・実行が割り込んでいれば、条件付き更新で弾く
+    if not _requeue_job(job_id):
+        raise HTTPException(status_code=409, detail="job was resumed or updated concurrently")
+
+    chunks_done = len(meta.get("chunks_done", []))
+    log_json(stage="bulk_job", action="resumed", job_id=job_id, skipped_chunks=chunks_done)
+    _start_job(job_id)
+    return {"job_id": job_id, "status": "queued", "total": int(meta["total"]), "chunks_done": chunks_done}
+
 @app.post("/api/pipeline/start", response_model=PipelineStartResponse)
 def start_pipeline(req: PipelineStartRequest):
     if not STEP_FUNCTION_ARN:
@@ -885,16 +3983,180 @@ def pipeline_status(execution_arn: str):
     finally:
         _record_latency("pipeline_status", t0, success)
 
+@app.get("/api/results/summary")
+def results_summary(since: Optional[str] = Query(None, description="ISO8601 (UTC) 以降の行のみ集計")):
+    _persistence.drain()
+    try:
+        return {"since": since, "providers": _summarize_results(since)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"invalid since: {since}")
+
 @app.get("/api/result/{request_id}")
 def get_result(request_id: str):
     r = ddb.get_item(Key={"request_id": request_id})
     if "Item" not in r:
         return {"found": False}
-    return {"found": True, "item": r["Item"]}
+    return {"found": True, "item": _rehydrate_result_item(r["Item"])}
+
+# ==== S3 転送（レンジ指定の並列 GET） ====
+_s3_transfer_pool = ThreadPoolExecutor(max_workers=max(S3_TRANSFER_THREADS, 1), thread_name_prefix="s3-transfer")
+# オブジェクト単位の並列取得（バッチ解析）用。パート取得（_s3_transfer_pool）を待つ側なので同じプールには載せない。
+# _provider_pool にも載せない（大きなバッチが他リクエストのプロバイダー呼び出しを待たせ、期限切れにするため）
+_s3_fetch_pool = ThreadPoolExecutor(max_workers=max(S3_FETCH_WORKERS, 1), thread_name_prefix="s3-fetch")
+
+def _read_body_into(body, view: memoryview) -> None:
+    """レスポンス本文を view に直接読み込む（中間の bytes を作らない）"""
+    got = 0
+    try:
+        while got < len(view):
+            n = body.readinto(view[got:])
+            if not n:
+                raise IOError(f"short read from S3: {got} of {len(view)} bytes")
+            got += n
+    finally:
+        body.close()
+
+def _check_s3_read_size(resp: dict, total: int, key: str) -> None:
+    if total > S3_READ_MAX_BYTES:
+        resp["Body"].close()
+        raise HTTPException(status_code=413, detail=f"s3 object too large: {key} is {total} bytes (limit {S3_READ_MAX_BYTES})")
+
+def _s3_get_bytes(key: str, bucket: Optional[str] = None) -> bytearray:
+    """
+    オブジェクトを S3_TRANSFER_PART_BYTES ごとのレンジ GET で並列に取得し、事前確保したバッファに直接書き込む。
+    - 先頭パートの GET の Content-Range で全体サイズを知る（HEAD は投げない）
+    - 残りのパートは IfMatch=ETag で取得し、途中で上書きされたオブジェクトを混ぜない
+    - パートサイズ以下のオブジェクトは GET 1回で終わる
+    - 全体サイズが S3_READ_MAX_BYTES を超えるオブジェクトはバッファを確保する前に 413
+    """
+    bucket = bucket or S3_UPLOAD_BUCKET
+    part = S3_TRANSFER_PART_BYTES
+    if part <= 0:
+        resp = s3.get_object(Bucket=bucket, Key=key)
+        _check_s3_read_size(resp, int(resp["ContentLength"]), key)
+        return bytearray(resp["Body"].read())
+    try:
+        first = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{part - 1}")
+    except Exception as exc:
+        if _client_error_code(exc) != "InvalidRange":
+            raise
+        return bytearray()  # 0 バイトのオブジェクト
+    content_range = first.get("ContentRange")
+    total = int(content_range.rsplit("/", 1)[1]) if content_range else int(first["ContentLength"])
+    _check_s3_read_size(first, total, key)
+    buf = bytearray(total)
+    view = memoryview(buf)
+    _read_body_into(first["Body"], view[:min(part, total)])
+    if total <= part:
+        return buf
+
+    etag = first.get("ETag")
+
+    def fetch(start: int, end: int):
+        extra = {"IfMatch": etag} if etag else {}
+        resp = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", **extra)
+        _read_body_into(resp["Body"], view[start:end])
+
+    futures = [_s3_transfer_pool.submit(fetch, start, min(start + part, total)) for start in range(part, total, part)]
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+    return buf
 
 def _read_image_from_s3(s3_key: str) -> bytes:
-    obj = s3.get_object(Bucket=S3_UPLOAD_BUCKET, Key=s3_key)
-    return obj["Body"].read()
+    return _s3_get_bytes(s3_key)
+
+# ==== パイプライン前処理アーティファクト（実行ごとに S3 読み込み・デコードを1回に） ====
+_artifact_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_artifact_cache_lock = threading.Lock()
+
+def _pipeline_artifact_keys(s3_key: str) -> Dict[str, str]:
+    base = f"{PIPELINE_ARTIFACT_PREFIX.rstrip('/')}/{s3_key}"
+    return {
+        "llm_jpeg": f"{base}/llm.jpg",
+        "sagemaker_tensor": f"{base}/sagemaker-{SAGEMAKER_PAYLOAD_MODE}.npy",
+    }
+
+def _remember_artifact(key: str, data: bytes) -> None:
+    """同じウォームコンテナで後続タスクが動いた場合に S3 GET を省くためのプロセス内キャッシュ"""
+    with _artifact_cache_lock:
+        _artifact_cache[key] = data
+        _artifact_cache.move_to_end(key)
+        while len(_artifact_cache) > PIPELINE_ARTIFACT_CACHE_ITEMS:
+            _artifact_cache.popitem(last=False)
+
+def _read_pipeline_artifact(key: str) -> bytes:
+    with _artifact_cache_lock:
+        data = _artifact_cache.get(key)
+    if data is None:
+        data = _read_image_from_s3(key)
+        _remember_artifact(key, data)
+    return data
+
+def _prepare_pipeline_artifacts(s3_key: str) -> Dict[str, str]:
+    """
+    元画像を1回だけ取得・デコードし、LLM 用の縮小 JPEG と SageMaker 用テンソル(.npy)を
+    派生キー(PIPELINE_ARTIFACT_PREFIX 配下)に保存する。後続タスクはこのキーを参照する。
+    """
+    prepared = PreparedImage(_read_image_from_s3(s3_key))
+    llm_jpeg = prepared.llm_jpeg
+    tensor = prepared.sagemaker_tensor(normalize=(SAGEMAKER_PAYLOAD_MODE != "uint8"))
+    buf = io.BytesIO()
+    np.save(buf, tensor, allow_pickle=False)
+
+    keys = _pipeline_artifact_keys(s3_key)
+    for name, data, content_type in (
+        ("llm_jpeg", llm_jpeg, "image/jpeg"),
+        ("sagemaker_tensor", buf.getvalue(), "application/x-npy"),
+    ):
+        s3.put_object(Bucket=S3_UPLOAD_BUCKET, Key=keys[name], Body=data, ContentType=content_type)
+        _remember_artifact(keys[name], data)
+    return keys
+
+PIPELINE_TASKS = ("sagemaker", "bedrock", "azure")
+
+def _pipeline_task_list(task) -> Optional[List[str]]:
+    """task="all" またはリスト指定なら実行するタスク一覧を返す（単一タスクは None）"""
+    if task == "all":
+        return list(PIPELINE_TASKS)
+    if not isinstance(task, list):
+        return None
+    unknown = [t for t in task if t not in PIPELINE_TASKS]
+    if unknown:
+        raise ValueError(f"unknown task {unknown}")
+    return list(dict.fromkeys(task))
+
+def _run_combined_pipeline(tasks: List[str], s3_key: str, request_id: str, refresh: bool) -> dict:
+    """
+    1回の起動で S3 取得を1度だけ行い、複数プロバイダーを並列実行する。
+    戻り値は単一タスク時のレスポンスをタスク名ごとに並べた形（PersistResults がそのまま参照できる）。
+    全プロバイダーが失敗した場合のみ例外にしてステートマシンの Catch に渡す。
+    """
+    try:
+        img_bytes = _read_image_from_s3(s3_key)
+    except Exception as exc:
+        log_json(stage="pipeline_worker", action="s3_get_failed", error=str(exc), s3_key=s3_key)
+        raise
+
+    response = {"task": "all", "request_id": request_id, "s3_key": s3_key, "tasks": tasks}
+    for entry in _run_providers(img_bytes, tasks, stage="pipeline_worker", refresh=refresh):
+        name = entry["provider"]
+        task_response = {"task": name, "request_id": request_id, "s3_key": s3_key}
+        if "error" in entry:
+            task_response["error"] = entry["error"]
+        elif name == "azure":
+            task_response["result"] = {"provider": "azure", "raw": entry["result"]}
+        else:
+            task_response["result"] = entry["result"]
+        response[name] = task_response
+
+    if all("error" in response[name] for name in tasks):
+        raise RuntimeError(f"all providers failed: {[response[name]['error'] for name in tasks]}")
+    return response
 
 def pipeline_handler(event, context):
     """Step Functions から直接呼ばれるワーカーLambda"""
@@ -902,27 +4164,50 @@ def pipeline_handler(event, context):
     task = event.get("task")
     s3_key = event.get("s3_key")
     request_id = event.get("request_id", f"sf-{int(time.time()*1000)}")
+    refresh = bool(event.get("refresh", False))
+
+    artifacts = event.get("artifacts") or {}
 
     if not task or not s3_key:
         raise ValueError("task and s3_key are required")
 
     log_json(stage="pipeline_worker", action="start", task=task, s3_key=s3_key, request_id=request_id)
 
+    if task == "prepare":
+        try:
+            artifacts = _prepare_pipeline_artifacts(s3_key)
+        except Exception as exc:
+            log_json(stage="pipeline_worker", action="prepare_failed", error=str(exc), s3_key=s3_key)
+            raise
+        log_json(stage="pipeline_worker", action="done", task=task, request_id=request_id)
+        return {"task": task, "request_id": request_id, "s3_key": s3_key, "artifacts": artifacts}
+
+    tasks = _pipeline_task_list(task)
+    if tasks is not None:
+        response = _run_combined_pipeline(tasks, s3_key, request_id, refresh)
+        log_json(stage="pipeline_worker", action="done", task=tasks, request_id=request_id)
+        return response
+
+    # 前処理アーティファクトがあれば、SageMaker はテンソル、LLM 系は縮小 JPEG を使う
+    artifact_key = artifacts.get("sagemaker_tensor" if task == "sagemaker" else "llm_jpeg")
     try:
-        img_bytes = _read_image_from_s3(s3_key)
+        img_bytes = _read_pipeline_artifact(artifact_key) if artifact_key else _read_image_from_s3(s3_key)
     except Exception as exc:
-        log_json(stage="pipeline_worker", action="s3_get_failed", error=str(exc), s3_key=s3_key)
+        log_json(stage="pipeline_worker", action="s3_get_failed", error=str(exc), s3_key=artifact_key or s3_key)
         raise
 
     try:
-        if task == "sagemaker":
-            provider_result = call_sagemaker_from_bytes(img_bytes)
+        if task == "sagemaker" and artifact_key:
+            tensor = np.load(io.BytesIO(img_bytes), allow_pickle=False)
+            provider_result = call_sagemaker_from_tensor(tensor, refresh=refresh)
+        elif task == "sagemaker":
+            provider_result = call_sagemaker_from_bytes(img_bytes, refresh=refresh)
         elif task == "bedrock":
-            provider_result = call_bedrock_from_bytes(img_bytes)
+            provider_result = call_bedrock_from_bytes(img_bytes, refresh=refresh)
         elif task == "azure":
             provider_result = {
                 "provider": "azure",
-                "raw": call_azure_from_bytes(img_bytes)
+                "raw": call_azure_from_bytes(img_bytes, refresh=refresh)
             }
         else:
             raise ValueError(f"unknown task {task}")
@@ -938,3 +4223,30 @@ def pipeline_handler(event, context):
     }
     log_json(stage="pipeline_worker", action="done", task=task, request_id=request_id)
     return response
+
+# ==== コールドスタート（事前初期化フック） ====
+def preinitialize() -> dict:
+    """
+    初回利用時まで遅らせている import とクライアント生成を先に済ませる。
+    Provisioned Concurrency / SnapStart では初期化フェーズ（スナップショット前）に実行すれば
+    最初のリクエストが遅延読み込みのコストを払わずに済む。
+    """
+    t0 = time.perf_counter()
+    import aws_embedded_metrics.logger.metrics_logger_factory  # noqa: F401
+    for lazy in (np, Image, httpx, postprocess, s3, ddb, sfn, _serializer, _deserializer):
+        lazy._resolve()
+    if USE_REAL:
+        _get_smr()
+        _get_bedrock_rt()
+        _get_azure_session()
+    elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+    _startup_stats["preinit_ms"] = elapsed_ms
+    log_json(stage="startup", action="preinitialized", elapsed_ms=elapsed_ms)
+    return {"elapsed_ms": elapsed_ms}
+
+_startup_stats = {"import_ms": None, "preinit_ms": None}
+if LAMBDA_PREINIT == "1" or (
+    LAMBDA_PREINIT == "auto" and os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE") in ("provisioned-concurrency", "snap-start")
+):
+    preinitialize()
+_startup_stats["import_ms"] = round((time.perf_counter() - _IMPORT_T0) * 1000, 1)
@@ -0,0 +1,124 @@
+"""
+分類モデル（SageMaker）出力の後処理。
+
+- レスポンス本文を Python のリストを経由せず (N, C) の NumPy 配列にする
+- argpartition で top-k を取り、k 件だけを並べ替える（全クラスの argsort はしない）
+- softmax は任意（ロジットを返すエンドポイント向け）
+- クラスラベル表は起動時に1回だけ読み込んで使い回す
+"""
+import json
+import pathlib
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+_ROW_SEP = re.compile(r"\]\s*,\s*\[")
+
+
+def parse_scores(body: bytes) -> np.ndarray:
+    """
+    エンドポイントのレスポンスを (N, C) の float64 配列にする（エンドポイントが返した値をそのまま保つ）。
+    - [[...], [...]] / [...]: 数値部分を np.fromstring で直接パース
+    - {"predictions": [...]} などそれ以外の JSON: json.loads してから配列化
+    形が揃わない（ragged）場合は json.loads 経由で配列化し、それでも揃わなければ ValueError
+    np.fromstring は不正な値の手前で黙って打ち切る（DeprecationWarning のみ）ため、
+    要素数がカンマ区切りの数と一致しない行があれば高速パスを使わず json.loads で厳密にパースする
+    """
+    text = body.decode("utf-8", errors="ignore").strip() if isinstance(body, (bytes, bytearray)) else str(body).strip()
+    if text.startswith("[") and "{" not in text and '"' not in text:
+        rows = _ROW_SEP.split(text[2:-2]) if text.startswith("[[") else [text[1:-1]]
+        parsed = [np.fromstring(r, dtype=np.float64, sep=",") for r in rows]
+        complete = all(p.size == r.count(",") + 1 for p, r in zip(parsed, rows))
+        if complete and parsed and parsed[0].size and all(r.size == parsed[0].size for r in parsed):
+            return np.stack(parsed)
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("predictions", data.get("scores", data.get("probabilities")))
+    arr = np.asarray(data, dtype=np.float64)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    if arr.ndim != 2 or arr.shape[1] == 0:
+        raise ValueError(f"unexpected score shape: {arr.shape}")
+    return arr
+
+
+def softmax(scores: np.ndarray) -> np.ndarray:
+    """行ごとの softmax（最大値を引いてオーバーフローを避ける）"""
+    z = scores - scores.max(axis=1, keepdims=True)
+    np.exp(z, out=z)
+    z /= z.sum(axis=1, keepdims=True)
+    return z
+
+
+def top_k(scores: np.ndarray, k: int):
+    """
+    (N, C) のスコアから行ごとの上位 k 件を降順で返す: (indices (N, k), values (N, k))。
+    argpartition で k 件を O(C) で選び、その k 件だけをソートする。
+    """
+    k = max(1, min(int(k), scores.shape[1]))
+    if k == scores.shape[1]:
+        part = np.broadcast_to(np.arange(k), scores.shape)
+    else:
+        part = np.argpartition(scores, -k, axis=1)[:, -k:]
+    values = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def load_labels(path: Optional[str]) -> Optional[List[str]]:
+    """
+    クラスラベル表を読み込む。
+    - .json: ["tench", ...] または {"0": "tench", ...}（ImageNet の class_index 形式 {"0": ["n01440764", "tench"]} も可）
+    - それ以外: 1行1ラベルのテキスト
+    path が空なら None（ラベルなし）
+    """
+    if not path:
+        return None
+    p = pathlib.Path(path)
+    text = p.read_text(encoding="utf-8")
+    if p.suffix.lower() != ".json":
+        return [line.strip() for line in text.splitlines() if line.strip()]
+    data = json.loads(text)
+    if isinstance(data, list):
+        return [str(v) for v in data]
+    labels = [""] * (max(int(k) for k in data) + 1)
+    for k, v in data.items():
+        labels[int(k)] = str(v[-1] if isinstance(v, (list, tuple)) else v)
+    return labels
+
+
+def summarize_scores(
+    scores: np.ndarray,
+    k: int = 5,
+    labels: Optional[Sequence[str]] = None,
+    apply_softmax: bool = False,
+    include_all_scores: bool = True,
+) -> List[Dict]:
+    """
+    (N, C) のスコアを画像ごとの分類結果に変換する（top-k は全行まとめてベクトル演算）。
+    返す dict は従来形式（predicted_class_index / confidence_score / top_5_indices / all_scores）に
+    top_k（index / score / label）と predicted_label を加えたもの。
+    """
+    if apply_softmax:
+        scores = softmax(scores.astype(np.float64, copy=True))
+    indices, values = top_k(scores, max(k, 5))
+    n_labels = len(labels) if labels is not None else 0
+    idx_rows, val_rows = indices.tolist(), values.tolist()
+    results = []
+    for row, (idx, val) in enumerate(zip(idx_rows, val_rows)):
+        entries = [
+            {"index": i, "score": v, "label": labels[i] if i < n_labels else None}
+            for i, v in zip(idx[:k], val[:k])
+        ]
+        result = {
+            "predicted_class_index": idx[0],
+            "predicted_label": labels[idx[0]] if idx[0] < n_labels else None,
+            "confidence_score": val[0],
+            "top_5_indices": idx[:5],
+            "top_k": entries,
+        }
+        if include_all_scores:
+            result["all_scores"] = [scores[row].tolist()]
+        results.append(result)
+    return results